@@ -36,7 +36,7 @@ from datetime import datetime, timedelta
 
 from imageserver.admin import blueprint
 from imageserver.errors import DoesNotExistError
-from imageserver.flask_app import app, data_engine, image_engine, permissions_engine
+from imageserver.flask_app import app, cache_engine, data_engine, image_engine, permissions_engine
 from imageserver.image_attrs import ImageAttrs
 from imageserver.template_attrs import TemplateAttrs
 from imageserver.models import Folder, Group, ImageTemplate, Property, User
@@ -303,7 +303,13 @@ def maintenance():
         timedelta(days=app.config['STATS_KEEP_DAYS'])
         if app.config['STATS_KEEP_DAYS'] > 0 else 31
     )
+    # The local and disk cache statistics are for this process only
+    cache_stats = [
+        ('In-process cache', cache_engine.local_stats()),
+        ('Disk cache', cache_engine.disk_stats())
+    ]
     return render_template(
         'admin_maintenance.html',
-        purge_to=purge_to
+        purge_to=purge_to,
+        cache_stats=[(name, stats) for (name, stats) in cache_stats if stats is not None]
     )
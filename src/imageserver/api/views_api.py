@@ -33,9 +33,11 @@
 # 12Oct2018  Matt  v4.1 Return standard image object dict from all APIs
 #
 
-from time import sleep
+import json
+from time import sleep, time
+import uuid
 
-from flask import request
+from flask import Response, request
 
 from imageserver.api import blueprint, url_version_prefix
 from imageserver.api.helpers import _prep_blank_image_object, _prep_image_object
@@ -45,27 +47,31 @@ from imageserver.api_util import (
 )
 from imageserver.csrf import csrf_exempt
 from imageserver.errors import (
-    AuthenticationError, DoesNotExistError, ImageError,
+    AuthenticationError, DBError, DoesNotExistError, ImageError,
     ParameterError, SecurityError
 )
 from imageserver.filesystem_manager import get_directory_listing, get_upload_directory, path_exists
 from imageserver.filesystem_sync import auto_sync_file, auto_sync_existing_file
-from imageserver.filesystem_sync import auto_sync_folder
+from imageserver.filesystem_sync import auto_sync_folder, on_image_db_create_anon_history
 from imageserver.flask_app import (
     app, logger,
-    cache_engine, data_engine, image_engine, permissions_engine, task_engine
+    cache_engine, data_engine, image_engine, permissions_engine,
+    stats_engine, task_engine
 )
 from imageserver.flask_ext import TimedTokenBasicAuthentication
 from imageserver.flask_util import external_url_for
 from imageserver.models import FolderPermission, Image, User
 from imageserver.session_manager import get_session_user
+from imageserver.session_manager import logged_in as session_logged_in
 from imageserver.user_auth import authenticate_user
 from imageserver.util import (
-    add_sep, filepath_filename, get_file_extension, secure_filename,
-    object_to_dict, parse_boolean, parse_int,
+    add_sep, filepath_filename, filepath_parent, get_file_extension,
+    secure_filename, object_to_dict, parse_boolean, parse_int,
     validate_number, validate_string
 )
-from imageserver.views_util import login_point
+from imageserver.views_util import (
+    get_image_attrs_from_args, login_point, public_image_limits_post_image_checks
+)
 
 
 # v4.1 None of the APIs here are specced to return the audit trail in the image
@@ -77,6 +83,9 @@ _omit_fields = [
     'history', 'user'
 ]
 
+# The maximum number of images that can be requested from the batch API
+_max_batch_images = 100
+
 
 # API login - generates a token to use the API outside of the web site
 @blueprint.route('/token', methods=['POST'], strict_slashes=False)
@@ -379,3 +388,138 @@ def upload():
 
     # If here, all files were uploaded successfully
     return make_api_success_response(ret_dict)
+
+
+# Generates or retrieves multiple images in one request. The request body is a
+# JSON list of image parameter objects, each as for the /image URL parameters.
+# Returns a multipart/mixed response, with one part per requested image in the
+# same order, each having a Content-ID of the index of the image in the list.
+# If an image fails, its part is a JSON object of the API error instead.
+@blueprint.route('/batch', methods=['POST'], strict_slashes=False)
+@blueprint.route(url_version_prefix + '/batch', methods=['POST'], strict_slashes=False)
+@csrf_exempt
+@add_api_error_handler
+def imagebatch():
+    batch_started = time()
+    image_specs = request.get_json(silent=True)
+    if not isinstance(image_specs, list) or not image_specs:
+        raise ParameterError('A JSON list of image parameters is required')
+    if len(image_specs) > _max_batch_images:
+        raise ParameterError(
+            'A maximum of ' + str(_max_batch_images) + ' images can be requested'
+        )
+
+    logged_in = session_logged_in()
+    current_user = get_session_user()
+    results = [None] * len(image_specs)
+    image_ids = {}
+    folder_errors = {}
+
+    def _check_folder(folder_path):
+        # Only check each folder's permissions once
+        if folder_path not in folder_errors:
+            try:
+                permissions_engine.ensure_folder_permitted(
+                    folder_path, FolderPermission.ACCESS_VIEW, current_user
+                )
+                folder_errors[folder_path] = None
+            except Exception as e:
+                folder_errors[folder_path] = e
+        if folder_errors[folder_path] is not None:
+            raise folder_errors[folder_path]
+
+    # Validate the image specs and check permissions
+    valid_attrs = []
+    for (idx, image_spec) in enumerate(image_specs):
+        try:
+            if not isinstance(image_spec, dict):
+                raise ValueError('Image parameters must be a JSON object')
+            try:
+                image_attrs = get_image_attrs_from_args(
+                    {k: str(v) for (k, v) in image_spec.items() if v is not None},
+                    logged_in
+                )
+            except (ValueError, TypeError) as e:
+                raise ParameterError(str(e))
+            # Get/create the database ID, only once per image file
+            src = image_attrs.filename()
+            if src not in image_ids:
+                image_ids[src] = data_engine.get_or_create_image_id(
+                    src,
+                    return_deleted=False,
+                    on_create=on_image_db_create_anon_history
+                )
+            if image_ids[src] == 0:
+                raise DoesNotExistError(src)
+            elif image_ids[src] < 0:
+                raise DBError('Failed to add image to database')
+            image_attrs.set_database_id(image_ids[src])
+            # Require view permission or file admin, ditto for overlays
+            _check_folder(image_attrs.folder_path())
+            if image_attrs.overlay_src():
+                _check_folder(filepath_parent(image_attrs.overlay_src()))
+            valid_attrs.append((idx, image_attrs))
+        except Exception as e:
+            results[idx] = e
+
+    # Get the images, cached images first then generate the rest in parallel
+    image_wrappers = image_engine.get_images([ia for (_, ia) in valid_attrs])
+    for ((idx, image_attrs), image_wrapper) in zip(valid_attrs, image_wrappers):
+        if image_wrapper is None:
+            image_wrapper = DoesNotExistError(image_attrs.filename())
+        elif not isinstance(image_wrapper, Exception) and not logged_in:
+            try:
+                public_image_limits_post_image_checks(
+                    image_attrs.width(),
+                    image_attrs.height(),
+                    image_attrs.template(),
+                    image_wrapper
+                )
+            except ValueError as e:
+                image_wrapper = ParameterError(str(e))
+        results[idx] = image_wrapper
+
+    # Log the image views, sharing the request time between them
+    duration_secs = (time() - batch_started) / len(results)
+    for result in results:
+        if not isinstance(result, Exception) and result is not None:
+            stats_engine.log_view(
+                result.attrs().database_id(),
+                len(result.data()),
+                result.is_from_cache(),
+                duration_secs,
+                result.record_stats()
+            )
+
+    boundary = uuid.uuid4().hex
+    return Response(
+        _multipart_stream(results, boundary),
+        mimetype='multipart/mixed; boundary=' + boundary
+    )
+
+
+def _multipart_stream(results, boundary):
+    """
+    A generator for a multipart/mixed response body from a list of ImageWrapper
+    objects, or exceptions that are returned as JSON API error objects.
+    """
+    for (idx, result) in enumerate(results):
+        if isinstance(result, Exception):
+            headers = {'Content-Type': 'application/json'}
+            part_data = json.dumps(create_api_error_dict(result, logger)).encode('utf8')
+        else:
+            headers = {
+                'Content-Type': result.attrs().mime_type(),
+                'X-From-Cache': str(result.is_from_cache())
+            }
+            part_data = result.data()
+        headers['Content-ID'] = str(idx)
+        headers['Content-Length'] = str(len(part_data))
+        yield (
+            '--' + boundary + '\r\n' +
+            ''.join(k + ': ' + v + '\r\n' for (k, v) in headers.items()) +
+            '\r\n'
+        ).encode('utf8')
+        yield part_data
+        yield b'\r\n'
+    yield ('--' + boundary + '--\r\n').encode('utf8')
@@ -36,22 +36,22 @@
 
 from collections import defaultdict
 import errno
+import io
 import json
 import os
 import socketserver
 import signal
+import struct
 import sys
 import time
 from datetime import date, datetime, timedelta
 from threading import Event, Lock, Thread
 
 from flask import current_app as app
-from sqlalchemy import func
-from sqlalchemy.exc import IntegrityError
 
 from imageserver.auxiliary import util
 from imageserver.counter import Counter
-from imageserver.models import ImageStats, SystemStats, Task
+from imageserver.models import SystemStats, Task
 
 try:
     import psutil
@@ -59,6 +59,15 @@ try:
 except ImportError:
     _have_psutil = False
 
+# Stats clients that add up their stats locally send them in a binary frame.
+# The frame starts with FRAME_MARKER (which cannot start a JSON object), then
+# the number of records, then the records, one per image ID (0 for system stats
+# only), containing the FRAME_FIELDS values followed by max_request_seconds.
+FRAME_MARKER = b'\x00'
+FRAME_HEADER = struct.Struct('!I')
+FRAME_RECORD = struct.Struct('!IIIIIQdd')
+FRAME_FIELDS = ('requests', 'views', 'cached_views', 'downloads', 'bytes', 'request_seconds')
+
 
 class StatsRequestHandler(socketserver.StreamRequestHandler):
     """
@@ -67,8 +76,8 @@ class StatsRequestHandler(socketserver.StreamRequestHandler):
     def handle(self):
         """
         Handle multiple requests for as long as the connection is open.
-        Each request is expected to contain the stats object in JSON format,
-        terminated by a newline character.
+        Each request is expected to contain either the stats object in JSON
+        format, terminated by a newline character, or a binary stats frame.
         """
         self.server.logger.debug('Entering client stats stream handler')
         while not self.server.shutdown_ev.is_set():
@@ -79,10 +88,13 @@ class StatsRequestHandler(socketserver.StreamRequestHandler):
         self.server.logger.debug('Exited client stats stream handler')
 
     def _handle_one(self):
-        data = self.rfile.readline()
+        data = self.rfile.read(1)
         if not data:
             raise StopIteration()
+        if data == FRAME_MARKER:
+            return self._handle_frame()
 
+        data += self.rfile.readline()
         stats_dict = json.loads(data.decode('utf8'))
         for image_key, stats_obj in stats_dict.items():
             image_id = int(image_key)
@@ -90,18 +102,37 @@ class StatsRequestHandler(socketserver.StreamRequestHandler):
             if image_id:
                 self._img_cache(image_id, stats_obj)
 
-    def _sys_cache(self, stats_obj):
+    def _handle_frame(self):
+        data = self.rfile.read(FRAME_HEADER.size)
+        if len(data) < FRAME_HEADER.size:
+            raise StopIteration()
+        (num_records, ) = FRAME_HEADER.unpack(data)
+        data = self.rfile.read(num_records * FRAME_RECORD.size)
+        if len(data) < num_records * FRAME_RECORD.size:
+            raise StopIteration()
+
+        for record in FRAME_RECORD.iter_unpack(data):
+            image_id = record[0]
+            stats_obj = {k: v for k, v in zip(FRAME_FIELDS, record[1:]) if v}
+            max_secs = record[-1] if 'request_seconds' in stats_obj else None
+            self._sys_cache(stats_obj, max_secs)
+            if image_id:
+                self._img_cache(image_id, stats_obj, max_secs)
+
+    def _sys_cache(self, stats_obj, max_secs=None):
         with self.server.sys_cache_lock:
             sys_cache = self.server.sys_cache
             sys_cache.update(stats_obj)
             # Add/update calculated field max_request_seconds
-            if 'request_seconds' in stats_obj:
+            if max_secs is None:
+                max_secs = stats_obj.get('request_seconds')
+            if max_secs is not None:
                 sys_cache['max_request_seconds'] = max(
                     sys_cache['max_request_seconds'],
-                    stats_obj['request_seconds']
+                    max_secs
                 )
 
-    def _img_cache(self, image_key, stats_obj):
+    def _img_cache(self, image_key, stats_obj, max_secs=None):
         with self.server.img_cache_lock:
             img_cache = self.server.img_cache
             istats = img_cache.get(image_key)
@@ -110,10 +141,12 @@ class StatsRequestHandler(socketserver.StreamRequestHandler):
                 img_cache[image_key] = istats
             istats.update(stats_obj)
             # Add/update calculated field max_request_seconds
-            if 'request_seconds' in stats_obj:
+            if max_secs is None:
+                max_secs = stats_obj.get('request_seconds')
+            if max_secs is not None:
                 istats['max_request_seconds'] = max(
                     istats['max_request_seconds'],
-                    stats_obj['request_seconds']
+                    max_secs
                 )
 
 
@@ -343,55 +376,89 @@ class StatsSocketServer(socketserver.ThreadingTCPServer):
             db_sys_stats.to_time = dt_now
 
     def _flush_img_stats_bucket(self, db_session, dt_period_start, dt_now, stats):
-        inserts = []
-        model = ImageStats
-        for image_id, istats in stats.items():
-            rcount = istats['requests']
-            vcount = istats['views']
-            cvcount = istats['cached_views']
-            dcount = istats['downloads']
-            bytesum = istats['bytes']
-            rsecs = istats['request_seconds']
-            maxsecs = istats['max_request_seconds']
-
-            update_num = db_session.query(model).filter(
-                model.image_id == image_id
-            ).filter(
-                model.from_time > dt_period_start
-            ).update({
-                model.requests: model.requests + rcount,
-                model.views: model.views + vcount,
-                model.cached_views: model.cached_views + cvcount,
-                model.downloads: model.downloads + dcount,
-                model.total_bytes: model.total_bytes + bytesum,
-                model.request_seconds: model.request_seconds + rsecs,
-                model.max_request_seconds: func.greatest(model.max_request_seconds, maxsecs),
-                model.to_time: dt_now
-            }, synchronize_session=False)
-
-            if not update_num:
-                inserts.append({
-                    'image_id': image_id,
-                    'requests': rcount,
-                    'views': vcount,
-                    'cached_views': cvcount,
-                    'downloads': dcount,
-                    'total_bytes': bytesum,
-                    'request_seconds': rsecs,
-                    'max_request_seconds': maxsecs,
-                    'from_time': self.caches_started,
-                    'to_time': dt_now
-                })
+        """
+        Adds the image stats to the current stats record of each image, or
+        creates new stats records for images that do not have one yet, using a
+        fixed number of database operations regardless of the number of images.
+        """
+        if not stats:
+            return
+
+        # Bulk load the stats into a staging table, which is dropped on commit
+        db_session.execute(
+            'CREATE TEMPORARY TABLE imagestats_flush ('
+            'image_id BIGINT PRIMARY KEY, requests BIGINT, views BIGINT, '
+            'cached_views BIGINT, downloads BIGINT, total_bytes BIGINT, '
+            'request_seconds FLOAT, max_request_seconds FLOAT'
+            ') ON COMMIT DROP'
+        )
+        self._copy_img_stats(db_session, stats)
+
+        # Update the images that have a stats record in the current period
+        db_session.execute(
+            'UPDATE imagestats AS i SET '
+            'requests = i.requests + f.requests, '
+            'views = i.views + f.views, '
+            'cached_views = i.cached_views + f.cached_views, '
+            'downloads = i.downloads + f.downloads, '
+            'total_bytes = i.total_bytes + f.total_bytes, '
+            'request_seconds = i.request_seconds + f.request_seconds, '
+            'max_request_seconds = GREATEST(i.max_request_seconds, f.max_request_seconds), '
+            'to_time = :to_time '
+            'FROM imagestats_flush AS f '
+            'WHERE i.image_id = f.image_id AND i.from_time > :period_start',
+            {'to_time': dt_now, 'period_start': dt_period_start}
+        )
+        # Then insert stats records for the rest, skipping images that have been deleted
+        db_session.execute(
+            'INSERT INTO imagestats (image_id, requests, views, cached_views, '
+            'downloads, total_bytes, request_seconds, max_request_seconds, '
+            'from_time, to_time) '
+            'SELECT f.image_id, f.requests, f.views, f.cached_views, '
+            'f.downloads, f.total_bytes, f.request_seconds, f.max_request_seconds, '
+            ':from_time, :to_time '
+            'FROM imagestats_flush AS f JOIN images AS im ON im.id = f.image_id '
+            'WHERE NOT EXISTS ('
+            'SELECT 1 FROM imagestats AS i '
+            'WHERE i.image_id = f.image_id AND i.from_time > :period_start'
+            ')',
+            {'from_time': self.caches_started, 'to_time': dt_now,
+             'period_start': dt_period_start}
+        )
+        res = db_session.execute(
+            'SELECT f.image_id FROM imagestats_flush AS f '
+            'LEFT JOIN images AS im ON im.id = f.image_id '
+            'WHERE im.id IS NULL'
+        )
+        deleted_ids = [row[0] for row in res]
+        res.close()
         db_session.commit()
 
-        if inserts:
-            try:
-                db_session.execute(ImageStats.__table__.insert(), inserts)
-            except IntegrityError:
-                db_session.rollback()
-                inserts = self._fix_insert_list(inserts, db_session)
-                if inserts:
-                    db_session.execute(ImageStats.__table__.insert(), inserts)
+        if deleted_ids:
+            self._uncache_deleted_images(deleted_ids)
+
+    def _copy_img_stats(self, db_session, stats):
+        """
+        Copies image stats into the imagestats_flush staging table.
+        """
+        buf = io.StringIO()
+        for image_id, istats in stats.items():
+            buf.write('%d\t%d\t%d\t%d\t%d\t%d\t%r\t%r\n' % (
+                image_id,
+                istats['requests'],
+                istats['views'],
+                istats['cached_views'],
+                istats['downloads'],
+                istats['bytes'],
+                float(istats['request_seconds']),
+                float(istats['max_request_seconds'])
+            ))
+        buf.seek(0)
+        cursor = db_session.connection().connection.cursor()
+        try:
+            cursor.copy_from(buf, 'imagestats_flush')
+        finally:
+            cursor.close()
 
     def _flush(self):
         """
@@ -457,44 +524,25 @@ class StatsSocketServer(socketserver.ThreadingTCPServer):
                 (flush_delta.seconds * 1000) + (flush_delta.microseconds // 1000)
             ))
 
-    def _fix_insert_list(self, insert_list, db_session):
+    def _uncache_deleted_images(self, image_ids):
         """
         When an image is deleted (and the image data purged), it is possible
         for recent image views, or views of cached versions, to still be
-        recorded here. Attempting to insert a stats record for the deleted
-        image then causes a foreign key integrity error.
-
-        This function checks all image IDs in the provided data list for
-        existence, removes list entries for image IDs that no longer exist, and
-        returns the list.
+        recorded here. The stats for these image IDs are discarded, and
+        this function removes any left-over images from the cache too.
         """
-        self.logger.warning(
-            'Stats data includes deleted images, attempting to fix and retry'
-        )
-        ret_list = []
-        for stat_dict in insert_list:
-            image_id = stat_dict['image_id']
-            if (
-                self.database.get_image(
-                    image_id,
-                    _db_session=db_session) is None
-            ):
-                self.logger.warning(
-                    'Removing deleted image ID %d from stats' % image_id
-                )
-                # Remove left-over images from cache too
-                self.tasks.add_task(
-                    None,
-                    'Uncache deleted image',
-                    'uncache_image',
-                    {'image_id': image_id},
-                    Task.PRIORITY_NORMAL,
-                    None, 'error'
-                )
-            else:
-                ret_list.append(stat_dict)
-        self.logger.debug('Now retrying image stats write')
-        return ret_list
+        for image_id in image_ids:
+            self.logger.warning(
+                'Removing deleted image ID %d from stats' % image_id
+            )
+            self.tasks.add_task(
+                None,
+                'Uncache deleted image',
+                'uncache_image',
+                {'image_id': image_id},
+                Task.PRIORITY_NORMAL,
+                None, 'error'
+            )
 
     def _poll_hardware(self):
         """
@@ -68,7 +68,12 @@
 #   At runtime only require libmemcached and the lib folder
 #
 
+from collections import OrderedDict
+import hashlib
+import operator
+import os
 import pickle
+import tempfile
 import time
 import threading
 
@@ -97,6 +102,773 @@ MAX_SLOT_SIZE = (
 _GLOBAL_LOCK_KEY = 'CACHEMANAGER_UNIVERSAL_LOCK'
 _GLOBAL_LOCK_TIMEOUT = 3600
 
+# The nominal size to count for local cache objects that have no length
+LOCAL_NOMINAL_OBJECT_SIZE = 256
+
+# Cache control index modes
+INDEX_DATABASE = 'database'
+INDEX_MEMCACHED = 'memcached'
+
+_INDEX_KEY_PREFIX = 'CACHECTL:'
+_INDEX_REF_SUFFIX = '_ctl'
+_INDEX_MAX_ENTRIES = 250
+_INDEX_CAS_RETRIES = 10
+_INDEX_FLUSH_SIZE = 100
+_INDEX_OPERATORS = {
+    'eq': operator.eq, 'lt': operator.lt, 'gt': operator.gt,
+    'lte': operator.le, 'gte': operator.ge
+}
+
+
+class LocalCache(object):
+    """
+    Implements a size-limited, least-recently-used in-memory cache for use within
+    one Python process, with an internal lock to ensure thread safety. Entries
+    expire after max_age_secs so that changes made by other processes (which
+    cannot invalidate this cache) eventually become visible.
+
+    Objects larger than 1/8 of the cache size are not stored.
+    """
+    def __init__(self, max_bytes, max_age_secs):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._max_bytes = max_bytes
+        self._max_object_bytes = max_bytes // 8
+        self._max_age_secs = max_age_secs
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        """
+        Returns the cache entry for the given key,
+        or None if there is no such key or the entry has expired.
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._cache.move_to_end(key)
+                    self._hits += 1
+                    return entry[2]
+                self._remove(key)
+            self._misses += 1
+            return None
+
+    def put(self, key, obj):
+        """
+        Sets or replaces a cache entry, evicting the least recently
+        used entries as required to keep within the size limit.
+        """
+        size = self._size_of(obj)
+        with self._lock:
+            self._remove(key)
+            if size > self._max_object_bytes:
+                return
+            while self._cache and self._bytes + size > self._max_bytes:
+                self._remove(next(iter(self._cache)))
+                self._evictions += 1
+            self._cache[key] = (time.time() + self._max_age_secs, size, obj)
+            self._bytes += size
+
+    def delete(self, key):
+        """
+        Removes a cache entry. There is no effect if the key does not exist.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def delete_prefix(self, prefix, separator=None):
+        """
+        Removes all cache entries whose key begins with prefix. If a separator
+        is given, only the entries whose key equals prefix or begins with
+        prefix + separator are removed.
+        """
+        with self._lock:
+            if separator is None:
+                keys = [k for k in self._cache if k.startswith(prefix)]
+            else:
+                keys = [
+                    k for k in self._cache
+                    if k == prefix or k.startswith(prefix + separator)
+                ]
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        self._start_threads()
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns a dictionary of usage information for this cache:
+        { 'count': objects, 'size': bytes, 'capacity': bytes,
+          'hits': n, 'misses': n, 'evictions': n }
+        """
+        with self._lock:
+            return {
+                'count': len(self._cache),
+                'size': self._bytes,
+                'capacity': self._max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions
+            }
+
+    def _remove(self, key):
+        # The lock must be held by the caller
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _size_of(self, obj):
+        return (
+            len(obj) if isinstance(obj, (bytes, str))
+            else LOCAL_NOMINAL_OBJECT_SIZE
+        )
+
+
+class DiskCache(object):
+    """
+    Implements a size-limited, least-recently-used cache of binary objects
+    stored as files in a local directory, for use as a second tier behind
+    Memcached on fast local storage such as an SSD. Files are named by a hash
+    of their cache key, and are written to a temporary file that is then
+    renamed, so that a crash cannot leave a partially written file in place.
+
+    Files are written by a background thread, so that callers do not wait for
+    the disk. Up to _WRITE_QUEUE_BYTES of objects can wait to be written,
+    after which new objects are not stored. The index of files is rebuilt from
+    the directory in order of last use, by another background thread when the
+    cache is first used in each process. Until then, existing files are still
+    found, but are only added to the index when they are used.
+
+    Several processes can share the same directory, but each keeps its own
+    index, so the total size is only approximately limited to max_bytes.
+    Objects larger than 1/8 of the cache size are not stored.
+    """
+    _TEMP_PREFIX = '.tmp'
+    _TEMP_MAX_AGE = 3600  # Remove temporary files older than this on startup
+    _TOUCH_SECS = 3600    # Update the modification time of used files this often
+    _WRITE_QUEUE_BYTES = 64 * 1024 * 1024
+    _WRITE_WAIT_SECS = 5  # How long get_file() waits for a file that is being written
+
+    def __init__(self, cache_dir, max_bytes):
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._cache = OrderedDict()
+        self._dir = cache_dir
+        self._max_bytes = max_bytes
+        self._max_object_bytes = max_bytes // 8
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._writes = OrderedDict()
+        self._write_bytes = 0
+        self._write_event = threading.Event()
+        self._writing = None
+        self._write_cancelled = False
+        self._clears = 0
+        self._indexed = False
+        self._thread_lock = threading.Lock()
+        self._thread_pid = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_file(self, key):
+        """
+        Returns a tuple of (file path, file size) for the cache entry with the
+        given key, or None if there is no such key.
+        """
+        self._start_threads()
+        name = self._file_name(key)
+        path = self._file_path(name)
+        with self._lock:
+            # Give a file that is waiting to be written a chance to appear
+            self._written.wait_for(
+                lambda: name not in self._writes and self._writing != name,
+                DiskCache._WRITE_WAIT_SECS
+            )
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Never stored, or evicted by another process
+            with self._lock:
+                self._remove(name)
+                self._misses += 1
+            return None
+        with self._lock:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                evicted = []
+            else:
+                evicted = self._add(name, st.st_size, st.st_mtime)
+            self._hits += 1
+            touch = self._cache[name][1] < time.time() - DiskCache._TOUCH_SECS
+            if touch:
+                self._cache[name] = (st.st_size, time.time())
+        if touch:
+            # Record the use for when the index is next rebuilt
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        self._remove_files(evicted)
+        return (path, st.st_size)
+
+    def get(self, key):
+        """
+        Returns the binary object with the given key,
+        or None if there is no such key.
+        """
+        file_info = self.get_file(key)
+        if file_info is not None:
+            try:
+                with open(file_info[0], 'rb') as f:
+                    return f.read()
+            except OSError:
+                pass
+        return None
+
+    def put(self, key, obj):
+        """
+        Sets or replaces a cache entry, evicting the least recently used
+        entries as required to keep within the size limit, and queues the
+        object to be written to disk. Any existing entry is removed if the
+        object is not binary, is too large to store, or the write queue is full.
+        Returns a boolean indicating success.
+        """
+        if not isinstance(obj, bytes) or len(obj) > self._max_object_bytes:
+            self.delete(key)
+            return False
+        self._start_threads()
+        name = self._file_name(key)
+        with self._lock:
+            self._cancel_write(name)
+            queue_full = (
+                len(self._writes) > 0 and
+                self._write_bytes + len(obj) > DiskCache._WRITE_QUEUE_BYTES
+            )
+            if not queue_full:
+                evicted = self._add(name, len(obj), time.time())
+                self._writes[name] = obj
+                self._write_bytes += len(obj)
+        if queue_full:
+            self.delete(key)
+            return False
+        self._write_event.set()
+        self._remove_files(evicted)
+        return True
+
+    def delete(self, key):
+        """
+        Removes a cache entry. There is no effect if the key does not exist.
+        """
+        self._start_threads()
+        name = self._file_name(key)
+        with self._lock:
+            self._remove(name)
+            self._cancel_write(name)
+        self._remove_files([name])
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+            for name in list(self._writes):
+                self._cancel_write(name)
+            self._write_cancelled = self._writing is not None
+            self._clears += 1
+        for (_, name, _) in self._scan():
+            self._remove_files([name])
+
+    def is_empty(self):
+        """
+        Returns whether there are no cache files in the cache directory.
+        Unlike stats(), this does not wait for the index to be rebuilt.
+        """
+        with self._lock:
+            if self._writes or self._writing is not None:
+                return False
+        with os.scandir(self._dir) as subdirs:
+            for subdir in subdirs:
+                if subdir.is_dir():
+                    with os.scandir(subdir.path) as entries:
+                        for entry in entries:
+                            if (not entry.name.startswith(DiskCache._TEMP_PREFIX) and
+                                    entry.is_file()):
+                                return False
+        return True
+
+    def sync(self, timeout_secs=None):
+        """
+        Waits for the queued files to be written and for the index to be rebuilt,
+        returning whether both have completed within timeout_secs.
+        """
+        self._start_threads()
+        with self._lock:
+            return self._written.wait_for(
+                lambda: self._indexed and not self._writes and self._writing is None,
+                timeout_secs
+            )
+
+    def stats(self):
+        """
+        Returns a dictionary of usage information for this cache:
+        { 'count': objects, 'size': bytes, 'capacity': bytes,
+          'hits': n, 'misses': n, 'evictions': n }
+        The count and size are incomplete until the index has been rebuilt.
+        """
+        self._start_threads()
+        with self._lock:
+            return {
+                'count': len(self._cache),
+                'size': self._bytes,
+                'capacity': self._max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions
+            }
+
+    def _start_threads(self):
+        """
+        Starts the background file writer thread if it is not running, which
+        includes the case where this process has been forked, along with a
+        thread to rebuild the index if it has not been built.
+        """
+        pid = os.getpid()
+        if self._thread_pid != pid:
+            with self._thread_lock:
+                if self._thread_pid != pid:
+                    # Another thread might have held the lock during a fork.
+                    # Files queued before a fork are written by the parent process.
+                    self._lock = threading.Lock()
+                    self._written = threading.Condition(self._lock)
+                    self._write_event = threading.Event()
+                    self._writes.clear()
+                    self._write_bytes = 0
+                    self._writing = None
+                    threads = [(self._write_thread, 'DiskCacheWrite')]
+                    if not self._indexed:
+                        threads.append((self._rebuild, 'DiskCacheIndex'))
+                    for (target, name) in threads:
+                        thread = threading.Thread(target=target, name=name)
+                        thread.daemon = True
+                        thread.start()
+                    self._thread_pid = pid
+
+    def _write_thread(self):
+        while True:
+            self._write_event.wait()
+            self._write_event.clear()
+            while True:
+                with self._lock:
+                    if not self._writes:
+                        break
+                    (name, obj) = self._writes.popitem(last=False)
+                    self._write_bytes -= len(obj)
+                    self._writing = name
+                    self._write_cancelled = False
+                written = self._write_file(name, obj)
+                with self._lock:
+                    if not written and name not in self._writes:
+                        self._remove(name)
+                    remove = written and self._write_cancelled
+                    self._writing = None
+                    self._written.notify_all()
+                if remove:
+                    # Deleted while it was being written
+                    self._remove_files([name])
+
+    def _write_file(self, name, obj):
+        # Writes a cache file, returning a boolean indicating success
+        subdir = os.path.dirname(self._file_path(name))
+        try:
+            os.makedirs(subdir, exist_ok=True)
+            (fd, temp_path) = tempfile.mkstemp(prefix=DiskCache._TEMP_PREFIX, dir=subdir)
+        except OSError:
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(obj)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._file_path(name))
+            return True
+        except OSError:
+            self._remove_files([temp_path], False)
+            return False
+
+    def _rebuild(self):
+        # Re-creates the index from the files in the cache directory. Entries
+        # added to the index during the scan are more recent, so they come last.
+        with self._lock:
+            clears = self._clears
+        try:
+            entries = sorted(self._scan(remove_temp=True))
+        except OSError:
+            entries = []
+        evicted = []
+        with self._lock:
+            if self._clears == clears:
+                recent = self._cache
+                self._cache = OrderedDict()
+                self._bytes = 0
+                for (mtime, name, size) in entries:
+                    if name not in recent:
+                        evicted += self._add(name, size, mtime)
+                for (name, (size, mtime)) in recent.items():
+                    evicted += self._add(name, size, mtime)
+            self._indexed = True
+            self._written.notify_all()
+        self._remove_files(evicted)
+
+    def _scan(self, remove_temp=False):
+        # Returns a list of (modification time, name, size) for the cache files,
+        # optionally removing temporary files left behind by a crash
+        entries = []
+        min_temp_time = time.time() - DiskCache._TEMP_MAX_AGE
+        for subdir in os.scandir(self._dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith(DiskCache._TEMP_PREFIX):
+                    if remove_temp and st.st_mtime < min_temp_time:
+                        self._remove_files([entry.path], False)
+                elif entry.is_file():
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+        return entries
+
+    def _add(self, name, size, mtime):
+        # The lock must be held by the caller. Returns the names of entries
+        # that were evicted, for which the files should then be removed.
+        self._remove(name)
+        self._cache[name] = (size, mtime)
+        self._bytes += size
+        evicted = []
+        while self._bytes > self._max_bytes and len(self._cache) > 1:
+            old_name = next(iter(self._cache))
+            self._remove(old_name)
+            self._cancel_write(old_name)
+            evicted.append(old_name)
+            self._evictions += 1
+        return evicted
+
+    def _remove(self, name):
+        # The lock must be held by the caller
+        entry = self._cache.pop(name, None)
+        if entry is not None:
+            self._bytes -= entry[0]
+
+    def _cancel_write(self, name):
+        # The lock must be held by the caller. Stops a file from being written,
+        # or from being kept if it is being written now.
+        obj = self._writes.pop(name, None)
+        if obj is not None:
+            self._write_bytes -= len(obj)
+        if self._writing == name:
+            self._write_cancelled = True
+
+    def _remove_files(self, names, cache_names=True):
+        # Deletes files, given as entry names or as paths
+        for name in names:
+            try:
+                os.remove(self._file_path(name) if cache_names else name)
+            except OSError:
+                pass
+
+    def _file_name(self, key):
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _file_path(self, name):
+        return os.path.join(self._dir, name[:2], name)
+
+
+class FrequencySketch(object):
+    """
+    Implements a count-min sketch that estimates how often each key has been
+    seen recently, in a fixed amount of memory (depth * width bytes) and with
+    an internal lock to ensure thread safety. Counts are capped at MAX_COUNT,
+    and all counts are halved after every width * 10 increments so that the
+    estimates follow changes in popularity. An estimate can be too high, when
+    keys share counters, but is otherwise never too low.
+    """
+    MAX_COUNT = 15
+    _DEPTH = 4
+    _HALVE_TABLE = bytes(n >> 1 for n in range(256))
+
+    def __init__(self, width=65536):
+        width = 1 << max(0, width - 1).bit_length()  # Round up to a power of 2
+        self._lock = threading.Lock()
+        self._rows = [bytearray(width) for _ in range(FrequencySketch._DEPTH)]
+        self._mask = width - 1
+        self._sample_size = width * 10
+        self._additions = 0
+
+    def increment(self, key):
+        """
+        Records one occurrence of the given key.
+        """
+        indexes = self._indexes(key)
+        with self._lock:
+            added = False
+            for (row, idx) in zip(self._rows, indexes):
+                if row[idx] < FrequencySketch.MAX_COUNT:
+                    row[idx] += 1
+                    added = True
+            if added:
+                self._additions += 1
+                if self._additions >= self._sample_size:
+                    self._age()
+
+    def frequency(self, key):
+        """
+        Returns the estimated number of recent occurrences of the given key.
+        """
+        indexes = self._indexes(key)
+        with self._lock:
+            return min(row[idx] for (row, idx) in zip(self._rows, indexes))
+
+    def _age(self):
+        # The lock must be held by the caller
+        for row in self._rows:
+            row[:] = row.translate(FrequencySketch._HALVE_TABLE)
+        self._additions //= 2
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(
+            key.encode('utf8'), digest_size=FrequencySketch._DEPTH * 4
+        ).digest()
+        return [
+            int.from_bytes(digest[n * 4:(n + 1) * 4], 'little') & self._mask
+            for n in range(FrequencySketch._DEPTH)
+        ]
+
+
+class CacheIndex(object):
+    """
+    Maintains the cache control entries in Memcached, so that the cache control
+    database does not have to be written to for every put() and queried for
+    every search() of the CacheManager.
+
+    Entries are grouped by their searchfield1 value, with one index object per
+    value that is updated atomically using check-and-set. Searches that specify
+    searchfield1 are answered from the index, with the database only being
+    queried if the index object has been evicted, or has grown too large.
+
+    Writes to the cache control database are still made, but they are queued
+    and applied in batches by a background thread every flush_secs seconds
+    (or sooner if the queue becomes large), so that the database remains a
+    complete record of the cache (albeit a slightly delayed one) from which
+    an index object can be re-built.
+
+    As with the database, the index is advisory only: entries may refer to
+    objects that have since expired, and an entry may be missing from the
+    index for a short time after an index object has been re-built.
+    """
+    def __init__(self, manager, flush_secs):
+        self._manager = manager
+        self._flush_secs = flush_secs
+        self._pending = OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._thread_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = 0
+
+    def put(self, entry, metadata):
+        """
+        Adds or replaces the index entry for a CacheEntry object,
+        and queues the entry to be written to the cache control database.
+        """
+        if entry.searchfield1 is not None:
+            entry_dict = {
+                'key': entry.key,
+                'valuesize': entry.valuesize,
+                'searchfield1': entry.searchfield1,
+                'searchfield2': entry.searchfield2,
+                'searchfield3': entry.searchfield3,
+                'searchfield4': entry.searchfield4,
+                'searchfield5': entry.searchfield5,
+                'metadata': metadata
+            }
+
+            def add_entry(entries):
+                entries[entry.key] = entry_dict
+
+            self._update(entry.searchfield1, add_entry)
+        self._queue(entry.key, entry)
+
+    def delete(self, key, searchfield1):
+        """
+        Removes the index entry for a cache key (if searchfield1 is not None),
+        and queues the entry to be deleted from the cache control database.
+        """
+        if searchfield1 is not None:
+            self._update(searchfield1, lambda entries: entries.pop(key, None))
+        self._queue(key, None)
+
+    def search(self, searchfield1, order, max_rows, searchfields):
+        """
+        Returns a list of index entries having the given searchfield1 value that
+        also match the searchfields criteria, as for CacheManager.search(),
+        or None if the index cannot be used and the database must be searched.
+        """
+        client = self._manager.client()
+        index_key = self._index_key(searchfield1)
+        try:
+            index, cas_id = client.gets(index_key)
+        except pylibmc.Error:
+            return None
+        if index is None or not index['complete']:
+            # Re-build the index from the database
+            self.flush()
+            rows = self._manager._db_search(
+                None, _INDEX_MAX_ENTRIES + 1, {'searchfield1__eq': searchfield1}
+            )
+            if len(rows) > _INDEX_MAX_ENTRIES:
+                return None
+            entries = dict((row['key'], row) for row in rows)
+            if index is not None:
+                # Entries added since the index was lost are newer than the database
+                entries.update(index['entries'])
+            new_index = {'complete': True, 'entries': entries}
+            try:
+                if index is None:
+                    client.add(index_key, new_index)
+                else:
+                    client.cas(index_key, new_index, cas_id)
+            except pylibmc.Error:
+                pass
+            index = new_index
+        results = [e for e in index['entries'].values() if self._matches(e, searchfields)]
+        if order == '+size':
+            results.sort(key=lambda e: e['valuesize'])
+        elif order == '-size':
+            results.sort(key=lambda e: e['valuesize'], reverse=True)
+        return results[:max_rows]
+
+    def flush(self):
+        """
+        Writes all queued entries to the cache control database.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, OrderedDict()
+            if pending:
+                self._manager._db_write_entries(pending)
+
+    def discard(self):
+        """
+        Discards all queued entries without writing them to the database.
+        """
+        with self._pending_lock:
+            self._pending.clear()
+
+    def _queue(self, key, entry):
+        """
+        Queues a CacheEntry to be written to the database for a key,
+        or queues the key for deletion if entry is None.
+        """
+        with self._pending_lock:
+            self._pending.pop(key, None)
+            self._pending[key] = entry
+            queue_size = len(self._pending)
+        self._start_flush_thread()
+        if queue_size >= _INDEX_FLUSH_SIZE:
+            self._flush_event.set()
+
+    def _start_flush_thread(self):
+        """
+        Starts the background database writer thread if it is not running,
+        which includes the case where this process has been forked.
+        """
+        pid = os.getpid()
+        if self._thread_pid != pid:
+            with self._thread_lock:
+                if self._thread_pid != pid:
+                    self._thread = threading.Thread(
+                        target=self._flush_thread,
+                        name='CacheIndexFlush'
+                    )
+                    self._thread.daemon = True
+                    self._thread.start()
+                    self._thread_pid = pid
+
+    def _flush_thread(self):
+        while True:
+            self._flush_event.wait(self._flush_secs)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self._manager._logger.error(
+                    'Failed to write cache control entries: ' + type(e).__name__ + ' ' + str(e)
+                )
+
+    def _update(self, searchfield1, update_fn):
+        """
+        Applies update_fn to the entries dictionary of an index object, retrying
+        if another client modifies the index object at the same time. If the
+        index object does not exist, a partial one is created that will be
+        completed from the database when next searched.
+        """
+        client = self._manager.client()
+        index_key = self._index_key(searchfield1)
+        try:
+            for _ in range(_INDEX_CAS_RETRIES):
+                index, cas_id = client.gets(index_key)
+                if index is None:
+                    index = {'complete': False, 'entries': {}}
+                    update_fn(index['entries'])
+                    if not index['entries'] or client.add(index_key, index):
+                        return
+                else:
+                    update_fn(index['entries'])
+                    if len(index['entries']) > _INDEX_MAX_ENTRIES:
+                        break
+                    if client.cas(index_key, index, cas_id):
+                        return
+            # Too large or too busy. Searches will use the database until it is re-built.
+            client.delete(index_key)
+        except pylibmc.Error:
+            pass
+
+    def _index_key(self, searchfield1):
+        return self._manager._prepare_cache_key(_INDEX_KEY_PREFIX + str(searchfield1))
+
+    def _matches(self, entry, searchfields):
+        """
+        Returns whether an index entry matches the search criteria,
+        following the same rules as the database query in CacheManager.search().
+        """
+        for (field_op, value) in searchfields.items():
+            field, opcode = tuple(field_op.split('__'))
+            field_value = entry[field]
+            op = _INDEX_OPERATORS[opcode]
+            values = value if isinstance(value, list) else [value]
+            if not any(
+                (field_value is None) if v is None else
+                (field_value is not None and op(field_value, v))
+                for v in values
+            ):
+                return False
+        return True
+
 
 class CacheManager(object):
     """
@@ -108,8 +880,30 @@ class CacheManager(object):
 
     The raw_get/raw_put function family provide direct access to Memcached,
     bypassing the cache control database.
+
+    If local_cache_size is greater than 0, a per-process LocalCache of that
+    many bytes is kept in front of Memcached for the get/put function family
+    (and optionally for raw_get/raw_put), so that frequently requested objects
+    do not require a network round trip. Local cache entries are retained for
+    at most local_cache_expiry seconds, because changes made by other processes
+    cannot be seen until then.
+
+    If index_mode is INDEX_MEMCACHED, the cache control entries are also kept
+    in Memcached by a CacheIndex, and writes to the cache control database are
+    made in batches every index_flush_secs seconds by a background thread.
+    In the default INDEX_DATABASE mode, every put() and search() uses the
+    cache control database directly.
+
+    If disk_cache_dir and disk_cache_size are set, binary objects stored with
+    put() are also written to a DiskCache of that many bytes, from which they
+    can still be returned after they have been evicted from Memcached (or
+    after Memcached has been restarted), and which can also hold objects too
+    large to store in Memcached.
     """
-    def __init__(self, logger, server_list, db_uri, db_pool_size):
+    def __init__(self, logger, server_list, db_uri, db_pool_size,
+                 local_cache_size=0, local_cache_expiry=60,
+                 index_mode=INDEX_DATABASE, index_flush_secs=5,
+                 disk_cache_dir='', disk_cache_size=0):
         try:
             self._server_list = server_list
             self._db_uri = db_uri
@@ -118,6 +912,20 @@ class CacheManager(object):
             self._db = None
             self._logger = logger
             self._locals = threading.local()
+            self._local_cache = (
+                LocalCache(local_cache_size, local_cache_expiry)
+                if local_cache_size > 0 else None
+            )
+            if index_mode not in (INDEX_DATABASE, INDEX_MEMCACHED):
+                raise ValueError('Invalid cache control index mode: ' + str(index_mode))
+            self._index = (
+                CacheIndex(self, index_flush_secs)
+                if index_mode == INDEX_MEMCACHED else None
+            )
+            self._disk_cache = (
+                DiskCache(disk_cache_dir, disk_cache_size)
+                if disk_cache_dir and disk_cache_size > 0 else None
+            )
 
             self._init_cache()
             self._open_db()
@@ -155,6 +963,10 @@ class CacheManager(object):
         Closes connections and releases resources held by this object.
         """
         self._capacity = 0
+        if self._local_cache is not None:
+            self._local_cache.clear()
+        if self._index is not None:
+            self._index.flush()
         self.client().disconnect_all()
         self._db.dispose()
 
@@ -211,6 +1023,30 @@ class CacheManager(object):
         cache - they may have timed out or been purged. To find out, you must call
         get() to try and load the object.
         """
+        if self._index is not None:
+            sf1_values = searchfields.get('searchfield1__eq')
+            if sf1_values is not None:
+                if not isinstance(sf1_values, list):
+                    sf1_values = [sf1_values]
+                results = []
+                for sf1_value in sf1_values:
+                    sf1_results = self._index.search(sf1_value, order, max_rows, searchfields)
+                    if sf1_results is None:
+                        results = None
+                        break
+                    results.extend(sf1_results)
+                if results is not None:
+                    if len(sf1_values) > 1 and order in ('+size', '-size'):
+                        results.sort(key=lambda e: e['valuesize'], reverse=(order == '-size'))
+                    return results[:max_rows]
+            # Bring the database up to date before querying it
+            self._index.flush()
+        return self._db_search(order, max_rows, searchfields)
+
+    def _db_search(self, order, max_rows, searchfields):
+        """
+        Performs search() using the cache control database.
+        """
         sql_operators = {'eq': '=', 'lt': '<', 'gt': '>', 'lte': '<=', 'gte': '>='}
         sql_field_ops = sorted(list(searchfields.keys()))
         # Create a blank query to build upon
@@ -275,20 +1111,25 @@ class CacheManager(object):
         object storage as necessary. None is returned if the requested object
         no longer exists in cache.
         """
+        if self._local_cache is not None:
+            obj = self._local_cache.get(key)
+            if obj is not None:
+                return obj
         # Get first chunk from cache, and see if there are any others.
         # If there are we'll need to hit the cache a second time, but this method
         # avoids the need for any database lookups.
         chunk = self.raw_get(key+'_1')
         if chunk is not None:
+            obj = None
             is_bytes = isinstance(chunk, bytes)
             blank = b'' if is_bytes else ''
             num_slots = self._get_slot_header_value(chunk[0:SLOT_HEADER_SIZE])
             if num_slots <= 0:
                 # Looks like an unmanaged object (no header).
-                return chunk
+                obj = chunk
             elif num_slots == 1:
                 # This is the one and only chunk. Return it sans header.
-                return chunk[SLOT_HEADER_SIZE:]
+                obj = chunk[SLOT_HEADER_SIZE:]
             else:
                 # Read the other chunks. Some or all may have been expired/purged.
                 chunk_keys = [key+'_'+str(num) for num in range(2, num_slots + 1)]
@@ -297,13 +1138,157 @@ class CacheManager(object):
                 if len(chunks) == len(chunk_keys):
                     # Return correctly ordered, re-constituted object
                     chunk1 = chunk[SLOT_HEADER_SIZE:]
-                    return chunk1 + blank.join(chunks[k] for k in chunk_keys)
+                    obj = chunk1 + blank.join(chunks[k] for k in chunk_keys)
+            if obj is not None:
+                if self._local_cache is not None:
+                    self._local_cache.put(key, obj)
+                return obj
         # If we get here it's a plain cache miss or one or more chunks are missing.
-        # For the former, just ensure the control record (if any) is deleted too.
-        # For the latter, also delete any orphaned chunks that may still exist.
+        if self._disk_cache is not None:
+            obj = self._disk_cache.get(key)
+            if obj is not None:
+                if chunk is not None:
+                    self._delete_chunks(key)
+                if self._local_cache is not None:
+                    self._local_cache.put(key, obj)
+                return obj
+        # Otherwise for a plain miss, just ensure the control record (if any) is
+        # deleted too. For missing chunks, also delete any orphaned chunks that
+        # may still exist.
         self.delete(key, _db_only=(chunk is None))
         return None
 
+    def getn(self, keys):
+        """
+        As for get() but takes a list of keys, returning a dictionary of the keys
+        and objects that were found in the cache. Keys that were not found are
+        not returned. Objects stored in a single chunk are all fetched in one
+        call to the cache, with any larger objects then fetched separately.
+        """
+        results = {}
+        if self._local_cache is not None:
+            for key in keys:
+                obj = self._local_cache.get(key)
+                if obj is not None:
+                    results[key] = obj
+        remote_keys = [k for k in keys if k not in results]
+        if remote_keys:
+            chunks = self.raw_getn([k + '_1' for k in remote_keys])
+            for key in remote_keys:
+                chunk = chunks.get(self._prepare_cache_key(key + '_1'))
+                if chunk is None:
+                    continue
+                num_slots = self._get_slot_header_value(chunk[0:SLOT_HEADER_SIZE])
+                if num_slots <= 1:
+                    obj = chunk if num_slots <= 0 else chunk[SLOT_HEADER_SIZE:]
+                    if self._local_cache is not None:
+                        self._local_cache.put(key, obj)
+                else:
+                    obj = self.get(key)
+                if obj is not None:
+                    results[key] = obj
+            if self._disk_cache is not None:
+                for key in remote_keys:
+                    if key not in results:
+                        obj = self._disk_cache.get(key)
+                        if obj is not None:
+                            results[key] = obj
+                            if self._local_cache is not None:
+                                self._local_cache.put(key, obj)
+        return results
+
+    def get_fused(self, key, meta_key, extra_keys=None):
+        """
+        Retrieves a managed object as for get(), together with its metadata
+        object and any other raw objects, in a single call to the cache where
+        possible.
+
+        The metadata object should be stored with raw_put() and local_cache set
+        to True. If it is a dictionary with a 'size' entry giving the length of
+        the managed object, all the object's chunks are requested up front, so
+        that a large object can also be returned in one call to the cache.
+        Otherwise only the first chunk is requested with the other keys, and any
+        remaining chunks are fetched separately.
+
+        Returns a tuple of (object, metadata, extras), where object and metadata
+        are None if not found, and extras is a dictionary of the extra_keys and
+        objects that were found in the cache. If the object is found in the
+        local cache, no call is made to the cache and extras will be empty.
+        The disk cache is not checked, for which use get_file() after a miss.
+        """
+        extra_keys = extra_keys or []
+        meta = None
+        if self._local_cache is not None:
+            meta = self._local_cache.get(meta_key)
+            obj = self._local_cache.get(key)
+            if obj is not None:
+                return obj, meta, {}
+
+        # Request as many chunks as the metadata tells us the object will need
+        num_slots = 1
+        if isinstance(meta, dict) and meta.get('size'):
+            num_slots = min(self._slots_for_size(meta['size']), MAX_OBJECT_SLOTS)
+        chunk_keys = [key+'_'+str(num) for num in range(1, num_slots + 1)]
+        fetch_keys = chunk_keys + extra_keys
+        if meta is None:
+            fetch_keys.append(meta_key)
+        values = self.raw_getn(fetch_keys)
+
+        if meta is None:
+            meta = values.get(self._prepare_cache_key(meta_key))
+            if meta is not None and self._local_cache is not None:
+                self._local_cache.put(meta_key, meta)
+        extras = {}
+        for k in extra_keys:
+            val = values.get(self._prepare_cache_key(k))
+            if val is not None:
+                extras[k] = val
+
+        obj = None
+        chunk = values.get(self._prepare_cache_key(chunk_keys[0]))
+        if chunk is not None:
+            num_slots = self._get_slot_header_value(chunk[0:SLOT_HEADER_SIZE])
+            if num_slots <= 0:
+                # Looks like an unmanaged object (no header).
+                obj = chunk
+            elif num_slots == 1:
+                obj = chunk[SLOT_HEADER_SIZE:]
+            else:
+                # Fetch any chunks we did not already request (the metadata
+                # may be missing, or out of date if the object was replaced)
+                chunk_keys = [key+'_'+str(num) for num in range(2, num_slots + 1)]
+                fetched_keys = set(self._prepare_cache_keys(fetch_keys))
+                missing_keys = [
+                    k for k in chunk_keys if self._prepare_cache_key(k) not in fetched_keys
+                ]
+                if missing_keys:
+                    values.update(self.raw_getn(missing_keys))
+                chunks = [values.get(self._prepare_cache_key(k)) for k in chunk_keys]
+                if None not in chunks:
+                    blank = b'' if isinstance(chunk, bytes) else ''
+                    obj = chunk[SLOT_HEADER_SIZE:] + blank.join(chunks)
+        if obj is not None:
+            if self._local_cache is not None:
+                self._local_cache.put(key, obj)
+        elif self._disk_cache is not None and self._disk_cache.get_file(key) is not None:
+            # The object can still be returned from disk
+            if chunk is not None:
+                self._delete_chunks(key)
+        else:
+            # As for get(), clean up the control record and any orphaned chunks
+            self.delete(key, _db_only=(chunk is None))
+        return obj, meta, extras
+
+    def get_file(self, key):
+        """
+        Returns a tuple of (file path, file size) for a managed object that is
+        held in the disk cache, so that it can be sent to a client without
+        first being read into memory, or None if the disk cache is disabled or
+        does not contain the object. The file may later be removed by eviction,
+        but remains readable while it is open.
+        """
+        return self._disk_cache.get_file(key) if self._disk_cache is not None else None
+
     def put(self, key, obj, expiry_secs=0, search_info=None):
         """
         Adds or replaces a managed object in cache, with an optional expiry time
@@ -323,7 +1308,13 @@ class CacheManager(object):
         chunks = {}
         num_slots = self._slots_for_size(len(obj))
         if num_slots > MAX_OBJECT_SLOTS:
-            return False
+            # Too large for Memcached, but may fit in the disk cache
+            if (self._disk_cache is None or expiry_secs or
+                not self._disk_cache.put(key, obj)):
+                return False
+            self._delete_chunks(key)
+            self._put_entry(key, len(obj), expiry_secs, search_info)
+            return True
         is_bytes = isinstance(obj, bytes)
         blank = b'' if is_bytes else ''
         for slot in range(1, num_slots + 1):
@@ -333,46 +1324,7 @@ class CacheManager(object):
             chunks[key+'_'+str(slot)] = slot_header + obj[from_offset:to_offset]
         # Add chunks to cache
         if self.raw_putn(chunks, expiry_secs):
-            # Chunks added. Prepare control db entry.
-            entry = CacheEntry(key, len(obj))
-            if search_info is not None:
-                entry.searchfield1 = search_info['searchfield1']
-                entry.searchfield2 = search_info['searchfield2']
-                entry.searchfield3 = search_info['searchfield3']
-                entry.searchfield4 = search_info['searchfield4']
-                entry.searchfield5 = search_info['searchfield5']
-                if search_info['metadata'] is not None:
-                    entry.extradata = pickle.dumps(
-                        search_info['metadata'],
-                        protocol=pickle.HIGHEST_PROTOCOL
-                    )
-            # Add/update entry in the control db
-            db_session = self._db.Session()
-            db_committed = False
-            try:
-                db_session.merge(entry)
-                db_session.commit()
-                db_committed = True
-            except IntegrityError:
-                # Rarely, 2 threads merging (adding) the same key causes a duplicate key error
-                db_session.rollback()
-                db_session.query(CacheEntry).filter(CacheEntry.key==entry.key).update({
-                    'valuesize': entry.valuesize,
-                    'searchfield1': entry.searchfield1,
-                    'searchfield2': entry.searchfield2,
-                    'searchfield3': entry.searchfield3,
-                    'searchfield4': entry.searchfield4,
-                    'searchfield5': entry.searchfield5,
-                    'extradata': entry.extradata
-                }, synchronize_session=False)
-                db_session.commit()
-                db_committed = True
-            finally:
-                try:
-                    if not db_committed:
-                        db_session.rollback()
-                finally:
-                    db_session.close()
+            self._put_added(key, obj, expiry_secs, search_info)
             return True
         else:
             # Delete everything for key (if there was a previous object for this
@@ -380,17 +1332,98 @@ class CacheManager(object):
             self.delete(key)
             return False
 
+    def putn(self, mapping, expiry_secs=0, search_infos=None):
+        """
+        As for put() but taking a dictionary of keys and objects, and optionally
+        a dictionary of keys and search_info dictionaries. Objects that fit into
+        one cache slot are all added in a single call to the cache, with any
+        larger objects then added separately.
+
+        Returns a boolean indicating whether all the objects were added.
+        """
+        search_infos = search_infos or {}
+        chunks = {}
+        ok = True
+        for (key, obj) in mapping.items():
+            if self._slots_for_size(len(obj)) == 1:
+                slot_header = self._get_slot_header(1, isinstance(obj, bytes))
+                chunks[key + '_1'] = slot_header + obj
+            else:
+                ok = self.put(key, obj, expiry_secs, search_infos.get(key)) and ok
+        if chunks:
+            single_keys = [chunk_key[:-2] for chunk_key in chunks]
+            if self.raw_putn(chunks, expiry_secs):
+                for key in single_keys:
+                    self._put_added(key, mapping[key], expiry_secs, search_infos.get(key))
+            else:
+                # As for put(), do not leave old and new objects mixed up
+                for key in single_keys:
+                    self.delete(key)
+                ok = False
+        return ok
+
+    def _put_added(self, key, obj, expiry_secs, search_info):
+        """
+        Updates the local and disk caches and the cache control entry for an
+        object that has just been added to the cache by put() or putn().
+        """
+        if self._local_cache is not None:
+            if not expiry_secs:
+                self._local_cache.put(key, obj)
+            else:
+                self._local_cache.delete(key)
+        if self._disk_cache is not None:
+            if not expiry_secs:
+                self._disk_cache.put(key, obj)
+            else:
+                self._disk_cache.delete(key)
+        # Chunks added. Add the control db entry.
+        self._put_entry(key, len(obj), expiry_secs, search_info)
+
+    def _put_entry(self, key, size, expiry_secs, search_info):
+        """
+        Adds or updates the cache control entry for an object added by put().
+        """
+        entry = CacheEntry(key, size)
+        if search_info is not None:
+            entry.searchfield1 = search_info['searchfield1']
+            entry.searchfield2 = search_info['searchfield2']
+            entry.searchfield3 = search_info['searchfield3']
+            entry.searchfield4 = search_info['searchfield4']
+            entry.searchfield5 = search_info['searchfield5']
+            if search_info['metadata'] is not None:
+                entry.extradata = pickle.dumps(
+                    search_info['metadata'],
+                    protocol=pickle.HIGHEST_PROTOCOL
+                )
+        # Add/update entry in the control index or db
+        if self._index is not None:
+            if entry.searchfield1 is not None:
+                self.raw_put(key + _INDEX_REF_SUFFIX, entry.searchfield1, expiry_secs)
+            self._index.put(entry, search_info['metadata'] if search_info else None)
+        else:
+            self._db_put_entry(entry)
+
     def delete(self, key, _db_only=False):
         """
         Removes a managed object from cache.
         """
+        if self._local_cache is not None:
+            self._local_cache.delete(key)
+        if self._disk_cache is not None:
+            self._disk_cache.delete(key)
+        if not _db_only:
+            self._delete_chunks(key)
+        if self._index is not None:
+            # Delete from the control index, the db delete is queued
+            index_ref = self.raw_get(key + _INDEX_REF_SUFFIX)
+            if index_ref is not None:
+                self.raw_delete(key + _INDEX_REF_SUFFIX)
+            self._index.delete(key, index_ref)
+            return True
         db_session = self._db.Session()
         db_commit = False
         try:
-            if not _db_only:
-                # Delete all possible chunks
-                chunk_keys = [key+'_'+str(num) for num in range(1, MAX_OBJECT_SLOTS + 1)]
-                self.raw_deleten(chunk_keys)
             # Delete from the control db
             db_session.query(CacheEntry).filter(CacheEntry.key==key).delete()
             db_commit = True
@@ -404,6 +1437,81 @@ class CacheManager(object):
                 db_session.close()
         return True
 
+    def _delete_chunks(self, key):
+        """
+        Deletes all possible chunks of a managed object from Memcached.
+        """
+        chunk_keys = [key+'_'+str(num) for num in range(1, MAX_OBJECT_SLOTS + 1)]
+        self.raw_deleten(chunk_keys)
+
+    def _db_put_entry(self, entry):
+        """
+        Adds or updates a CacheEntry in the cache control database.
+        """
+        db_session = self._db.Session()
+        db_committed = False
+        try:
+            db_session.merge(entry)
+            db_session.commit()
+            db_committed = True
+        except IntegrityError:
+            # Rarely, 2 threads merging (adding) the same key causes a duplicate key error
+            db_session.rollback()
+            db_session.query(CacheEntry).filter(CacheEntry.key==entry.key).update({
+                'valuesize': entry.valuesize,
+                'searchfield1': entry.searchfield1,
+                'searchfield2': entry.searchfield2,
+                'searchfield3': entry.searchfield3,
+                'searchfield4': entry.searchfield4,
+                'searchfield5': entry.searchfield5,
+                'extradata': entry.extradata
+            }, synchronize_session=False)
+            db_session.commit()
+            db_committed = True
+        finally:
+            try:
+                if not db_committed:
+                    db_session.rollback()
+            finally:
+                db_session.close()
+
+    def _db_write_entries(self, entries):
+        """
+        Applies a batch of changes to the cache control database in one
+        transaction, where entries is a dictionary of cache keys to CacheEntry
+        objects to add or update, or to None for keys that should be deleted.
+        """
+        delete_keys = [k for (k, e) in entries.items() if e is None]
+        put_entries = [e for e in entries.values() if e is not None]
+        db_session = self._db.Session()
+        db_committed = False
+        try:
+            if delete_keys:
+                db_session.query(CacheEntry).filter(
+                    CacheEntry.key.in_(delete_keys)
+                ).delete(synchronize_session=False)
+            for entry in put_entries:
+                db_session.merge(entry)
+            db_session.commit()
+            db_committed = True
+        except IntegrityError:
+            # Another process added one of the keys, fall back to one at a time
+            db_session.rollback()
+            if delete_keys:
+                db_session.query(CacheEntry).filter(
+                    CacheEntry.key.in_(delete_keys)
+                ).delete(synchronize_session=False)
+                db_session.commit()
+            for entry in put_entries:
+                self._db_put_entry(entry)
+            db_committed = True
+        finally:
+            try:
+                if not db_committed:
+                    db_session.rollback()
+            finally:
+                db_session.close()
+
     def count(self):
         """
         Returns the total number of objects currently in the cache,
@@ -475,6 +1583,12 @@ class CacheManager(object):
         """
         Deletes all items from the cache.
         """
+        if self._local_cache is not None:
+            self._local_cache.clear()
+        if self._disk_cache is not None:
+            self._disk_cache.clear()
+        if self._index is not None:
+            self._index.discard()
         db_session = self._db.Session()
         try:
             db_session.query(CacheEntry).delete()
@@ -484,16 +1598,26 @@ class CacheManager(object):
         self.client().flush_all()
         return True
 
-    def raw_get(self, key):
+    def raw_get(self, key, local_cache=False):
         """
         Returns the binary object with the given key from cache,
         or None if the key does not exist in the cache.
+        If local_cache is True, the object is first looked for in (and is then
+        added to) the local cache, if enabled. Only use this for objects that
+        are also stored with local_cache set to True.
         This method bypasses the cache control database.
         """
+        use_local = local_cache and self._local_cache is not None
+        if use_local:
+            obj = self._local_cache.get(key)
+            if obj is not None:
+                return obj
         try:
             obj = self.client().get(self._prepare_cache_key(key))
         except pylibmc.Error:
             obj = None
+        if use_local and obj is not None:
+            self._local_cache.put(key, obj)
         return obj
 
     def raw_getn(self, keys):
@@ -526,13 +1650,59 @@ class CacheManager(object):
         except pylibmc.Error:
             return False
 
-    def raw_put(self, key, obj, expiry_secs=0):
+    def raw_atomic_addn(self, mapping, expiry_secs=0):
+        """
+        As for raw_atomic_add() but taking a dictionary of the format
+        { 'key1':'value1', 'key2':'value2' }
+        Returns a list of the keys whose objects were added, i.e. those that
+        did not already exist.
+        This method bypasses the cache control database.
+        """
+        prepared = dict((self._prepare_cache_key(k), k) for k in mapping)
+        try:
+            failed_keys = set(self.client().add_multi(
+                dict((pk, mapping[k]) for (pk, k) in prepared.items()),
+                expiry_secs
+            ))
+            return [k for (pk, k) in prepared.items() if pk not in failed_keys]
+        except pylibmc.Error:
+            return []
+
+    def raw_incr(self, key, initial_value=1):
+        """
+        Atomically increments the integer object with the given key, and returns
+        its new value. If the key does not exist, it is added (also atomically)
+        with the value initial_value, which is then returned.
+        Returns None if the operation failed.
+        This method bypasses the cache control database.
+        """
+        try:
+            client = self.client()
+            key = self._prepare_cache_key(key)
+            for _ in range(2):
+                try:
+                    return client.incr(key)
+                except pylibmc.NotFound:
+                    if client.add(key, initial_value):
+                        return initial_value
+            return None
+        except pylibmc.Error:
+            return None
+
+    def raw_put(self, key, obj, expiry_secs=0, local_cache=False):
         """
         Adds or replaces an object in cache, with an optional expiry time in seconds.
         The pickled object size cannot be greater than MAX_SLOT_SIZE.
+        If local_cache is True and there is no expiry time, the object is also
+        added to the local cache, if enabled.
         Returns a boolean indicating success.
         This method bypasses the cache control database.
         """
+        if self._local_cache is not None:
+            if local_cache and not expiry_secs:
+                self._local_cache.put(key, obj)
+            else:
+                self._local_cache.delete(key)
         try:
             return self.client().set(self._prepare_cache_key(key), obj, expiry_secs)
         except pylibmc.Error:
@@ -556,6 +1726,8 @@ class CacheManager(object):
         Deletes the object with the specified key from the cache.
         This method bypasses the cache control database.
         """
+        if self._local_cache is not None:
+            self._local_cache.delete(key)
         try:
             self.client().delete(self._prepare_cache_key(key))
             return True
@@ -573,6 +1745,31 @@ class CacheManager(object):
         except pylibmc.Error:
             return False
 
+    def local_delete_prefix(self, prefix, separator=None):
+        """
+        Removes all objects from the local cache (only) whose key begins with
+        prefix, as described for LocalCache.delete_prefix().
+        There is no effect if the local cache is disabled.
+        """
+        if self._local_cache is not None:
+            self._local_cache.delete_prefix(prefix, separator)
+
+    def local_stats(self):
+        """
+        Returns a dictionary of usage information and hit/miss counters for
+        the local cache in this process, as described for LocalCache.stats(),
+        or None if the local cache is disabled.
+        """
+        return self._local_cache.stats() if self._local_cache is not None else None
+
+    def disk_stats(self):
+        """
+        Returns a dictionary of usage information and hit/miss counters for
+        the disk cache as seen by this process, as described for
+        DiskCache.stats(), or None if the disk cache is disabled.
+        """
+        return self._disk_cache.stats() if self._disk_cache is not None else None
+
     def get_global_lock(self, wait_timeout=0):
         """
         Obtains a universal lock across all processes and threads, so that the
@@ -673,16 +1870,20 @@ class CacheManager(object):
         Returns a new client connection to the cache.
         Under pylibmc, this object is NOT thread safe.
         """
+        behaviors = {
+            "distribution": "consistent",
+            "connect_timeout": 3000,
+            "send_timeout": 3000000,
+            "receive_timeout": 3000000,
+            "dead_timeout": 5,
+            "verify_keys": False
+        }
+        if self._index is not None:
+            # Required for gets() and cas()
+            behaviors["cas"] = True
         return pylibmc.Client(
             self._server_list,
-            behaviors={
-                "distribution": "consistent",
-                "connect_timeout": 3000,
-                "send_timeout": 3000000,
-                "receive_timeout": 3000000,
-                "dead_timeout": 5,
-                "verify_keys": False
-            },
+            behaviors=behaviors,
             binary=False
         )
 
@@ -749,7 +1950,11 @@ class CacheManager(object):
                         db_session = self._db.Session()
                         db_count = db_session.query(CacheEntry.key).limit(1).count()
                         db_session.close()
-                        if db_count > 0:
+                        if db_count > 0 and self._disk_cache is not None and \
+                           not self._disk_cache.is_empty():
+                            # Keep the control entries for the objects in the disk cache
+                            self._logger.info('Cache is empty, disk cache is not')
+                        elif db_count > 0:
                             # Cache is empty, control database is not. Delete and re-create
                             # the database so we're not left with any fragmentation, etc.
                             self._logger.info('Cache is empty, resetting cache control database')
@@ -29,6 +29,15 @@ SECRET_KEY = "\xc7\x9b\xed9Q\x89\xb0\x19\xad\x80\x85+r\xaat:U#\x9bi\xc9\x99zY"
 # Use 'pillow' for basic imaging, 'imagemagick' for premium imaging
 # (requires qismagick.so), or 'auto' for automatic detection/selection.
 IMAGE_BACKEND = 'auto'
+# The number of worker processes (per web server process) in which to generate
+# images, or 0 to generate images in the web server thread. Using worker
+# processes allows image generation to use all CPU cores. When there are more
+# than IMAGE_BACKEND_QUEUE_SIZE images waiting for a free worker, or when an
+# image takes longer than IMAGE_BACKEND_TIMEOUT seconds, a "server too busy"
+# error is returned.
+IMAGE_BACKEND_WORKERS = 0
+IMAGE_BACKEND_QUEUE_SIZE = 20
+IMAGE_BACKEND_TIMEOUT = 30
 
 # Allowed image types, in the format {file extension: (name, mime type), ...}.
 # Only the image types in this list will be allowed to be uploaded and displayed
@@ -48,6 +57,7 @@ IMAGE_FORMATS = {
     "png": ("PNG image", "image/png"),
     "tif": ("TIFF image", "image/tiff"),
     "tiff": ("TIFF image", "image/tiff"),
+    "webp": ("WebP image", "image/webp"),
 
     # Extra image files - requires qismagick.so
     "bmp": ("Bitmap image", "image/bmp"),
@@ -80,12 +90,19 @@ IMAGE_RESIZE_QUALITY = 3
 # best image quality. Adds a small overhead with the ImageMagick back-end but
 # incurs a heavy performance penalty with the Pillow back-end.
 IMAGE_RESIZE_GAMMA_CORRECT = True
+# With the Pillow back-end, whether to gamma correct RGB images using lookup
+# tables instead of colour profile conversions. This is faster and slightly more
+# accurate. Images with an embedded colour profile still use the profile.
+IMAGE_RESIZE_GAMMA_LUT = False
 
 # Maximum image width/height parameter value to accept
 # E.g. 15k x 15k x 32bpp = 900MB memory required for processing
 MAX_IMAGE_DIMENSION = 15000
 # Maximum grid size when producing tiles (must be a power of 2)
 MAX_GRID_TILES = 256
+# Whether to generate every tile in a tile grid when the first tile is requested,
+# from one decode of the base image, instead of generating each tile separately
+IMAGE_TILE_GRIDS = False
 
 # Optional width and/or height limits to enforce for public-facing images,
 # e.g. to prevent people requesting large versions of thumbnail images.
@@ -96,6 +113,15 @@ MAX_GRID_TILES = 256
 PUBLIC_MAX_IMAGE_WIDTH = 0
 PUBLIC_MAX_IMAGE_HEIGHT = 0
 
+# Optional "ladder" of standard image sizes, to reduce the number of different
+# image sizes that are generated and cached when web pages request many slightly
+# different sizes. Width and height parameters in image URLs are rounded up to
+# the next size in the ladder. This can be a list of sizes, e.g.
+# [100, 200, 400, 800, 1600], or a number greater than 1 for a ladder of sizes
+# that increase by that ratio, e.g. 1.2 for 16, 19, 23, 28, 34 ... pixels.
+# Use None to leave the requested sizes unchanged.
+IMAGE_SIZE_LADDER = None
+
 # The image pixel area beyond which the server may choose to automatically create
 # resized smaller versions of the image, to speed up future imaging operations.
 # Values below 1000000 (1 megapixel) will be ignored and disable this feature.
@@ -191,6 +217,12 @@ LOGGING_SERVER_PORT = 9002
 STATS_SERVER = "localhost"
 # The logging server port
 STATS_SERVER_PORT = 9003
+# When greater than 0, each process adds up its statistics and sends them to the
+# stats server every STATS_CLIENT_BATCH_MSECS milliseconds, or sooner when
+# STATS_CLIENT_BATCH_EVENTS requests have been logged (0 for no limit), instead
+# of sending a message for every request
+STATS_CLIENT_BATCH_MSECS = 0
+STATS_CLIENT_BATCH_EVENTS = 1000
 # The granularity of recorded image statistics, in minutes (approximate, minimum 5)
 STATS_FREQUENCY = 60
 # The number of days to keep statistics for before deleting them.
@@ -206,6 +238,40 @@ TASK_SERVER_THREADS = 5
 
 # The memcached server(s) to use, as a list
 MEMCACHED_SERVERS = ["127.0.0.1:11211"]
+# The size in bytes of an optional in-memory cache of recently used images,
+# kept in front of memcached by each web server process, or 0 to disable.
+# E.g. 64 * 1024 * 1024 for 64MB per process.
+LOCAL_CACHE_SIZE = 0
+# The maximum number of seconds to keep an image in the local in-memory cache.
+# Because each process has its own local cache, when an image is changed it
+# can take up to this long before other processes return the new version.
+LOCAL_CACHE_EXPIRY_SECS = 60
+# Where to index the cached images for searching, either "database" to use the
+# cache management database for every change, or "memcached" to keep the index
+# in memcached and write changes to the database in batches, every
+# CACHE_INDEX_FLUSH_SECS seconds. The "memcached" option greatly reduces the
+# load on the database when many new images are being generated.
+CACHE_INDEX_MODE = "database"
+CACHE_INDEX_FLUSH_SECS = 5
+# Whether to include generation numbers for each image and folder in the cache
+# keys of images, so that all cached versions of an image (or of every image in
+# a folder tree) can be invalidated by changing a single number in the cache,
+# instead of finding and deleting each cached image. The old cached images are
+# then left to be ejected from the cache in the usual way.
+IMAGE_CACHE_GENERATIONS = False
+# The directory and size in bytes of an optional second-tier image cache on
+# local disk (ideally an SSD), or 0 to disable. Images are then also kept on
+# disk after they have been ejected from memcached (or memcached is restarted),
+# including images too large to store in memcached. Images found on disk are
+# sent to the client directly from the file. E.g. 20 * 1024 * 1024 * 1024 for 20GB.
+DISK_CACHE_DIR = INSTALL_DIR + "cache/"
+DISK_CACHE_SIZE = 0
+# Whether to stop rarely requested images from ejecting popular images from
+# the cache. When enabled and the cache is nearly full, a newly generated image
+# is only cached if it has been requested more than once recently, or if it took
+# at least IMAGE_CACHE_ADMISSION_MIN_SECS seconds to generate.
+IMAGE_CACHE_ADMISSION = False
+IMAGE_CACHE_ADMISSION_MIN_SECS = 0.5
 
 # The cache management database
 CACHE_DATABASE_CONNECTION = "postgresql+psycopg2:///qis-cache"
@@ -438,6 +438,21 @@ class DataManager(object):
             if not _db_session:
                 db_session.close()
 
+    @db_operation
+    def list_folder_permission_paths(self, _db_session=None):
+        """
+        Returns a list of (folder path, group ID, access level) tuples
+        for all the FolderPermission objects in the database.
+        """
+        db_session = _db_session or self._db.Session()
+        try:
+            q = db_session.query(Folder.path, FolderPermission.group_id, FolderPermission.access)
+            q = q.filter(FolderPermission.folder_id == Folder.id)
+            return [tuple(row) for row in q.all()]
+        finally:
+            if not _db_session:
+                db_session.close()
+
     @db_operation
     def get_portfolio(self, folio_id=0, human_id=None,
                       load_images=False, load_history=False, _db_session=None):
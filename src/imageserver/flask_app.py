@@ -174,7 +174,9 @@ with app.app_context():
         stats_engine = StatsManager(
             logger,
             app.config['STATS_SERVER'],
-            app.config['STATS_SERVER_PORT']
+            app.config['STATS_SERVER_PORT'],
+            app.config['STATS_CLIENT_BATCH_MSECS'],
+            app.config['STATS_CLIENT_BATCH_EVENTS']
         )
         app.stats_engine = stats_engine
 
@@ -183,7 +185,13 @@ with app.app_context():
             logger,
             app.config['MEMCACHED_SERVERS'],
             app.config['CACHE_DATABASE_CONNECTION'],
-            app.config['CACHE_DATABASE_POOL_SIZE']
+            app.config['CACHE_DATABASE_POOL_SIZE'],
+            app.config['LOCAL_CACHE_SIZE'],
+            app.config['LOCAL_CACHE_EXPIRY_SECS'],
+            app.config['CACHE_INDEX_MODE'],
+            app.config['CACHE_INDEX_FLUSH_SECS'],
+            app.config['DISK_CACHE_DIR'],
+            app.config['DISK_CACHE_SIZE']
         )
         app.cache_engine = cache_engine
 
@@ -177,6 +177,10 @@ class ImageAttrs():
     Before using the attribute values, call normalise_values() to standardise
     strings and remove unnecessary values, and validate() to check for bad values.
     """
+    # Defaults for attributes that are missing from objects pickled by older versions
+    _generation = 0
+    _max_bytes = None
+
     def __init__(self, src, db_id=-1, page=None,
                  iformat=None, template=None, width=None, height=None,
                  align_h=None, align_v=None, rotation=None, flip=None,
@@ -184,13 +188,14 @@ class ImageAttrs():
                  size_fit=None, fill=None, quality=None, sharpen=None,
                  overlay_src=None, overlay_size=None, overlay_pos=None, overlay_opacity=None,
                  icc_profile=None, icc_intent=None, icc_bpc=None, colorspace=None,
-                 strip=None, dpi=None, tile_spec=None):
+                 strip=None, dpi=None, tile_spec=None, max_bytes=None):
         """
         Constructs a new image attributes object.
         See this class's attribute methods for allowed parameter values.
         """
         self._filename = filepath_normalize(src)
         self._db_id = db_id
+        self._generation = 0
         self._page = page
         self._format = iformat
         self._template = template
@@ -221,6 +226,7 @@ class ImageAttrs():
         self._dpi_x = dpi
         self._dpi_y = dpi
         self._tile = tile_spec
+        self._max_bytes = max_bytes
         self._normalise_strings()
         self._normalise_floats()
 
@@ -398,6 +404,12 @@ class ImageAttrs():
         """
         return self._quality
 
+    def max_bytes(self):
+        """
+        Returns the max_bytes (maximum file size) attribute if it was supplied, or None
+        """
+        return self._max_bytes
+
     def sharpen(self):
         """
         Returns the sharpen attribute if it was supplied, or None
@@ -484,6 +496,20 @@ class ImageAttrs():
         """
         self._db_id = db_id
 
+    def generation(self):
+        """
+        Returns the cache generation number of the image, or 0 if not set
+        """
+        return self._generation
+
+    def set_generation(self, generation):
+        """
+        Sets the cache generation number of the image, which changes whenever
+        the cached versions of the image are invalidated. This is managed by
+        the image manager and is not an image attribute.
+        """
+        self._generation = generation
+
     @staticmethod
     def _validators():
         """
@@ -520,6 +546,7 @@ class ImageAttrs():
             "size_fit": (BooleanValidator(), "autosizefit"),
             "fill": (LengthValidator(3, 32), "fill"),
             "quality": (RangeValidator(1, 100), "quality"),
+            "max_bytes": (RangeValidator(0, 1073741824), "maxbytes"),
             "sharpen": (RangeValidator(-500, 500), "sharpen"),
             "overlay_src": (LengthValidator(1, 1024), "overlay"),
             "overlay_pos": (ChoiceValidator(ov_positions), "ovpos"),
@@ -616,6 +643,7 @@ class ImageAttrs():
             (self.bottom() is not None) or
             (self.right() is not None) or
             (self.quality() is not None) or
+            (self.max_bytes() is not None) or
             (self.sharpen() is not None) or
             (self.overlay_src() is not None) or
             (self.icc_profile() is not None) or
@@ -656,6 +684,10 @@ class ImageAttrs():
         if base.page() != target.page():
             return 2
 
+        # Cache generation must match (or the base is an invalidated image)
+        if base.generation() != target.generation():
+            return 21
+
         # File formats must match (a lossy jpg is no good as a base for lossless png)
         if base.format() != target.format():
             return 3
@@ -691,6 +723,10 @@ class ImageAttrs():
         if this_quality < target_quality:
             return 7
 
+        # Ditto for a base that was reduced in quality to meet a file size limit
+        if base.max_bytes() is not None:
+            return 22
+
         # Width and height are similar to quality. If None, the width/height is
         # original and cannot be bettered. Since in Python (1 > None) == True
         # we must swap None for a large int (same as the 101 for quality).
@@ -883,6 +919,9 @@ class ImageAttrs():
         assert self._db_id > 0, 'Image database ID must be set to create cache key'
         key_parts = [_prefix + str(self._db_id)]
 
+        if self._generation:
+            key_parts.append('U' + str(self._generation))
+
         # Note: Most functions check for "is None" to see if a value is given.
         #       Here we treat all values as booleans because we do not want
         #       to include values with "", 0, False or None. In all cases
@@ -936,6 +975,9 @@ class ImageAttrs():
         if self._quality:
             key_parts.append('Q' + str(self._quality))
 
+        if self._max_bytes:
+            key_parts.append('M' + str(self._max_bytes))
+
         if self._sharpen:
             key_parts.append('S' + str(self._sharpen))
 
@@ -1119,6 +1161,9 @@ class ImageAttrs():
         if self._quality == 0:
             self._quality = None
 
+        if self._max_bytes == 0:
+            self._max_bytes = None
+
         if self._sharpen == 0:
             self._sharpen = None
 
@@ -37,18 +37,24 @@
 # TODO Can we make base image detection more intelligent to work with cropped images?
 #      Currently auto-pyramid for cropped images has no effect.
 
+import bisect
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import glob
+import math
 import os
 import threading
 import time
+import zlib
 
 from . import exif
 from . import imaging
 
+from .cache_manager import MAX_OBJECT_SLOTS, MAX_SLOT_SIZE, FrequencySketch
 from .errors import DBDataError, DoesNotExistError, ImageError, ServerTooBusyError
 from .filesystem_manager import (
-    get_deduped_path, get_file_data, get_file_info,
+    get_abs_path, get_deduped_path, get_file_data, get_file_info,
     make_dirs, path_exists, put_file_data
 )
 from .filesystem_sync import auto_sync_file, set_image_properties
@@ -57,7 +63,7 @@ from .image_wrapper import ImageWrapper
 from .models import FolderPermission, Image, ImageHistory, Task
 from .template_manager import ImageTemplateManager
 from .util import default_value, get_file_extension
-from .util import filepath_filename, validate_filename
+from .util import filepath_filename, filepath_normalize, strip_seps, validate_filename
 
 
 class ImageManager(object):
@@ -68,6 +74,31 @@ class ImageManager(object):
     DEFAULT_EXPIRY_SECS = 60 * 60 * 24 * 7
     DEFAULT_QUALITY_JPG = 80  # Err on the high quality side
     DEFAULT_QUALITY_PNG = 79  # 79 for complex images / 31 for simple images
+    IMAGE_LOCK_CHECK_MIN = 0.01  # Initial and maximum delays between checks
+    IMAGE_LOCK_CHECK_MAX = 0.5   # of another process's image generation lock
+    # Unaltered images larger than the cache can store are streamed from disk
+    PASSTHROUGH_STREAM_MIN_SIZE = MAX_OBJECT_SLOTS * MAX_SLOT_SIZE
+    # Cache keys for the generation numbers of images and folders
+    IMAGE_GENERATION_KEY = 'IMG_GEN:'
+    FOLDER_GENERATION_KEY = 'FOLDER_GEN:'
+    # The smallest size in a ladder of image sizes given as a ratio
+    SIZE_LADDER_MIN = 16
+    # For format=auto, the image formats to use in order of preference,
+    # if the client accepts them and the imaging back end supports them
+    AUTO_FORMAT_PREFERENCE = ['webp']
+    # The size and overlap in pixels of Deep Zoom (DZI) image tiles
+    DZI_TILE_SIZE = 254
+    DZI_TILE_OVERLAP = 1
+    # The number of Deep Zoom tiles across and down in the blocks of tiles
+    # that are cut together from one decode of the original image
+    DZI_TILE_BLOCK = 8
+    # Cache key prefix for the original image sizes used for Deep Zoom tiles
+    DZI_SIZE_KEY = 'DZI_SIZE:'
+    # With IMAGE_CACHE_ADMISSION, the number of recent requests required to
+    # cache a new image, and the cache usage from which this applies
+    CACHE_ADMISSION_MIN_FREQUENCY = 2
+    CACHE_ADMISSION_MIN_PERCENT = 90
+    CACHE_ADMISSION_CHECK_SECS = 60  # How often to check the cache usage
 
     def __init__(self, data_manager, cache_manager, task_manager,
                  permissions_manager, settings, logger):
@@ -80,12 +111,22 @@ class ImageManager(object):
         self._templates = ImageTemplateManager(data_manager, logger)
         self.__icc_profiles = None
         self._icc_load_lock = threading.Lock()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._admission_sketch = (
+            FrequencySketch() if settings['IMAGE_CACHE_ADMISSION'] else None
+        )
+        self._admission_counts = {'admitted': 0, 'rejected': 0}
+        self._admission_cache_full = (0, False)
         # Load imaging library
         imaging.init(
             settings['IMAGE_BACKEND'],
             settings['GHOSTSCRIPT_PATH'],
             settings['TEMP_DIR'],
-            settings['PDF_BURST_DPI']
+            settings['PDF_BURST_DPI'],
+            settings['IMAGE_BACKEND_WORKERS'],
+            settings['IMAGE_BACKEND_QUEUE_SIZE'],
+            settings['IMAGE_BACKEND_TIMEOUT']
         )
         logger.info('Loaded imaging library: ' + imaging.get_version_info())
 
@@ -126,6 +167,47 @@ class ImageManager(object):
                 image_attrs._quality = prev_quality    # restore the quality setting
         return image_attrs
 
+    def get_ladder_image_size(self, width, height):
+        """
+        Returns a tuple of (width, height) with the given image width and height
+        rounded up to the next size in the IMAGE_SIZE_LADDER setting. If both
+        values are given, the larger is rounded up and the other is scaled in
+        proportion. Values of None or 0 are returned unchanged, as are sizes
+        above the largest size in the ladder, and all sizes if the setting is
+        empty.
+        """
+        if not self._settings['IMAGE_SIZE_LADDER']:
+            return (width, height)
+        if width and height:
+            size = max(width, height)
+            ladder_size = self._get_ladder_size(size)
+            if width >= height:
+                return (ladder_size, max(height, int(round(height * ladder_size / size))))
+            else:
+                return (max(width, int(round(width * ladder_size / size))), ladder_size)
+        return (
+            self._get_ladder_size(width) if width else width,
+            self._get_ladder_size(height) if height else height
+        )
+
+    def _get_ladder_size(self, size):
+        """
+        Returns the next size in the IMAGE_SIZE_LADDER setting that is equal
+        to or larger than size, or size if there is no such value.
+        """
+        ladder = self._settings['IMAGE_SIZE_LADDER']
+        if isinstance(ladder, (list, tuple)):
+            ladder_sizes = sorted(ladder)
+            idx = bisect.bisect_left(ladder_sizes, size)
+            return ladder_sizes[idx] if idx < len(ladder_sizes) else size
+        max_size = self._settings['MAX_IMAGE_DIMENSION']
+        if ladder <= 1 or size >= max_size:
+            return size
+        ladder_size = ImageManager.SIZE_LADDER_MIN
+        while ladder_size < size:
+            ladder_size = max(ladder_size + 1, int(round(ladder_size * ladder)))
+        return min(ladder_size, max_size)
+
     def get_template_list(self):
         """
         Returns a list of available template information as
@@ -204,6 +286,23 @@ class ImageManager(object):
             if supported_only else self._memo_image_formats_all
         )
 
+    def get_auto_image_format(self, accept_mime_types):
+        """
+        Returns the preferred image format (as a file extension) for a client
+        that accepts the given list of MIME types, e.g. from the HTTP Accept
+        header, or None if the client should receive the normal image format.
+        Only MIME types named explicitly are considered, not wildcards such as
+        image/*, and only formats that the imaging back end supports.
+        """
+        accepted = set(mt.lower() for mt in accept_mime_types)
+        supported = self.get_image_formats(supported_only=True)
+        for fmt in ImageManager.AUTO_FORMAT_PREFERENCE:
+            if fmt in supported:
+                (_, mime_type) = self._settings['IMAGE_FORMATS'][fmt]
+                if mime_type in accepted:
+                    return fmt
+        return None
+
     def get_supported_operations(self):
         """
         Returns a dictionary of {key: boolean} values for which imaging operations
@@ -331,12 +430,15 @@ class ImageManager(object):
         self._logger.debug('Stored uploaded file, returning image ' + str(stored_attrs))
         return stored_attrs, db_image
 
-    def get_image_original(self, image_attrs):
+    def get_image_original(self, image_attrs, stream=False):
         """
         Returns an ImageWrapper object containing an original unchanged image
         (attributes in image_attrs other than the filename are ignored),
         or None if the image could not be found or could not be read.
 
+        If stream is True, the file is not read, and the ImageWrapper instead
+        contains the file path and size for streaming the file to the client.
+
         Raises a SecurityError if the file path requested attempts to read outside
         of the images directory, or an ImageError if the requested image is in
         an invalid or unsupported file format.
@@ -348,9 +450,16 @@ class ImageManager(object):
         if file_name_extension not in self.get_image_formats(supported_only=True):
             raise ImageError('The file is not a supported image format')
 
-        file_data = get_file_data(image_attrs.filename())
-        if file_data is None:
-            return None
+        file_data = None
+        file_info = None
+        if stream:
+            file_info = get_file_info(image_attrs.filename())
+            if file_info is None:
+                return None
+        else:
+            file_data = get_file_data(image_attrs.filename())
+            if file_data is None:
+                return None
 
         # Hmm, what client caching time for the original image?
         # Let's assume that the original is valid for as long as the default derivations of it
@@ -364,11 +473,42 @@ class ImageManager(object):
             file_data,
             ImageAttrs(image_attrs.filename(), image_attrs.database_id()),
             from_cache=False,
-            last_modified=self.get_image_original_modified_time(image_attrs),
-            client_expiry_seconds=expiry_secs
+            last_modified=(
+                file_info['modified'] if file_info else
+                self.get_image_original_modified_time(image_attrs)
+            ),
+            client_expiry_seconds=expiry_secs,
+            file_path=get_abs_path(image_attrs.filename()) if file_info else None,
+            file_size=file_info['size'] if file_info else 0
         )
 
-    def get_image(self, image_attrs, cache_result=True):
+    def get_image_passthrough(self, image_attrs):
+        """
+        For image attributes that do not change the original image (see
+        ImageAttrs.attributes_change_image()), returns an ImageWrapper for
+        streaming the original file to the client, with the handling options
+        that get_image() would return. This only applies to files too large
+        to be stored in the cache. Returns None if the image attributes change
+        the image, or if the file is not too large to cache, or if the file
+        could not be found, in which case get_image() should be used instead.
+
+        Raises a SecurityError if the file path requested attempts to read
+        outside of the images directory.
+        """
+        if image_attrs.attributes_change_image():
+            return None
+        file_info = get_file_info(image_attrs.filename())
+        if file_info is None or file_info['size'] <= ImageManager.PASSTHROUGH_STREAM_MIN_SIZE:
+            return None
+        self._set_image_generations([image_attrs])
+        if self._settings['DEBUG']:
+            self._logger.debug('Streaming unaltered image file for ' + str(image_attrs))
+        return self._make_image_wrapper(
+            None, image_attrs, False, get_abs_path(image_attrs.filename()), file_info['size']
+        )
+
+    def get_image(self, image_attrs, cache_result=True, stream=False, _always_cache=False,
+                  _base_image_fn=None, _generate_fn=None):
         """
         Returns an ImageWrapper object for the image with the specified attributes,
         or None if the image's filename could not be found or could not be read.
@@ -383,6 +523,20 @@ class ImageManager(object):
         cache for faster retrieval by subsequent calls. When cache_result is
         'refresh', any existing cache entries are first removed.
 
+        If stream is True and the image is found in the disk cache, the file is
+        not read, and the ImageWrapper instead contains the file path and size
+        for streaming the file to the client.
+
+        If IMAGE_CACHE_ADMISSION is enabled, a newly generated image is only
+        added to cache if it passes the checks in _admit_to_cache(), unless
+        _always_cache is True.
+
+        If _base_image_fn is given, it is called to obtain the base image (an
+        ImageWrapper, or None to use the original image) when the image has to
+        be generated, instead of searching the cache for a base image. If
+        _generate_fn is given, it is called with the base image to generate the
+        new image data, and should raise an ImageError on error.
+
         Raises a SecurityError if the file path requested attempts to read outside
         of the images directory, an ImageError if the requested image is invalid
         or is an unsupported file format, a ServerTooBusyError if a timeout occurs
@@ -391,7 +545,6 @@ class ImageManager(object):
         # Init a few things
         debug_mode = self._settings['DEBUG']
         ret_from_cache = False
-        cache_key = image_attrs.get_cache_key()
         wait_timeout = min(max(self._settings['IMAGE_GENERATION_WAIT_TIMEOUT'], 10), 120)
 
         # See if caller wants to refresh the cache.
@@ -402,137 +555,421 @@ class ImageManager(object):
         if cache_result == 'refresh':
             self._logger.debug('Cleaning cache entries for ' + image_attrs.filename())
             self.reset_image(image_attrs, re_burst_pdf=False)
+            image_attrs.set_generation(0)
             cache_result = True
 
-        # See if the exact same custom image is already in cache
+        self._set_image_generations([image_attrs])
+        cache_key = image_attrs.get_cache_key()
+        if self._admission_sketch is not None:
+            self._admission_sketch.increment(cache_key)
+
+        # See if the exact same custom image is already in cache, fetching its
+        # metadata and any generation lock in the same call to the cache
         if debug_mode:
             self._logger.debug('Checking cache for requested image ' + str(image_attrs))
-        ret_image_data = self._cache.get(cache_key)
-
-        if ret_image_data is None and self._is_image_lock(cache_key):
-            # The requested image + attrs is not yet in cache but someone else
-            # is currently generating it. Wait for it to complete or time out.
-            if debug_mode:
-                self._logger.debug('Waiting while another client generates ' + str(image_attrs))
-            wait_until = time.time() + wait_timeout
-            while self._is_image_lock(cache_key) and time.time() < wait_until:
-                time.sleep(0.1)
-            # Try again
-            ret_image_data = self._cache.get(cache_key)
-            if ret_image_data is None:
-                self._logger.warning('Timed out waiting for ' + str(image_attrs))
-                if (
-                    self._settings['IMAGE_GENERATION_RAISE_TOO_BUSY'] and
-                    not self._settings['BENCHMARKING']
-                ):
-                    # We might have 10 (100!) requests queued up waiting, so an
-                    # error now is preferable to letting them all go through
-                    raise ServerTooBusyError()
+        (ret_image_data, image_metadata, cache_extras) = self._cache.get_fused(
+            cache_key, image_attrs.get_metadata_cache_key(), ['LOCK_' + cache_key]
+        )
+        image_locked = ('LOCK_' + cache_key) in cache_extras
 
+        # Images in the disk cache can be streamed from their cache file
         if ret_image_data is None:
-            # We'll need to generate the image.
-            self._logger.debug('No exact match, trying to find a cached base image')
-            try:
-                if cache_result:
-                    # Notify other clients what we'll put in the cache
-                    # #2293 Don't overwrite the lock if there's one already
-                    if not self._is_image_lock(cache_key):
-                        self._set_image_lock(cache_key, wait_timeout)
-
-                # See if there is a version already cached that we can use as a base
-                base_image = self._get_base_image(image_attrs)
-
-                if image_attrs.tile_spec() is not None:
-                    # Performance special case - always generate the non-tiled version
-                    # of a tile request, otherwise calls for all the other tiles have
-                    # to start from scratch too
-                    if (base_image is None or
-                        base_image.attrs().width() != image_attrs.width() or
-                        base_image.attrs().height() != image_attrs.height()
-                    ):
-                        self._logger.debug('Creating new base image for requested tile')
-                        base_image = self._get_tile_base_image(image_attrs)
-
-                if base_image is None:
+            disk_file = self._cache.get_file(cache_key)
+            if disk_file is not None:
+                if stream:
                     if debug_mode:
-                        self._logger.debug('No base image found, reading original disk file')
-                    file_data = get_file_data(image_attrs.filename())
-                    if file_data is None:
-                        # Disk file read failed
-                        return None
-                    # See whether to auto-pyramid the original image for the future
-                    self._auto_pyramid_image(
-                        file_data, get_file_extension(image_attrs.filename()), image_attrs
+                        self._logger.debug('Streaming from disk cache: ' + str(image_attrs))
+                    return self._make_image_wrapper(
+                        None, image_attrs, True, disk_file[0], disk_file[1],
+                        modified_time=(image_metadata['modified'] if image_metadata else 0)
                     )
-                    # Set the original image from disk as the base image
-                    file_attrs = ImageAttrs(image_attrs.filename(), image_attrs.database_id())
-                    base_image = ImageWrapper(file_data, file_attrs)
+                ret_image_data = self._cache.get(cache_key)
+
+        # If another thread in this process is already generating (or waiting
+        # for) the same image, wait for it to finish rather than polling the cache
+        flight = None
+        flight_error = None
+        if ret_image_data is None and cache_result:
+            flight, is_leader = self._join_image_flight(cache_key)
+            if not is_leader:
+                if debug_mode:
+                    self._logger.debug('Waiting while another thread generates ' + str(image_attrs))
+                try:
+                    # This raises the other thread's exception if it failed
+                    flight_data = flight.result(wait_timeout)
+                except futures.TimeoutError:
+                    self._image_wait_timed_out(image_attrs)
                 else:
-                    if debug_mode:
-                        self._logger.debug('Base image found: ' + str(base_image.attrs()))
-                    # If the base image found is the full size,
-                    # see whether to auto-pyramid the original image for the future
-                    if not base_image.attrs().width() and not base_image.attrs().height():
-                        self._auto_pyramid_image(
-                            base_image.data(), base_image.attrs().format(), image_attrs
-                        )
+                    (ret_image_data, image_metadata, cache_extras) = self._cache.get_fused(
+                        cache_key, image_attrs.get_metadata_cache_key(), ['LOCK_' + cache_key]
+                    )
+                    image_locked = ('LOCK_' + cache_key) in cache_extras
+                    if ret_image_data is None:
+                        # The image was not cached, use the other thread's copy
+                        if flight_data is None:
+                            return None
+                        return self._make_image_wrapper(flight_data, image_attrs, False)
+                flight = None
 
-                # Generate a new custom image
+        try:
+            if ret_image_data is None and image_locked:
+                # The requested image + attrs is not yet in cache but someone else
+                # is currently generating it. Wait for it to complete or time out.
+                if debug_mode:
+                    self._logger.debug('Waiting while another client generates ' + str(image_attrs))
+                lock_cleared = self._wait_for_image_lock(cache_key, wait_timeout)
+                # Try again. If the lock was cleared without the image being
+                # cached (it was not admitted to cache), generate it ourselves.
+                ret_image_data = self._cache.get(cache_key)
+                if ret_image_data is None and not lock_cleared:
+                    self._image_wait_timed_out(image_attrs)
+
+            if ret_image_data is None:
+                # We'll need to generate the image.
+                self._logger.debug('No exact match, trying to find a cached base image')
+                gen_started = time.time()
                 try:
-                    ret_image_data = self._adjust_image(
-                        base_image.data(),
-                        base_image.attrs(),
-                        image_attrs
-                    )
-                except ImageError as e:
-                    # Image generation failed. Continue, cache the error so that
-                    # other clients don't repeatedly try to re-generate it.
-                    ret_image_data = ImageManager.IMAGE_ERROR_HEADER + str(e)
-
-                # Add it to cache for next time
-                if cache_result:
-                    if self._cache_image(ret_image_data, image_attrs):
+                    if cache_result:
+                        # Notify other clients what we'll put in the cache
+                        # #2293 Don't overwrite the lock if there's one already
+                        if not self._is_image_lock(cache_key):
+                            self._set_image_lock(cache_key, wait_timeout)
+
+                    # See if there is a version already cached that we can use as a base
+                    if _base_image_fn is not None:
+                        base_image = _base_image_fn()
+                    else:
+                        base_image = self._get_base_image(image_attrs)
+
+                    if image_attrs.tile_spec() is not None:
+                        # Performance special case - always generate the non-tiled version
+                        # of a tile request, otherwise calls for all the other tiles have
+                        # to start from scratch too
+                        if (base_image is None or
+                            base_image.attrs().width() != image_attrs.width() or
+                            base_image.attrs().height() != image_attrs.height()
+                        ):
+                            self._logger.debug('Creating new base image for requested tile')
+                            base_image = self._get_tile_base_image(image_attrs)
+
+                    if base_image is None:
                         if debug_mode:
-                            self._logger.debug('Added new image to cache: ' + str(image_attrs))
+                            self._logger.debug('No base image found, reading original disk file')
+                        file_data = get_file_data(image_attrs.filename())
+                        if file_data is None:
+                            # Disk file read failed
+                            return None
+                        # See whether to auto-pyramid the original image for the future
+                        self._auto_pyramid_image(
+                            file_data, get_file_extension(image_attrs.filename()), image_attrs
+                        )
+                        # Set the original image from disk as the base image
+                        file_attrs = ImageAttrs(image_attrs.filename(), image_attrs.database_id())
+                        base_image = ImageWrapper(file_data, file_attrs)
                     else:
-                        self._logger.warning('Failed to add image to cache: ' + str(image_attrs))
-            finally:
-                if cache_result:
-                    # Tell anyone waiting they can now grab the cached image
-                    self._clear_image_lock(cache_key)
-        else:
-            # We found the requested image in cache
-            ret_from_cache = True
-            if debug_mode:
-                self._logger.debug('Retrieved exact match from cache for ' + str(image_attrs))
+                        if debug_mode:
+                            self._logger.debug('Base image found: ' + str(base_image.attrs()))
+                        # If the base image found is the full size,
+                        # see whether to auto-pyramid the original image for the future
+                        if not base_image.attrs().width() and not base_image.attrs().height():
+                            self._auto_pyramid_image(
+                                base_image.data(), base_image.attrs().format(), image_attrs
+                            )
+
+                    # Generate a new custom image
+                    ret_quality = 0
+                    try:
+                        if _generate_fn is not None:
+                            ret_image_data = _generate_fn(base_image)
+                        elif image_attrs.max_bytes():
+                            # Start from the quality found the last time
+                            # this image was generated, if it is known
+                            ret_image_data, ret_quality = self._adjust_image_max_bytes(
+                                base_image.data(),
+                                base_image.attrs(),
+                                image_attrs,
+                                image_metadata.get('quality', 0) if image_metadata else 0
+                            )
+                        elif (self._settings['IMAGE_TILE_GRIDS'] and cache_result and
+                              image_attrs.tile_spec() is not None and
+                              base_image.attrs().tile_spec() is None):
+                            # Generate the other tiles in the grid at the same time
+                            ret_image_data = self._generate_tile_grid(
+                                base_image, image_attrs, wait_timeout
+                            )
+                        else:
+                            ret_image_data = self._adjust_image(
+                                base_image.data(),
+                                base_image.attrs(),
+                                image_attrs
+                            )
+                    except ImageError as e:
+                        # Image generation failed. Continue, cache the error so that
+                        # other clients don't repeatedly try to re-generate it.
+                        ret_image_data = ImageManager.IMAGE_ERROR_HEADER + str(e)
+
+                    # Add it to cache for next time
+                    if cache_result and not _always_cache and not self._admit_to_cache(
+                        cache_key, ret_image_data, time.time() - gen_started
+                    ):
+                        if debug_mode:
+                            self._logger.debug('Not adding new image to cache: ' + str(image_attrs))
+                    elif cache_result:
+                        if self._cache_image(ret_image_data, image_attrs, ret_quality):
+                            if debug_mode:
+                                self._logger.debug('Added new image to cache: ' + str(image_attrs))
+                        else:
+                            self._logger.warning(
+                                'Failed to add image to cache: ' + str(image_attrs)
+                            )
+                finally:
+                    if cache_result:
+                        # Tell anyone waiting they can now grab the cached image
+                        self._clear_image_lock(cache_key)
+            else:
+                # We found the requested image in cache
+                ret_from_cache = True
+                if debug_mode:
+                    self._logger.debug('Retrieved exact match from cache for ' + str(image_attrs))
+        except Exception as e:
+            flight_error = e
+            raise
+        finally:
+            if flight is not None:
+                # Tell any other threads waiting they can now grab the image
+                self._end_image_flight(cache_key, flight, ret_image_data, flight_error)
 
-        # If there was an imaging error (just now or previously cached),
-        # raise the exception now
-        if self._is_image_error(ret_image_data):
-            raise ImageError(self._get_image_error(ret_image_data))
+        return self._make_image_wrapper(
+            ret_image_data, image_attrs, ret_from_cache,
+            modified_time=(image_metadata['modified'] if ret_from_cache and image_metadata else 0)
+        )
 
-        # v1.17 Get/set the image's last modification time
-        modified_time = self.get_image_modified_time(image_attrs)
-        if modified_time == 0:
-            modified_time = time.time()
-            self._cache_image_metadata(image_attrs, modified_time)
+    def get_images(self, image_attrs_list, cache_result=True, max_threads=4):
+        """
+        Returns a list of ImageWrapper objects for multiple images, in the same
+        order as image_attrs_list. As for get_image(), a list entry is None if
+        the image's filename could not be found or could not be read. If an
+        exception is raised for an image, the exception object is returned in
+        its place in the list.
+
+        Images that are already in cache are all retrieved in a single cache call.
+        The remaining images are then generated in parallel, using up to
+        max_threads threads.
+        """
+        results = [None] * len(image_attrs_list)
+        self._set_image_generations(image_attrs_list)
+        cached_images = self._cache.getn(
+            list(set(ia.get_cache_key() for ia in image_attrs_list))
+        ) if cache_result else {}
+        missing = []
+        for (idx, image_attrs) in enumerate(image_attrs_list):
+            image_data = cached_images.get(image_attrs.get_cache_key())
+            if image_data is not None:
+                if self._admission_sketch is not None:
+                    self._admission_sketch.increment(image_attrs.get_cache_key())
+                try:
+                    results[idx] = self._make_image_wrapper(image_data, image_attrs, True)
+                except Exception as e:
+                    results[idx] = e
+            else:
+                missing.append(idx)
 
-        # Get default handling options from requested template or default template
-        template_attrs = self.get_image_template(image_attrs)
-        expiry_secs = default_value(template_attrs.expiry_secs(), ImageManager.DEFAULT_EXPIRY_SECS)
-        attachment = default_value(template_attrs.attachment(), False)
-        do_stats = default_value(template_attrs.record_stats(), True)
+        def _get_image(idx):
+            try:
+                return self.get_image(image_attrs_list[idx], cache_result)
+            except Exception as e:
+                return e
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(len(missing), max_threads)) as executor:
+                for (idx, result) in zip(missing, executor.map(_get_image, missing)):
+                    results[idx] = result
+        return results
+
+    def get_image_variants(self, image_attrs_list, cache_result=True, cascade=False):
+        """
+        Returns a list of ImageWrapper objects for several variants of the same
+        image file, in the same order as image_attrs_list. As for get_images(),
+        a list entry is None if the image's filename could not be found or could
+        not be read, and if an exception is raised for an image, the exception
+        object is returned in its place in the list.
+
+        Variants that are not already in cache are all generated from a single
+        read and decode of the original image file, which is much faster than
+        calling get_image() for each one, e.g. when generating every template
+        for a new image. Image tiles, and images that another client is
+        already generating, are returned via get_image() instead.
+
+        If cascade is True, image_attrs_list should be in order of decreasing
+        image size, and the images that are only resized are each resized from
+        the one before, as described for imaging.adjust_image_cascade().
+
+        Raises a ValueError if the image attributes are not all for the same file.
+        """
+        if not image_attrs_list:
+            return []
+        filename = image_attrs_list[0].filename()
+        if any(ia.filename() != filename for ia in image_attrs_list):
+            raise ValueError('Image variants must all be for the same image file')
+
+        results = [None] * len(image_attrs_list)
+        self._set_image_generations(image_attrs_list)
+        cache_keys = [ia.get_cache_key() for ia in image_attrs_list]
+        cached_images = self._cache.getn(list(set(cache_keys))) if cache_result else {}
+        generate = []
+        individual = []
+        for (idx, image_attrs) in enumerate(image_attrs_list):
+            cache_key = cache_keys[idx]
+            image_data = cached_images.get(cache_key)
+            if image_data is not None:
+                try:
+                    results[idx] = self._make_image_wrapper(image_data, image_attrs, True)
+                except Exception as e:
+                    results[idx] = e
+            elif (image_attrs.tile_spec() is not None or
+                  not image_attrs.attributes_change_image() or
+                  cache_key in (cache_keys[g] for g in generate) or
+                  (cache_result and self._is_image_lock(cache_key))):
+                individual.append(idx)
+            else:
+                generate.append(idx)
+
+        if generate:
+            try:
+                generated = self._generate_image_variants(
+                    [image_attrs_list[idx] for idx in generate],
+                    cache_result,
+                    cascade
+                )
+            except Exception as e:
+                generated = [e] * len(generate)
+            for (idx, result) in zip(generate, generated):
+                results[idx] = result
 
-        # Return the requested image
-        return ImageWrapper(
-            ret_image_data,
-            image_attrs,
-            ret_from_cache,
-            modified_time,
-            expiry_secs,
-            attachment,
-            do_stats
-        )
+        # This includes any duplicates of the images just generated
+        for idx in individual:
+            try:
+                results[idx] = self.get_image(image_attrs_list[idx], cache_result)
+            except Exception as e:
+                results[idx] = e
+        return results
+
+    def get_dzi_image_size(self, image_attrs):
+        """
+        Returns the size of the original image, as a tuple of (width, height),
+        for the image's Deep Zoom (DZI) descriptor and tiles. The size is read
+        from cache if possible, otherwise from the image's database record.
+        The image attributes must have the database ID set.
+
+        Returns (0, 0) if the image size is not known.
+        """
+        size_attrs = ImageAttrs(image_attrs.filename(), image_attrs.database_id())
+        self._set_image_generations([size_attrs])
+        size_key = size_attrs.get_cache_key(_prefix=ImageManager.DZI_SIZE_KEY)
+        image_size = self._cache.raw_get(size_key)
+        if image_size is None:
+            db_image = self._data.get_image(image_attrs.database_id())
+            if db_image is None or not db_image.width or not db_image.height:
+                return (0, 0)
+            image_size = (db_image.width, db_image.height)
+            self._cache.raw_put(size_key, image_size)
+        return image_size
+
+    @staticmethod
+    def get_dzi_levels(width, height):
+        """
+        Returns a list of the image sizes, as tuples of (width, height), at each
+        level of the Deep Zoom (DZI) tile pyramid for an image of the given size.
+        Level 0 is 1 pixel in size, and each level is double the size of the one
+        before, with sizes rounded up, up to the full image size at the last level.
+        """
+        max_level = int(math.ceil(math.log(max(width, height, 1), 2)))
+        levels = []
+        for level in range(max_level + 1):
+            scale = 2 ** (max_level - level)
+            levels.append((-(-width // scale), -(-height // scale)))
+        return levels
+
+    def get_dzi_tile(self, image_attrs, level, column, row):
+        """
+        Returns an ImageWrapper for a tile of the Deep Zoom (DZI) tile pyramid
+        for an image, or None if the image's filename could not be found or
+        could not be read. The image attributes must have the database ID set,
+        and should specify only the image filename and the tile image format.
+
+        Tiles are DZI_TILE_SIZE pixels square (less at the right and bottom
+        edges), plus DZI_TILE_OVERLAP pixels overlapping each neighbouring tile.
+        Each tile is cached, and when not in cache is cut from a cached copy of
+        the full image at the tile's level. Each level image is in turn created
+        by halving the level above, so that the original image file only needs
+        to be read for the top levels of the pyramid. The tiles at the top level,
+        and at any level larger than the MAX_IMAGE_DIMENSION setting, are cut
+        directly from the original image, in blocks of up to DZI_TILE_BLOCK
+        tiles across and down from each read and decode of the original.
+
+        Raises a ValueError if the level, column or row is outside the tile
+        pyramid, otherwise raises exceptions as for get_image().
+        """
+        (width, height) = self.get_dzi_image_size(image_attrs)
+        if not width or not height:
+            return None
+        levels = ImageManager.get_dzi_levels(width, height)
+        if level < 0 or level >= len(levels):
+            raise ValueError('level: out of range')
+        (level_width, level_height) = levels[level]
+        tile_size = ImageManager.DZI_TILE_SIZE
+        if column < 0 or row < 0 or column * tile_size >= level_width or \
+           row * tile_size >= level_height:
+            raise ValueError('column or row: out of range')
+        (tile_attrs, tile_crop) = self._get_dzi_tile_attrs(image_attrs, levels, level, column, row)
+
+        max_image_level = self._get_dzi_max_image_level(levels)
+        if level <= max_image_level:
+            return self.get_image(
+                tile_attrs,
+                _base_image_fn=lambda: self._get_dzi_level_image(
+                    image_attrs, levels, level, max_image_level
+                )
+            )
+
+        # Cut the tile from the original image, along with the other tiles in
+        # its block that are not already cached or being generated elsewhere
+        wait_timeout = min(max(self._settings['IMAGE_GENERATION_WAIT_TIMEOUT'], 10), 120)
+        block_tiles = {}
+
+        def get_base_image():
+            block_tiles.update(self._lock_dzi_tile_block(
+                image_attrs, levels, level, column, row, wait_timeout
+            ))
+            # Use the original image
+            return None
+
+        def generate_tiles(base_image):
+            return self._generate_dzi_tile_block(
+                base_image, tile_attrs, tile_crop, list(block_tiles.values())
+            )
+
+        try:
+            return self.get_image(
+                tile_attrs, _base_image_fn=get_base_image, _generate_fn=generate_tiles
+            )
+        finally:
+            if block_tiles:
+                self._cache.raw_deleten(list(block_tiles))
+
+    def get_cache_admission_stats(self):
+        """
+        Returns a dictionary of the number of newly generated images that were
+        'admitted' to and 'rejected' from the cache by this process, and the
+        'admit_ratio' of admitted images to the total, or None if the
+        IMAGE_CACHE_ADMISSION setting is disabled.
+        """
+        if self._admission_sketch is None:
+            return None
+        stats = dict(self._admission_counts)
+        total = stats['admitted'] + stats['rejected']
+        stats['admit_ratio'] = (stats['admitted'] / total) if total else 1.0
+        return stats
 
     def get_image_template(self, image_attrs):
         """
@@ -555,7 +992,10 @@ class ImageManager(object):
         Note that even if the last modification time is known, the associated
         image itself may not still be in cache (or may never have been cached).
         """
-        image_metadata = self._cache.raw_get(image_attrs.get_metadata_cache_key())
+        self._set_image_generations([image_attrs])
+        image_metadata = self._cache.raw_get(
+            image_attrs.get_metadata_cache_key(), local_cache=True
+        )
         return image_metadata['modified'] if image_metadata else 0
 
     def get_image_original_modified_time(self, image_attrs):
@@ -717,6 +1157,187 @@ class ImageManager(object):
         """
         self._templates.reset()
 
+    def _make_image_wrapper(self, image_data, image_attrs, from_cache,
+                            file_path=None, file_size=0, modified_time=0):
+        """
+        Returns an ImageWrapper for image data that has been retrieved or
+        generated for image_attrs, with the image's modification time and the
+        handling options from its template. Raises an ImageError instead if
+        the image data is a (cached) image generation error. For an image that
+        is to be streamed from disk, image_data is None and the file path and
+        size are given instead. If the caller has already read the image's
+        modification time from cache, it can be given in modified_time.
+        """
+        # If there was an imaging error (just now or previously cached),
+        # raise the exception now
+        if self._is_image_error(image_data):
+            raise ImageError(self._get_image_error(image_data))
+
+        # v1.17 Get/set the image's last modification time
+        if not modified_time:
+            modified_time = self.get_image_modified_time(image_attrs)
+        if modified_time == 0:
+            modified_time = time.time()
+            self._cache_image_metadata(image_attrs, modified_time)
+
+        # Get default handling options from requested template or default template
+        template_attrs = self.get_image_template(image_attrs)
+        expiry_secs = default_value(template_attrs.expiry_secs(), ImageManager.DEFAULT_EXPIRY_SECS)
+        attachment = default_value(template_attrs.attachment(), False)
+        do_stats = default_value(template_attrs.record_stats(), True)
+
+        # Return the requested image
+        return ImageWrapper(
+            image_data,
+            image_attrs,
+            from_cache,
+            modified_time,
+            expiry_secs,
+            attachment,
+            do_stats,
+            file_path,
+            file_size
+        )
+
+    def _generate_image_variants(self, image_attrs_list, cache_result, cascade=False):
+        """
+        For get_image_variants(), generates several images from one read of
+        their original image file, returning a list of ImageWrapper objects,
+        None if the file could not be read, or an exception object for each
+        image that failed. The new images are added to cache together.
+        """
+        debug_mode = self._settings['DEBUG']
+        wait_timeout = min(max(self._settings['IMAGE_GENERATION_WAIT_TIMEOUT'], 10), 120)
+        locked_keys = []
+        try:
+            if cache_result:
+                # Notify other clients what we'll put in the cache, but only
+                # take over the locks that no other client already holds
+                for image_attrs in image_attrs_list:
+                    cache_key = image_attrs.get_cache_key()
+                    if self._set_image_lock(cache_key, wait_timeout):
+                        locked_keys.append(cache_key)
+
+            if debug_mode:
+                self._logger.debug(
+                    'Generating %d image variants from disk file %s' % (
+                        len(image_attrs_list), image_attrs_list[0].filename()
+                    )
+                )
+            file_data = get_file_data(image_attrs_list[0].filename())
+            if file_data is None:
+                # Disk file read failed
+                return [None] * len(image_attrs_list)
+            file_attrs = ImageAttrs(
+                image_attrs_list[0].filename(), image_attrs_list[0].database_id()
+            )
+
+            # Generate the new images
+            try:
+                images_data = self._adjust_image_multi(
+                    file_data, file_attrs, image_attrs_list, cascade
+                )
+            except ServerTooBusyError:
+                raise
+            except Exception:
+                # One of the images is invalid. Generate them separately so that
+                # the image error is only cached for the one that failed.
+                images_data = []
+                for image_attrs in image_attrs_list:
+                    try:
+                        images_data.append(self._adjust_image(file_data, file_attrs, image_attrs))
+                    except ImageError as e:
+                        images_data.append(ImageManager.IMAGE_ERROR_HEADER + str(e))
+
+            # Add them to cache for next time
+            if cache_result:
+                if self._cache_images(list(zip(images_data, image_attrs_list))):
+                    if debug_mode:
+                        self._logger.debug(
+                            'Added %d new images to cache for %s' % (
+                                len(image_attrs_list), image_attrs_list[0].filename()
+                            )
+                        )
+                else:
+                    self._logger.warning(
+                        'Failed to add new images to cache for ' + image_attrs_list[0].filename()
+                    )
+
+            results = []
+            for (image_attrs, image_data) in zip(image_attrs_list, images_data):
+                try:
+                    results.append(self._make_image_wrapper(image_data, image_attrs, False))
+                except Exception as e:
+                    results.append(e)
+            return results
+        finally:
+            # Tell anyone waiting they can now grab the cached images
+            for cache_key in locked_keys:
+                self._clear_image_lock(cache_key)
+
+    def _join_image_flight(self, image_key):
+        """
+        Registers the current thread's interest in generating the image with the
+        given unique key, returning a tuple of (future, is_leader). If is_leader
+        is True, the caller must generate the image and then call
+        _end_image_flight(). Otherwise another thread in this process is already
+        generating the image, and the caller should wait for the future's result.
+        This is the raw image data, which might not have been added to cache,
+        or None if the image could not be read.
+        """
+        with self._flights_lock:
+            flight = self._flights.get(image_key)
+            if flight is not None:
+                return flight, False
+            flight = futures.Future()
+            self._flights[image_key] = flight
+            return flight, True
+
+    def _end_image_flight(self, image_key, flight, image_data, error=None):
+        """
+        Releases all threads waiting on a future from _join_image_flight(),
+        giving them either the raw image data or the exception that occurred.
+        """
+        with self._flights_lock:
+            if self._flights.get(image_key) is flight:
+                del self._flights[image_key]
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(image_data)
+
+    def _wait_for_image_lock(self, image_key, timeout_secs):
+        """
+        Waits for the image lock with the given unique key to be cleared,
+        typically by another process. The lock is checked after a short delay
+        that doubles on each check, so that quick image generations are noticed
+        quickly without making many cache calls during slow ones.
+        Returns whether the lock was cleared within timeout_secs.
+        """
+        wait_until = time.time() + timeout_secs
+        delay = ImageManager.IMAGE_LOCK_CHECK_MIN
+        while self._is_image_lock(image_key):
+            remaining = wait_until - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, ImageManager.IMAGE_LOCK_CHECK_MAX)
+        return True
+
+    def _image_wait_timed_out(self, image_attrs):
+        """
+        Logs a warning that an image was not generated while waiting for it,
+        then raises a ServerTooBusyError if this is enabled in the settings.
+        """
+        self._logger.warning('Timed out waiting for ' + str(image_attrs))
+        if (
+            self._settings['IMAGE_GENERATION_RAISE_TOO_BUSY'] and
+            not self._settings['BENCHMARKING']
+        ):
+            # We might have 10 (100!) requests queued up waiting, so an
+            # error now is preferable to letting them all go through
+            raise ServerTooBusyError()
+
     def _is_image_lock(self, image_key):
         """
         Returns whether there is an image lock currently in place for the given key.
@@ -792,7 +1413,8 @@ class ImageManager(object):
             searchfield1__eq=image_id,
             searchfield2__eq=format_hash,
             searchfield3__gte=[target_attrs.width(), None],
-            searchfield4__gte=[target_attrs.height(), None]
+            searchfield4__gte=[target_attrs.height(), None],
+            searchfield5__eq=target_attrs.generation() or None
         )
         # Loop through the results and see if any would work for us
         for result in base_candidates:
@@ -808,6 +1430,9 @@ class ImageManager(object):
                         continue
                     # Success
                     return ImageWrapper(base_data, result_attrs, True)
+            elif base_err == 21:
+                # The image has since been invalidated, tidy up
+                self._cache.delete(result_key)
             elif self._settings['DEBUG']:
                 self._logger.debug(
                     'Base image candidate ' + str(result_attrs) +
@@ -815,15 +1440,23 @@ class ImageManager(object):
                 )
         return None
 
-    def _cache_image_metadata(self, image_attrs, modified_time):
+    def _cache_image_metadata(self, image_attrs, modified_time, data_size=0, quality=0):
         """
         As a partner to _cache_image(), adds additional image metadata to cache.
-        Currently the only metadata field is last modification time.
-        """
+        The metadata fields are last modification time and, if known, the size
+        of the cached image data, which allows a large image to be fetched from
+        cache in one call (see CacheManager.get_fused()), and the quality value
+        that was found to meet the image's max_bytes attribute.
+        """
+        metadata = {'modified': modified_time}
+        if data_size:
+            metadata['size'] = data_size
+        if quality:
+            metadata['quality'] = quality
         ok = self._cache.raw_put(
-            image_attrs.get_metadata_cache_key(), {
-                'modified': modified_time
-            }
+            image_attrs.get_metadata_cache_key(),
+            metadata,
+            local_cache=True
         )
         if not ok:
             self._logger.warning(
@@ -837,11 +1470,95 @@ class ImageManager(object):
             )
         return ok
 
-    def _cache_image(self, image_data, image_attrs):
+    def _admit_to_cache(self, image_key, image_data, gen_secs):
+        """
+        When IMAGE_CACHE_ADMISSION is enabled, returns whether a newly generated
+        image (that took gen_secs to generate) should be added to cache.
+
+        Memcached does not tell us which image it would eject to make room for
+        the new one, but its least recently used image has, by definition, not
+        been requested recently. So when the cache is nearly full, the new image
+        is admitted only if it has been requested at least
+        CACHE_ADMISSION_MIN_FREQUENCY times recently, if it was expensive to
+        generate, or if it is an image error. This prevents one-off requests
+        from ejecting popular images from the cache.
+
+        Returns True if IMAGE_CACHE_ADMISSION is disabled.
+        """
+        if self._admission_sketch is None:
+            return True
+        min_frequency = ImageManager.CACHE_ADMISSION_MIN_FREQUENCY
+        admit = (
+            gen_secs >= self._settings['IMAGE_CACHE_ADMISSION_MIN_SECS'] or
+            self._is_image_error(image_data) or
+            not self._is_cache_nearly_full() or
+            self._admission_sketch.frequency(image_key) >= min_frequency
+        )
+        self._admission_counts['admitted' if admit else 'rejected'] += 1
+        return admit
+
+    def _is_cache_nearly_full(self):
+        """
+        Returns whether the cache usage is at least CACHE_ADMISSION_MIN_PERCENT,
+        checking this at most every CACHE_ADMISSION_CHECK_SECS seconds.
+        """
+        (checked_time, is_full) = self._admission_cache_full
+        if checked_time < time.time() - ImageManager.CACHE_ADMISSION_CHECK_SECS:
+            is_full = self._cache.size_percent() >= ImageManager.CACHE_ADMISSION_MIN_PERCENT
+            self._admission_cache_full = (time.time(), is_full)
+        return is_full
+
+    def _cache_image(self, image_data, image_attrs, quality=0):
         """
         Adds image data and its associated attributes and search keys to cache.
+        If the image was generated to meet a max_bytes attribute, quality is the
+        quality value that was used, to be stored in the image's metadata.
         Returns a boolean indicating success.
         """
+        ok = self._cache.put(
+            image_attrs.get_cache_key(),
+            image_data,
+            search_info=self._get_cache_search_info(image_attrs)
+        )
+        if ok and (len(image_data) > MAX_SLOT_SIZE or quality):
+            # Record the size of images stored in multiple chunks,
+            # and the quality found for a max_bytes attribute
+            image_metadata = self._cache.raw_get(
+                image_attrs.get_metadata_cache_key(), local_cache=True
+            )
+            self._cache_image_metadata(
+                image_attrs,
+                image_metadata['modified'] if image_metadata else time.time(),
+                len(image_data) if len(image_data) > MAX_SLOT_SIZE else 0,
+                quality
+            )
+        return ok
+
+    def _cache_images(self, images):
+        """
+        As for _cache_image(), but adds a list of (image data, image attributes)
+        tuples to cache, with the smaller images all added in one call to the cache.
+        Returns a boolean indicating whether all the images were cached.
+        """
+        ok = True
+        small_images = {}
+        search_infos = {}
+        for (image_data, image_attrs) in images:
+            if len(image_data) > MAX_SLOT_SIZE:
+                ok = self._cache_image(image_data, image_attrs) and ok
+            else:
+                cache_key = image_attrs.get_cache_key()
+                small_images[cache_key] = image_data
+                search_infos[cache_key] = self._get_cache_search_info(image_attrs)
+        if small_images:
+            ok = self._cache.putn(small_images, search_infos=search_infos) and ok
+        return ok
+
+    def _get_cache_search_info(self, image_attrs):
+        """
+        Returns the search_info dictionary (see CacheManager.put()) that allows
+        an image to be found later as a base image by _get_base_image().
+        """
         image_id = image_attrs.database_id()
         assert image_id > 0, 'Image database ID must be set to cache images'
         format_hash = self._get_attrs_hash(
@@ -849,19 +1566,14 @@ class ImageManager(object):
             image_attrs.fill(),
             image_attrs.tile_spec()
         )
-        search_info = {
+        return {
             'searchfield1': image_id,
             'searchfield2': format_hash,
             'searchfield3': image_attrs.width(),
             'searchfield4': image_attrs.height(),
-            'searchfield5': None,
+            'searchfield5': image_attrs.generation() or None,
             'metadata': image_attrs
         }
-        return self._cache.put(
-            image_attrs.get_cache_key(),
-            image_data,
-            search_info=search_info
-        )
 
     def _uncache_image(self, image_attrs, uncache_variants=True):
         """
@@ -882,23 +1594,150 @@ class ImageManager(object):
         """
         Deletes cache entries associated with an image ID,
         including all variants of the image in any file format.
-        """
+
+        When IMAGE_CACHE_GENERATIONS is enabled, this instead increments the
+        image's generation number, so that its cache keys change and the old
+        cache entries are no longer used.
+        """
+        # Remove the image variants from this process's local cache,
+        # including any that the search below does not find
+        self._cache.local_delete_prefix('IMG:' + str(image_id), ',')
+        self._cache.local_delete_prefix('IMG_MD:' + str(image_id), ',')
+        if self._settings['IMAGE_CACHE_GENERATIONS']:
+            if self._cache.raw_incr(
+                ImageManager.IMAGE_GENERATION_KEY + str(image_id),
+                self._new_generation()
+            ) is not None:
+                # The old entries are no longer used, but are still taking up
+                # space in the cache control database and disk cache
+                self._tasks.add_task(
+                    None,
+                    'Uncache old generations of image %d' % image_id,
+                    'uncache_image_generations',
+                    {'image_id': image_id},
+                    Task.PRIORITY_NORMAL,
+                    'debug',
+                    'warn'
+                )
+                return
+            self._logger.warning(
+                'Failed to increment the cache generation for image ID %d' % image_id
+            )
+        self._cache.raw_delete(ImageManager.DZI_SIZE_KEY + str(image_id))
         matches = self._cache.search(searchfield1__eq=image_id)
         for match in matches:
-            match_image_key = match['key']
             match_attrs = match['metadata']
-            # Delete the cached image and its search keys
-            self._cache.delete(match_image_key)
-            # v1.17 Also delete any cached metadata
-            self._cache.raw_delete(match_attrs.get_metadata_cache_key())
-            # Delete any associated lock flags, etc
-            self._cache.raw_delete('LOCK_' + match_image_key)
-            self._cache.raw_delete('TILE_BASE_' + match_image_key)
+            self._uncache_entry(match)
             pyr_key = 'PYRAMID_IMG:' + str(image_id)
             if match_attrs.format():
                 pyr_key += ',F' + match_attrs.format()
             self._cache.raw_delete(pyr_key)
 
+    def _uncache_image_generations(self, image_id):
+        """
+        When IMAGE_CACHE_GENERATIONS is enabled, deletes the cache entries
+        associated with an image ID that are from previous generations of the
+        image, and so can no longer be used.
+        """
+        matches = self._cache.search(searchfield1__eq=image_id)
+        current_generation = None
+        for match in matches:
+            match_attrs = match['metadata']
+            if current_generation is None:
+                current_attrs = ImageAttrs(match_attrs.filename(), image_id)
+                self._set_image_generations([current_attrs])
+                current_generation = current_attrs.generation()
+            if match_attrs.generation() != current_generation:
+                self._uncache_entry(match)
+
+    def _uncache_entry(self, match):
+        """
+        Deletes a cached image, as returned by a cache search, along with
+        its cached metadata and associated flags.
+        """
+        match_image_key = match['key']
+        match_attrs = match['metadata']
+        # Delete the cached image and its search keys
+        self._cache.delete(match_image_key)
+        # v1.17 Also delete any cached metadata
+        self._cache.raw_delete(match_attrs.get_metadata_cache_key())
+        # Delete any associated lock flags, etc
+        self._cache.raw_delete('LOCK_' + match_image_key)
+        self._cache.raw_delete('TILE_BASE_' + match_image_key)
+
+    def _uncache_folder(self, folder_path):
+        """
+        When IMAGE_CACHE_GENERATIONS is enabled, increments the generation
+        number of a folder, so that the cache keys of all images in the folder
+        and its sub-folders change and their old cache entries are no longer used.
+        Returns whether this was successful. Returns False without action
+        if IMAGE_CACHE_GENERATIONS is disabled.
+        """
+        if not self._settings['IMAGE_CACHE_GENERATIONS']:
+            return False
+        return self._cache.raw_incr(
+            self._get_folder_generation_key(folder_path),
+            self._new_generation()
+        ) is not None
+
+    def _set_image_generations(self, image_attrs_list):
+        """
+        When IMAGE_CACHE_GENERATIONS is enabled, sets the cache generation number
+        in each of the image attributes that has a database ID, from the current
+        generation numbers of the image and of its folder and parent folders.
+        The generation numbers for all the images are read in one cache call.
+        """
+        if not self._settings['IMAGE_CACHE_GENERATIONS']:
+            return
+        attrs_keys = []
+        for image_attrs in image_attrs_list:
+            if image_attrs.database_id() > 0 and not image_attrs.generation():
+                gen_keys = [ImageManager.IMAGE_GENERATION_KEY + str(image_attrs.database_id())]
+                folder_path = ''
+                gen_keys.append(self._get_folder_generation_key(folder_path))
+                for folder_name in strip_seps(image_attrs.folder_path()).split(os.path.sep):
+                    if folder_name:
+                        folder_path += os.path.sep + folder_name
+                        gen_keys.append(self._get_folder_generation_key(folder_path))
+                attrs_keys.append((image_attrs, gen_keys))
+        if not attrs_keys:
+            return
+
+        generations = self._cache.raw_getn(list(set(
+            k for (_, gen_keys) in attrs_keys for k in gen_keys
+        )))
+        for (image_attrs, gen_keys) in attrs_keys:
+            gen_total = 0
+            for gen_key in gen_keys:
+                gen = generations.get(gen_key)
+                if gen is None:
+                    # Start a new (or evicted) generation number
+                    gen = self._new_generation()
+                    if not self._cache.raw_atomic_add(gen_key, gen):
+                        gen = self._cache.raw_get(gen_key) or gen
+                    generations[gen_key] = gen
+                gen_total += int(gen)
+            # Since every generation number only ever goes up, the total changes
+            # (and never returns to a previous value) when any of them changes
+            image_attrs.set_generation(gen_total)
+
+    def _get_folder_generation_key(self, folder_path):
+        """
+        Returns the cache key for the generation number of a folder path.
+        """
+        folder_path = strip_seps(filepath_normalize(folder_path))
+        return ImageManager.FOLDER_GENERATION_KEY + str(
+            zlib.crc32(folder_path.encode('utf8'))
+        )
+
+    def _new_generation(self):
+        """
+        Returns the starting value for a new generation number. This is based on
+        the current time, so that if a generation number is lost from cache,
+        the new value will always be higher than the old one.
+        """
+        return int(time.time() * 1000)
+
     def _get_tile_base_image(self, image_attrs):
         """
         Generates and caches the base image required for an image tile.
@@ -944,7 +1783,9 @@ class ImageManager(object):
         # Generate the base image
         try:
             self._logger.debug('Performing tile base generation for ' + str(image_attrs))
-            base_img_wrapper = self.get_image(base_image_attrs, cache_result=True)
+            base_img_wrapper = self.get_image(
+                base_image_attrs, cache_result=True, _always_cache=True
+            )
             self._logger.debug('Tile base generation completed for ' + str(image_attrs))
             return base_img_wrapper
         except ImageError as e:
@@ -957,6 +1798,208 @@ class ImageManager(object):
             # though - as noted above this is really only a defensive measure.
             self._cache.raw_put(gen_flag, 'DONE', expiry_secs=600)
 
+    def _get_dzi_max_image_level(self, levels):
+        """
+        Returns the highest level of a Deep Zoom (DZI) tile pyramid, where levels
+        is the list from get_dzi_levels(), for which _get_dzi_level_image() is
+        used. This is the level below the full size image, or lower if that
+        level is larger than the MAX_IMAGE_DIMENSION setting. Returns -1 if
+        there is no such level.
+        """
+        max_size = self._settings['MAX_IMAGE_DIMENSION']
+        level = len(levels) - 2
+        while level >= 0 and max(levels[level]) > max_size:
+            level -= 1
+        return level
+
+    def _get_dzi_level_image(self, image_attrs, levels, level, max_image_level):
+        """
+        Generates and caches the full image at a level of a Deep Zoom (DZI)
+        tile pyramid, as the base image for the tiles at that level, where
+        levels is the list from get_dzi_levels() and max_image_level is the
+        value from _get_dzi_max_image_level().
+
+        As for create_image_pyramid(), the level images specify their width only,
+        so that they are found by _get_base_image() for the next level down.
+        Before a level image is generated, the level above is first generated if
+        it is not in cache, so that each level is made by halving the one above.
+        The image at max_image_level is made from the original image.
+
+        Returns an ImageWrapper containing the level image, or None if the image
+        could not be read.
+        """
+        level_attrs = ImageAttrs(
+            image_attrs.filename(),
+            image_attrs.database_id(),
+            page=image_attrs.page(),
+            iformat=image_attrs.format(),
+            width=levels[level][0],
+            strip=False,
+            dpi=0
+        )
+        self.finalise_image_attrs(level_attrs)
+        self._set_image_generations([level_attrs])
+        if level < max_image_level and self._cache.raw_get(
+            level_attrs.get_metadata_cache_key(), local_cache=True
+        ) is None:
+            self._get_dzi_level_image(image_attrs, levels, level + 1, max_image_level)
+        return self.get_image(level_attrs, cache_result=True, _always_cache=True)
+
+    def _get_dzi_tile_attrs(self, image_attrs, levels, level, column, row):
+        """
+        Returns a tuple of the finalised image attributes for a tile of a Deep Zoom
+        (DZI) tile pyramid, where levels is the list from get_dzi_levels(), and the
+        tile's (top, left, bottom, right) cropping values at full precision.
+
+        The tile is the crop of the level image at pixel positions. The cropping
+        values in the image attributes are rounded to a few decimal places, which
+        for the largest images is not enough to select each pixel exactly, so the
+        full precision values should be used when generating the tile.
+        """
+        (level_width, level_height) = levels[level]
+        tile_size = ImageManager.DZI_TILE_SIZE
+        overlap = ImageManager.DZI_TILE_OVERLAP
+        left = max(column * tile_size - overlap, 0)
+        top = max(row * tile_size - overlap, 0)
+        right = min((column + 1) * tile_size + overlap, level_width)
+        bottom = min((row + 1) * tile_size + overlap, level_height)
+
+        # Offset the crop values a little from each pixel edge so that
+        # they still select it after rounding
+        def crop_value(px, length):
+            return 0.0 if px == 0 else 1.0 if px == length else (px - 0.25) / length
+
+        tile_crop = (
+            crop_value(top, level_height),
+            crop_value(left, level_width),
+            crop_value(bottom, level_height),
+            crop_value(right, level_width)
+        )
+        tile_attrs = ImageAttrs(
+            image_attrs.filename(),
+            image_attrs.database_id(),
+            page=image_attrs.page(),
+            iformat=image_attrs.format(),
+            width=right - left,
+            height=bottom - top,
+            top=tile_crop[0],
+            left=tile_crop[1],
+            bottom=tile_crop[2],
+            right=tile_crop[3],
+            strip=False,
+            dpi=0
+        )
+        self.finalise_image_attrs(tile_attrs)
+        return (tile_attrs, tile_crop)
+
+    def _lock_dzi_tile_block(self, image_attrs, levels, level, column, row, lock_timeout):
+        """
+        For a tile of a Deep Zoom (DZI) tile pyramid that is to be cut from the
+        original image, sets the image lock for the other tiles in the same block
+        of DZI_TILE_BLOCK tiles across and down, so that requests for them wait
+        for this instead of generating them again. Tiles that are already cached
+        or that another client is already generating are skipped.
+
+        Returns a dictionary of the lock keys that were set, with values of the
+        tuple from _get_dzi_tile_attrs() for each tile. The caller must delete
+        the lock keys after generating the tiles.
+        """
+        (level_width, level_height) = levels[level]
+        tile_size = ImageManager.DZI_TILE_SIZE
+        block_size = ImageManager.DZI_TILE_BLOCK
+        first_column = column - (column % block_size)
+        first_row = row - (row % block_size)
+        other_tiles = []
+        for other_column in range(first_column, first_column + block_size):
+            for other_row in range(first_row, first_row + block_size):
+                if (other_column * tile_size < level_width and
+                        other_row * tile_size < level_height and
+                        (other_column, other_row) != (column, row)):
+                    other_tiles.append(self._get_dzi_tile_attrs(
+                        image_attrs, levels, level, other_column, other_row
+                    ))
+        if not other_tiles:
+            return {}
+        self._set_image_generations([ia for (ia, _) in other_tiles])
+        cached_tiles = self._cache.getn([ia.get_cache_key() for (ia, _) in other_tiles])
+        other_tiles = dict(
+            ('LOCK_' + ia.get_cache_key(), (ia, tile_crop))
+            for (ia, tile_crop) in other_tiles
+            if ia.get_cache_key() not in cached_tiles
+        )
+        # Set the image locks in one call to the cache
+        lock_keys = self._cache.raw_atomic_addn(
+            dict((lock_key, 'LOCK') for lock_key in other_tiles), lock_timeout
+        )
+        return dict((lock_key, other_tiles[lock_key]) for lock_key in lock_keys)
+
+    def _generate_dzi_tile_block(self, base_image, tile_attrs, tile_crop, other_tiles):
+        """
+        Generates a tile of a Deep Zoom (DZI) tile pyramid from the original image,
+        along with a list of other tiles from the same image level, each given as
+        the tuple from _get_dzi_tile_attrs(), from a single decode of the original.
+        The other tiles are added to cache together and the raw image data for the
+        requested tile is returned. On error creating the tiles, an ImageError is
+        raised.
+        """
+        tiles_data = self._adjust_image_multi(
+            base_image.data(),
+            base_image.attrs(),
+            [tile_attrs] + [ia for (ia, _) in other_tiles],
+            crops=[tile_crop] + [crop for (_, crop) in other_tiles]
+        )
+        if other_tiles and not self._cache_images(
+            list(zip(tiles_data[1:], [ia for (ia, _) in other_tiles]))
+        ):
+            self._logger.warning('Failed to add image tiles to cache for ' + str(tile_attrs))
+        elif self._settings['DEBUG']:
+            self._logger.debug(
+                'Added %d other image tiles to cache for %s' % (
+                    len(other_tiles), str(tile_attrs)
+                )
+            )
+        return tiles_data[0]
+
+    def _generate_tile_grid(self, base_image, image_attrs, lock_timeout):
+        """
+        For IMAGE_TILE_GRIDS, generates the requested image tile from the base
+        image (the non-tiled image) along with all the other tiles in the same
+        grid, from a single decode of the base image. The other tiles are added
+        to cache together and the raw image data for the requested tile is
+        returned. The image lock is set for the other tiles while they are
+        generated, so that requests for them wait for this instead of generating
+        them again, and tiles that another client is already generating are
+        skipped. On error creating the tiles, an ImageError is raised.
+        """
+        (tile_number, grid_size) = image_attrs.tile_spec()
+        other_tiles = {}
+        for other_number in range(1, grid_size + 1):
+            if other_number != tile_number:
+                tile_attrs = copy.copy(image_attrs)
+                tile_attrs._tile = (other_number, grid_size)
+                other_tiles['LOCK_' + tile_attrs.get_cache_key()] = tile_attrs
+        # Set the image locks for the other tiles in one call to the cache
+        lock_keys = self._cache.raw_atomic_addn(
+            dict((lock_key, 'LOCK') for lock_key in other_tiles), lock_timeout
+        )
+        gen_tiles = [other_tiles[lock_key] for lock_key in lock_keys]
+        try:
+            tiles_data = self._adjust_image_multi(
+                base_image.data(), base_image.attrs(), [image_attrs] + gen_tiles
+            )
+            if gen_tiles and not self._cache_images(list(zip(tiles_data[1:], gen_tiles))):
+                self._logger.warning('Failed to add image tiles to cache for ' + str(image_attrs))
+            elif self._settings['DEBUG']:
+                self._logger.debug(
+                    'Added %d other image tiles to cache for %s' % (
+                        len(gen_tiles), str(image_attrs)
+                    )
+                )
+            return tiles_data[0]
+        finally:
+            if lock_keys:
+                self._cache.raw_deleten(lock_keys)
+
     def _auto_pyramid_image(self, original_data, original_type, image_attrs):
         """
         Checks the supplied image, and if it exceeds a certain size, meets
@@ -1013,6 +2056,8 @@ class ImageManager(object):
         lock_flag = 'PYRAMID_IMG:' + str(image_attrs.database_id())
         if image_attrs.format():
             lock_flag += ',F' + image_attrs.format()
+        if image_attrs.generation():
+            lock_flag += ',U' + str(image_attrs.generation())
         # atomic_add side effect in the "if" ... sorry!
         if (self._cache.raw_get(lock_flag) is not None or
             not self._cache.raw_atomic_add(lock_flag, 'DONE')
@@ -1054,156 +2099,225 @@ class ImageManager(object):
         """
         # See if the requested image attributes require altering the base image
         if new_image_attrs.attributes_change_image():
-
-            # Set the final image attributes
-            iformat = new_image_attrs.format()
-            page = default_value(new_image_attrs.page(), 1)
-            width = default_value(new_image_attrs.width(), 0)
-            height = default_value(new_image_attrs.height(), 0)
-            align_h = new_image_attrs.align_h()
-            align_v = new_image_attrs.align_v()
-            rotation = default_value(new_image_attrs.rotation(), 0.0)
-            flip = new_image_attrs.flip()
-            top = default_value(new_image_attrs.top(), 0.0)
-            left = default_value(new_image_attrs.left(), 0.0)
-            bottom = default_value(new_image_attrs.bottom(), 1.0)
-            right = default_value(new_image_attrs.right(), 1.0)
-            autocropfit = default_value(new_image_attrs.crop_fit(), False)
-            autosizefit = default_value(new_image_attrs.size_fit(), False)
-            fill = default_value(new_image_attrs.fill(), '#ffffff')
-            cquality = default_value(new_image_attrs.quality(), 0)
-            sharpen = default_value(new_image_attrs.sharpen(), 0)
-            overlay_src = new_image_attrs.overlay_src()
-            overlay_size = default_value(new_image_attrs.overlay_size(), 1.0)
-            overlay_pos = new_image_attrs.overlay_pos()
-            overlay_opacity = default_value(new_image_attrs.overlay_opacity(), 1.0)
-            icc_profile_name = new_image_attrs.icc_profile()
-            icc_profile_intent = new_image_attrs.icc_intent()
-            icc_profile_bpc = new_image_attrs.icc_bpc()
-            colorspace = new_image_attrs.colorspace()
-            dpi = default_value(new_image_attrs.dpi(), 0)
-            strip_info = default_value(new_image_attrs.strip_info(), False)
-            tile_spec = default_value(new_image_attrs.tile_spec(), (0, 0))
-
-            # Mandatory image attributes: a couple of things must have a value,
-            # so we need to set them here if they're not already set. These are
-            # special cases - note that setting them here means that these values
-            # do not go into the cache key! This is only OK for things that do
-            # not change the actual image pixels.
-            #
-            # compression value must always be set to something
-            if cquality == 0:
-                cquality = (
-                    ImageManager.DEFAULT_QUALITY_PNG if iformat == 'png'
-                    else ImageManager.DEFAULT_QUALITY_JPG
-                )
-            # when converting from PDF we must set a DPI
-            if dpi == 0 and base_image_attrs.src_is_pdf():
-                dpi = self._settings['PDF_BURST_DPI']
-
-            # Now, if the base image is already rotated, cropped, sharpened etc,
-            # do not re-apply the same adjustment. These checks rely heavily on
-            # the behaviour of ImageAttrs.suitable_for_base()
-            if base_image_attrs.page() is not None and \
-               base_image_attrs.page() == page:
-                page = 1
-            if base_image_attrs.rotation() is not None and \
-               base_image_attrs.rotation() == rotation:
-                rotation = 0
-            if base_image_attrs.flip() is not None and \
-               base_image_attrs.flip() == flip:
-                flip = None
-            if base_image_attrs.top() is not None and \
-               base_image_attrs.top() == top:
-                top = 0.0
-            if base_image_attrs.left() is not None and \
-               base_image_attrs.left() == left:
-                left = 0.0
-            if base_image_attrs.bottom() is not None and \
-               base_image_attrs.bottom() == bottom:
-                bottom = 1.0
-            if base_image_attrs.right() is not None and \
-               base_image_attrs.right() == right:
-                right = 1.0
-            if base_image_attrs.crop_fit() and autocropfit:
-                autocropfit = False
-            if base_image_attrs.sharpen() is not None and \
-               base_image_attrs.sharpen() == sharpen:
-                sharpen = 0
-            if base_image_attrs.overlay_src() is not None and \
-               base_image_attrs.overlay_src() == overlay_src:
-                overlay_src = None
-                overlay_size = 0.0
-            if base_image_attrs.icc_profile() is not None and \
-               base_image_attrs.icc_profile() == icc_profile_name and \
-               base_image_attrs.icc_intent() == icc_profile_intent and \
-               default_value(base_image_attrs.icc_bpc(), False) == icc_profile_bpc:
-                icc_profile_name = None
-                icc_profile_intent = None
-                icc_profile_bpc = None
-            if base_image_attrs.tile_spec() is not None and \
-               base_image_attrs.tile_spec() == tile_spec:
-                tile_spec = (0, 0)
-                rotation = 0
-                top = left = 0.0
-                bottom = right = 1.0
-
-            # Get the overlay image data, if required
-            overlay_image_data = None
-            if overlay_src:
-                overlay_image_data = get_file_data(overlay_src)
-                if overlay_image_data is None:
-                    raise DoesNotExistError('Overlay file \'' + overlay_src + '\' was not found')
-
-            # Get ICC profile data, if required
-            icc_profile_data = self._icc_profiles[icc_profile_name][1] if icc_profile_name else None
-
-            # Finally, generate a new image from base_image_data
-            image_ops = {
-                'page': page,
-                'width': width,
-                'height': height,
-                'size_fit': autosizefit,
-                'align_h': align_h,
-                'align_v': align_v,
-                'rotation': rotation,
-                'flip': flip,
-                'sharpen': sharpen,
-                'dpi_x': dpi,
-                'dpi_y': dpi,
-                'fill': fill,
-                'top': top,
-                'left': left,
-                'bottom': bottom,
-                'right': right,
-                'crop_fit': autocropfit,
-                'overlay_data': overlay_image_data,
-                'overlay_size': overlay_size,
-                'overlay_pos': overlay_pos,
-                'overlay_opacity': overlay_opacity,
-                'icc_data': icc_profile_data,
-                'icc_intent': icc_profile_intent,
-                'icc_bpc': icc_profile_bpc,
-                'tile': tile_spec,
-                'colorspace': colorspace,
-                'format': iformat,
-                'quality': cquality,
-                'resize_type': self._settings['IMAGE_RESIZE_QUALITY'],
-                'resize_gamma': self._settings['IMAGE_RESIZE_GAMMA_CORRECT'],
-                'strip': strip_info
-            }
+            image_ops = self._get_image_ops(base_image_attrs, new_image_attrs)
             try:
                 return imaging.adjust_image(
                     base_image_data,
                     base_image_attrs.format(),
                     image_ops
                 )
+            except ServerTooBusyError:
+                # Not an image error, do not cache it
+                raise
             except Exception as e:
                 raise ImageError(str(e)) if not self._settings['DEBUG'] else e
         else:
             # There are no attributes to change
             return base_image_data
 
+    def _adjust_image_max_bytes(self, base_image_data, base_image_attrs, new_image_attrs,
+                                quality_hint=0):
+        """
+        As for _adjust_image(), for new image attributes that specify a max_bytes
+        value, but returns a tuple of the raw image data and the quality value
+        that was used to meet max_bytes. The quality_hint is the quality value
+        returned previously for the same image attributes, if known, or 0.
+        """
+        image_ops = self._get_image_ops(base_image_attrs, new_image_attrs)
+        try:
+            return imaging.adjust_image_max_bytes(
+                base_image_data,
+                base_image_attrs.format(),
+                image_ops,
+                quality_hint
+            )
+        except ServerTooBusyError:
+            # Not an image error, do not cache it
+            raise
+        except Exception as e:
+            raise ImageError(str(e)) if not self._settings['DEBUG'] else e
+
+    def _adjust_image_multi(self, base_image_data, base_image_attrs, new_image_attrs_list,
+                            cascade=False, crops=None):
+        """
+        Returns a list of raw image data, as for _adjust_image() but applying
+        each of a list of new image attributes to the same base image. Every
+        item in new_image_attrs_list must specify some change to the image.
+        If cascade is True, uses imaging.adjust_image_cascade() instead of
+        imaging.adjust_image_multi(). If crops is given, it is a list of
+        (top, left, bottom, right) cropping values for each of the new image
+        attributes, to use instead of the attributes' own rounded values.
+        On error creating any of the new images, an ImageError is raised.
+        """
+        images_ops = [
+            self._get_image_ops(base_image_attrs, new_image_attrs)
+            for new_image_attrs in new_image_attrs_list
+        ]
+        if crops is not None:
+            for (image_ops, crop) in zip(images_ops, crops):
+                (image_ops['top'], image_ops['left'],
+                 image_ops['bottom'], image_ops['right']) = crop
+        adjust_fn = imaging.adjust_image_cascade if cascade else imaging.adjust_image_multi
+        try:
+            return adjust_fn(
+                base_image_data,
+                base_image_attrs.format(),
+                images_ops
+            )
+        except ServerTooBusyError:
+            # Not an image error, do not cache it
+            raise
+        except Exception as e:
+            raise ImageError(str(e)) if not self._settings['DEBUG'] else e
+
+    def _get_image_ops(self, base_image_attrs, new_image_attrs):
+        """
+        Returns the imaging operations dictionary for imaging.adjust_image()
+        that will transform the supplied base image attributes into the new
+        image attributes. Raises a DoesNotExistError if an overlay image
+        is required but its file cannot be found.
+        """
+        # Set the final image attributes
+        iformat = new_image_attrs.format()
+        page = default_value(new_image_attrs.page(), 1)
+        width = default_value(new_image_attrs.width(), 0)
+        height = default_value(new_image_attrs.height(), 0)
+        align_h = new_image_attrs.align_h()
+        align_v = new_image_attrs.align_v()
+        rotation = default_value(new_image_attrs.rotation(), 0.0)
+        flip = new_image_attrs.flip()
+        top = default_value(new_image_attrs.top(), 0.0)
+        left = default_value(new_image_attrs.left(), 0.0)
+        bottom = default_value(new_image_attrs.bottom(), 1.0)
+        right = default_value(new_image_attrs.right(), 1.0)
+        autocropfit = default_value(new_image_attrs.crop_fit(), False)
+        autosizefit = default_value(new_image_attrs.size_fit(), False)
+        fill = default_value(new_image_attrs.fill(), '#ffffff')
+        cquality = default_value(new_image_attrs.quality(), 0)
+        max_bytes = default_value(new_image_attrs.max_bytes(), 0)
+        sharpen = default_value(new_image_attrs.sharpen(), 0)
+        overlay_src = new_image_attrs.overlay_src()
+        overlay_size = default_value(new_image_attrs.overlay_size(), 1.0)
+        overlay_pos = new_image_attrs.overlay_pos()
+        overlay_opacity = default_value(new_image_attrs.overlay_opacity(), 1.0)
+        icc_profile_name = new_image_attrs.icc_profile()
+        icc_profile_intent = new_image_attrs.icc_intent()
+        icc_profile_bpc = new_image_attrs.icc_bpc()
+        colorspace = new_image_attrs.colorspace()
+        dpi = default_value(new_image_attrs.dpi(), 0)
+        strip_info = default_value(new_image_attrs.strip_info(), False)
+        tile_spec = default_value(new_image_attrs.tile_spec(), (0, 0))
+
+        # Mandatory image attributes: a couple of things must have a value,
+        # so we need to set them here if they're not already set. These are
+        # special cases - note that setting them here means that these values
+        # do not go into the cache key! This is only OK for things that do
+        # not change the actual image pixels.
+        #
+        # compression value must always be set to something
+        if cquality == 0:
+            cquality = (
+                ImageManager.DEFAULT_QUALITY_PNG if iformat == 'png'
+                else ImageManager.DEFAULT_QUALITY_JPG
+            )
+        # when converting from PDF we must set a DPI
+        if dpi == 0 and base_image_attrs.src_is_pdf():
+            dpi = self._settings['PDF_BURST_DPI']
+
+        # Now, if the base image is already rotated, cropped, sharpened etc,
+        # do not re-apply the same adjustment. These checks rely heavily on
+        # the behaviour of ImageAttrs.suitable_for_base()
+        if base_image_attrs.page() is not None and \
+           base_image_attrs.page() == page:
+            page = 1
+        if base_image_attrs.rotation() is not None and \
+           base_image_attrs.rotation() == rotation:
+            rotation = 0
+        if base_image_attrs.flip() is not None and \
+           base_image_attrs.flip() == flip:
+            flip = None
+        if base_image_attrs.top() is not None and \
+           base_image_attrs.top() == top:
+            top = 0.0
+        if base_image_attrs.left() is not None and \
+           base_image_attrs.left() == left:
+            left = 0.0
+        if base_image_attrs.bottom() is not None and \
+           base_image_attrs.bottom() == bottom:
+            bottom = 1.0
+        if base_image_attrs.right() is not None and \
+           base_image_attrs.right() == right:
+            right = 1.0
+        if base_image_attrs.crop_fit() and autocropfit:
+            autocropfit = False
+        if base_image_attrs.sharpen() is not None and \
+           base_image_attrs.sharpen() == sharpen:
+            sharpen = 0
+        if base_image_attrs.overlay_src() is not None and \
+           base_image_attrs.overlay_src() == overlay_src:
+            overlay_src = None
+            overlay_size = 0.0
+        if base_image_attrs.icc_profile() is not None and \
+           base_image_attrs.icc_profile() == icc_profile_name and \
+           base_image_attrs.icc_intent() == icc_profile_intent and \
+           default_value(base_image_attrs.icc_bpc(), False) == icc_profile_bpc:
+            icc_profile_name = None
+            icc_profile_intent = None
+            icc_profile_bpc = None
+        if base_image_attrs.tile_spec() is not None and \
+           base_image_attrs.tile_spec() == tile_spec:
+            tile_spec = (0, 0)
+            rotation = 0
+            top = left = 0.0
+            bottom = right = 1.0
+
+        # Get the overlay image data, if required
+        overlay_image_data = None
+        if overlay_src:
+            overlay_image_data = get_file_data(overlay_src)
+            if overlay_image_data is None:
+                raise DoesNotExistError('Overlay file \'' + overlay_src + '\' was not found')
+
+        # Get ICC profile data, if required
+        icc_profile_data = self._icc_profiles[icc_profile_name][1] if icc_profile_name else None
+
+        # Finally, the operations to generate a new image from base_image_data
+        return {
+            'page': page,
+            'width': width,
+            'height': height,
+            'size_fit': autosizefit,
+            'align_h': align_h,
+            'align_v': align_v,
+            'rotation': rotation,
+            'flip': flip,
+            'sharpen': sharpen,
+            'dpi_x': dpi,
+            'dpi_y': dpi,
+            'fill': fill,
+            'top': top,
+            'left': left,
+            'bottom': bottom,
+            'right': right,
+            'crop_fit': autocropfit,
+            'overlay_data': overlay_image_data,
+            'overlay_size': overlay_size,
+            'overlay_pos': overlay_pos,
+            'overlay_opacity': overlay_opacity,
+            'icc_data': icc_profile_data,
+            'icc_intent': icc_profile_intent,
+            'icc_bpc': icc_profile_bpc,
+            'tile': tile_spec,
+            'colorspace': colorspace,
+            'format': iformat,
+            'quality': cquality,
+            'max_bytes': max_bytes,
+            'resize_type': self._settings['IMAGE_RESIZE_QUALITY'],
+            'resize_gamma': self._settings['IMAGE_RESIZE_GAMMA_CORRECT'],
+            'resize_gamma_lut': self._settings['IMAGE_RESIZE_GAMMA_LUT'],
+            'strip': strip_info
+        }
+
     def _get_icc_colorspace(self, icc_data):
         """
         Returns the colorspace header field of an ICC profile
@@ -33,11 +33,18 @@
 class ImageWrapper(object):
     """
     Class to wrap binary image data along with some associated properties.
+
+    Alternatively the image can be held as the path of a file on disk (with
+    image_data None), for images that are to be streamed to the client
+    without reading the whole file into memory.
     """
     def __init__(self, image_data, image_attrs, from_cache=False,
                  last_modified=0, client_expiry_seconds=0,
-                 attachment=False, record_stats=True):
+                 attachment=False, record_stats=True,
+                 file_path=None, file_size=0):
         self._data = image_data
+        self._file_path = file_path
+        self._file_size = file_size
         self._attrs = image_attrs
         self._from_cache = from_cache
         self._last_modified_time = last_modified
@@ -47,10 +54,24 @@ class ImageWrapper(object):
 
     def data(self):
         """
-        Returns the binary image data for this image.
+        Returns the binary image data for this image,
+        or None if the image is instead held as a file path.
         """
         return self._data
 
+    def data_size(self):
+        """
+        Returns the size of the image data in bytes.
+        """
+        return len(self._data) if self._data is not None else self._file_size
+
+    def file_path(self):
+        """
+        Returns the absolute path of the image file on disk when this image is
+        to be streamed from the file instead of from memory, otherwise None.
+        """
+        return self._file_path
+
     def attrs(self):
         """
         Returns the ImageAttrs object associated with this image.
@@ -27,12 +27,27 @@
 # =========  ====  ============================================================
 #
 
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
 import tempfile
+import threading
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None  # Python < 3.8
 
 from . import imaging_magick as magick
 from . import imaging_pillow as pillow
+from .errors import ServerTooBusyError
 
 _backend = None
+_executor = None
+
+# Image data smaller than this is sent to worker processes by value
+_SHARED_MEMORY_MIN_SIZE = 64 * 1024
 
 
 def backend_supported(back_end):
@@ -51,7 +66,8 @@ def backend_supported(back_end):
     return False
 
 
-def init(back_end='auto', gs_path='gs', temp_files_path=None, pdf_default_dpi=150):
+def init(back_end='auto', gs_path='gs', temp_files_path=None, pdf_default_dpi=150,
+         workers=0, queue_size=0, job_timeout=30):
     """
     Initialises the back-end imaging library. This function must be called
     once on startup before the other functions can be used; it is not safe
@@ -64,8 +80,15 @@ def init(back_end='auto', gs_path='gs', temp_files_path=None, pdf_default_dpi=15
                       defaults to the operating system's temp directory
     pdf_default_dpi - the default target DPI when converting PDFs to images,
                       or when requesting the dimensions of a PDF, e.g. 150
+    workers - the number of worker processes in which to run adjust_image()
+              and get_image_dimensions(), or 0 to run them in the calling thread
+    queue_size - when using worker processes, the number of additional jobs that
+                 can wait for a free worker before a ServerTooBusyError is raised
+    job_timeout - when using worker processes, the number of seconds to wait for
+                  a job to complete before a ServerTooBusyError is raised. A job
+                  that has already started is not stopped when this happens.
     """
-    global _backend
+    global _backend, _executor
     if not temp_files_path:
         temp_files_path = tempfile.gettempdir()
 
@@ -81,6 +104,17 @@ def init(back_end='auto', gs_path='gs', temp_files_path=None, pdf_default_dpi=15
     else:
         raise ValueError('Unsupported back end: ' + back_end)
 
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    if workers > 0:
+        _executor = _ProcessExecutor(
+            (back_end, gs_path, temp_files_path, pdf_default_dpi),
+            workers,
+            queue_size,
+            job_timeout
+        )
+
 
 def get_backend():
     """
@@ -105,6 +139,17 @@ def get_version_info():
     return _backend.get_version_info()
 
 
+def get_icc_transform_stats():
+    """
+    Returns a dictionary of usage information for the back-end's cache of colour
+    profile transformations in this process:
+    { 'count': transforms, 'capacity': transforms, 'hits': n, 'misses': n }
+    or None if the back-end does not cache them. When using worker processes,
+    images are adjusted (and transformations cached) in the workers instead.
+    """
+    return _backend.get_icc_transform_stats()
+
+
 def supported_file_types():
     """
     Returns a list of lower-case file types supported by the current back-end
@@ -183,8 +228,15 @@ def adjust_image(image_data, data_type, image_spec):
                    default "" (no change)
     format:        lower case image format to return, default "jpg"
     quality:       JPG quality or PNG compression type, 0 to 100, default 80
+    max_bytes:     the maximum size of the encoded image in bytes, default 0 (no limit).
+                   The quality is reduced as little as possible (or for PNG, the
+                   compression increased) to meet this size, so that the quality
+                   value above becomes the highest quality to use.
     resize_type:   resizing algorithm, 1 (fastest) to 3 (best quality), default 3
     resize_gamma:  whether to gamma correct sRGB images when resizing, default True
+    resize_gamma_lut: whether to gamma correct using lookup tables instead of colour
+                   profile conversions (for RGB images without an embedded profile),
+                   default False
     strip:         whether to strip EXIF data and colour profiles from the image,
                    True or False, default False
 
@@ -211,10 +263,67 @@ def adjust_image(image_data, data_type, image_spec):
 
     Raises a ValueError if the supplied data is not a supported image, or for
     invalid parameter values. Other back-end specific errors may also be raised.
+    When using worker processes, raises a ServerTooBusyError if the job queue is
+    full or if the job times out.
     """
+    if _executor is not None:
+        return _executor.run('adjust_image', image_data, data_type, image_spec)
     return _backend.adjust_image(image_data, data_type, image_spec)
 
 
+def adjust_image_max_bytes(image_data, data_type, image_spec, quality_hint=0):
+    """
+    As for adjust_image(), but returns a tuple of the newly encoded image and the
+    quality value that was used to encode it. When the image_spec has a max_bytes
+    value, this is the quality that was found to meet max_bytes. Giving it back
+    as the quality_hint when generating the same image again allows the back-end
+    to check it first instead of repeating the whole search.
+
+    Raises the same errors as adjust_image().
+    """
+    if _executor is not None:
+        return _executor.run(
+            'adjust_image_max_bytes', image_data, data_type, image_spec, quality_hint
+        )
+    return _backend.adjust_image_max_bytes(image_data, data_type, image_spec, quality_hint)
+
+
+def adjust_image_multi(image_data, data_type, image_specs):
+    """
+    Produces several new images from one encoded image, as for adjust_image()
+    but with a list of image_spec dictionaries, returning a list of the newly
+    encoded images in the same order. This is faster than calling adjust_image()
+    for each image_spec because the image data only has to be decoded once, and
+    some back-ends are also able to share common operations between the images.
+
+    Raises a ValueError if the supplied data is not a supported image, or for
+    an invalid parameter value in any of the image specs, in which case no
+    images are returned. Other back-end specific errors may also be raised.
+    When using worker processes, raises a ServerTooBusyError if the job queue is
+    full or if the job times out.
+    """
+    if _executor is not None:
+        return _executor.run('adjust_image_multi', image_data, data_type, image_specs)
+    return _backend.adjust_image_multi(image_data, data_type, image_specs)
+
+
+def adjust_image_cascade(image_data, data_type, image_specs):
+    """
+    As for adjust_image_multi(), but for image specs in order of decreasing size,
+    such as an image pyramid. Where an image spec changes nothing before the
+    resize step, the image is resized from the previous image in the cascade
+    instead of from the original image, when that is large enough. This is much
+    faster and uses less memory for a large original image, but can give very
+    slightly softer images. Back-ends that do not support this fall back to
+    adjust_image_multi().
+
+    Raises the same errors as adjust_image_multi().
+    """
+    if _executor is not None:
+        return _executor.run('adjust_image_cascade', image_data, data_type, image_specs)
+    return _backend.adjust_image_cascade(image_data, data_type, image_specs)
+
+
 def burst_pdf(pdf_data, dest_dir, dpi):
     """
     Exports every page of a PDF file as separate PNG files into a directory
@@ -264,5 +373,184 @@ def get_image_dimensions(image_data, data_type):
     Returns a tuple with format (width, height).
 
     Raises a ValueError if the supplied data is not a supported image.
+    When using worker processes, raises a ServerTooBusyError if the job times out.
     """
+    if _executor is not None:
+        try:
+            return _executor.run('get_image_dimensions', image_data, data_type)
+        except _QueueFullError:
+            # This is usually a cheap operation, do it here rather than fail
+            pass
     return _backend.get_image_dimensions(image_data, data_type)
+
+
+class _QueueFullError(ServerTooBusyError):
+    """
+    Raised when a job cannot be added to the worker processes job queue.
+    """
+    pass
+
+
+class _ProcessExecutor(object):
+    """
+    Runs imaging back-end functions in a pool of worker processes, so that
+    image processing can use all CPU cores without blocking the calling thread
+    or holding the Python GIL. The number of jobs running or waiting to run is
+    limited to workers + queue_size, after which jobs are refused. The job
+    timeout only limits how long the caller waits. A job that has started is
+    left to finish, and keeps its worker process and queue slot until then.
+
+    Where available, large image data is copied into shared memory for the
+    worker processes rather than being pickled and sent down a pipe. The
+    returned images are (usually smaller and) sent back as normal.
+
+    The pool is started on first use in each process, so that this object
+    can be created before the web server forks its worker processes. The
+    worker processes are not forked from the (multi-threaded) web server
+    process, but are started by a fork server or as new processes.
+    """
+    def __init__(self, init_args, workers, queue_size, job_timeout):
+        self._init_args = init_args
+        self._workers = workers
+        self._job_timeout = job_timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._isolated_slot = threading.BoundedSemaphore(1)
+        self._pool_lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = 0
+        self._mp_context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+            else 'spawn'
+        )
+
+    def run(self, fn_name, image_data, *args):
+        """
+        Runs the named back-end function in a worker process with the
+        given image data and other arguments, returning the result.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise _QueueFullError('The imaging job queue is full')
+        shm = None
+        pool = None
+        try:
+            if shared_memory is not None and len(image_data) >= _SHARED_MEMORY_MIN_SIZE:
+                shm = shared_memory.SharedMemory(create=True, size=len(image_data))
+                shm.buf[:len(image_data)] = image_data
+                job_data = (shm.name, len(image_data))
+            else:
+                job_data = image_data
+            pool = self._get_pool()
+            future = pool.submit(_run_job, fn_name, job_data, args)
+        except BrokenProcessPool:
+            # Another job has crashed the pool. This job did not run.
+            self._release_job(shm)
+            self._reset_pool(pool)
+            raise ServerTooBusyError('The imaging worker processes are restarting')
+        except:
+            self._release_job(shm)
+            raise
+        # Free the queue slot when the job finishes rather than when we stop waiting
+        future.add_done_callback(lambda f: self._release_job(shm))
+        try:
+            return future.result(timeout=self._job_timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise ServerTooBusyError('Timed out waiting for the imaging job to complete')
+        except BrokenProcessPool:
+            # A worker process crashed, but all the jobs in the pool fail
+            # when this happens, so it may not have been running this job
+            self._reset_pool(pool)
+            return self._run_isolated(fn_name, image_data, args)
+
+    def shutdown(self):
+        """
+        Stops the worker processes, if they were started in this process.
+        """
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def _run_isolated(self, fn_name, image_data, args):
+        """
+        Re-runs a job that failed when the worker processes crashed, in a new
+        worker process of its own. Raises a ValueError if this crashes too,
+        as then the image itself is the cause. The re-run takes a queue slot
+        as for other jobs, and only one re-run at a time is allowed.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise _QueueFullError('The imaging job queue is full')
+        if not self._isolated_slot.acquire(timeout=self._job_timeout):
+            self._slots.release()
+            raise ServerTooBusyError('Timed out waiting to re-run the imaging job')
+        pool = self._new_pool(1)
+        try:
+            future = pool.submit(_run_job, fn_name, image_data, args)
+        except:
+            self._release_isolated_job()
+            raise
+        finally:
+            # The worker process exits when the job finishes
+            pool.shutdown(wait=False)
+        future.add_done_callback(lambda f: self._release_isolated_job())
+        try:
+            return future.result(timeout=self._job_timeout)
+        except futures.TimeoutError:
+            raise ServerTooBusyError('Timed out waiting for the imaging job to complete')
+        except BrokenProcessPool:
+            raise ValueError('The imaging worker process terminated unexpectedly')
+
+    def _get_pool(self):
+        pid = os.getpid()
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != pid:
+                self._pool = self._new_pool(self._workers)
+                self._pool_pid = pid
+            return self._pool
+
+    def _new_pool(self, workers):
+        return futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=self._mp_context,
+            initializer=_init_job_process,
+            initargs=self._init_args
+        )
+
+    def _reset_pool(self, pool):
+        with self._pool_lock:
+            if pool is not None and self._pool is pool:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+    def _release_job(self, shm):
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        self._slots.release()
+
+    def _release_isolated_job(self):
+        self._isolated_slot.release()
+        self._slots.release()
+
+
+def _init_job_process(back_end, gs_path, temp_files_path, pdf_default_dpi):
+    """
+    Initialises the imaging back-end in a new worker process.
+    """
+    init(back_end, gs_path, temp_files_path, pdf_default_dpi)
+
+
+def _run_job(fn_name, job_data, args):
+    """
+    Runs a back-end function in a worker process, where job_data is either the
+    image data or a tuple of (shared memory name, image data length).
+    """
+    if isinstance(job_data, tuple):
+        shm = shared_memory.SharedMemory(name=job_data[0])
+        try:
+            image_data = bytes(shm.buf[:job_data[1]])
+        finally:
+            shm.close()
+    else:
+        image_data = job_data
+    return getattr(_backend, fn_name)(image_data, *args)
@@ -73,6 +73,16 @@ class ImageMagickBackend(object):
         """
         return qismagick.get_library_info()
 
+    def get_icc_transform_stats(self):
+        """
+        ImageMagick implementation of imaging.get_icc_transform_stats(),
+        see the function documentation there for full details.
+
+        The qismagick library manages its own colour profile transformations,
+        so this returns None.
+        """
+        return None
+
     def supported_file_types(self):
         """
         Returns which image types are supported by the ImageMagick back-end.
@@ -116,8 +126,10 @@ class ImageMagickBackend(object):
             'colorspace': True,
             'format': True,
             'quality': True,
+            'max_bytes': False,
             'resize_type': True,
             'resize_gamma': True,
+            'resize_gamma_lut': False,
             'strip': True
         }
 
@@ -128,6 +140,42 @@ class ImageMagickBackend(object):
         """
         return qismagick.adjust_image(image_data, data_type, image_spec)
 
+    def adjust_image_max_bytes(self, image_data, data_type, image_spec, quality_hint=0):
+        """
+        ImageMagick implementation of imaging.adjust_image_max_bytes(),
+        see the function documentation there for full details.
+
+        The qismagick library does not yet support max_bytes, so this returns
+        the image encoded at the quality given in the image spec.
+        """
+        return (
+            qismagick.adjust_image(image_data, data_type, image_spec),
+            image_spec.get('quality', 0)
+        )
+
+    def adjust_image_multi(self, image_data, data_type, image_specs):
+        """
+        ImageMagick implementation of imaging.adjust_image_multi(),
+        see the function documentation there for full details.
+
+        The qismagick library does not yet provide a multi-image call,
+        so this currently decodes the image once for each image spec.
+        """
+        return [
+            qismagick.adjust_image(image_data, data_type, image_spec)
+            for image_spec in image_specs
+        ]
+
+    def adjust_image_cascade(self, image_data, data_type, image_specs):
+        """
+        ImageMagick implementation of imaging.adjust_image_cascade(),
+        see the function documentation there for full details.
+
+        The qismagick library does not yet support this, so this is the same as
+        adjust_image_multi().
+        """
+        return self.adjust_image_multi(image_data, data_type, image_specs)
+
     def burst_pdf(self, pdf_data, dest_dir, dpi):
         """
         ImageMagick implementation of imaging.burst_pdf(),
@@ -27,13 +27,17 @@
 # =========  ====  ============================================================
 #
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
 import io
 import math
+import threading
 
 _pillow_import_error = None
 try:
     import PIL
-    from PIL import Image, ImageCms, ImageColor, ExifTags, TiffTags, IptcImagePlugin
+    from PIL import Image, ImageCms, ImageColor, ExifTags, TiffTags, IptcImagePlugin, features
 except Exception as e:
     _pillow_import_error = e
 
@@ -43,6 +47,12 @@ class PillowBackend(object):
     Implements a back-end for imaging.py using the Python Pillow library.
     """
     MAX_ICC_SIZE = 1048576 * 5
+    # When downscaling JPEGs, how much larger than the target size to decode them
+    JPEG_DRAFT_MARGIN = 2
+    # The range of linear light values used when gamma correcting with lookup tables
+    LINEAR_LUT_MAX = 65535
+    # How many colour profile transformations to keep for re-use
+    MAX_ICC_TRANSFORMS = 32
 
     # Keys in image.info that are important to preserve through the processing chain
     METADATA_INFO_KEYS = (
@@ -62,6 +72,10 @@ class PillowBackend(object):
         global _pillow_import_error
         if _pillow_import_error:
             raise ImportError("Failed to import Pillow: " + str(_pillow_import_error))
+        self._icc_transforms = OrderedDict()
+        self._icc_transforms_lock = threading.Lock()
+        self._icc_transform_hits = 0
+        self._icc_transform_misses = 0
         try:
             # Cache some useful ICC profiles
             linear_file = io.BytesIO(LINEAR_RGB_ICC_PROFILE)
@@ -82,6 +96,16 @@ class PillowBackend(object):
             self._transform_rgba_linear_to_srgb = ImageCms.buildTransform(
                 self.linear_rgb_profile, self.srgb_profile, 'RGBA', 'RGBA'
             )
+
+            # Pre-calculate sRGB 8 bit --> linear float and linear 16 bit --> sRGB 8 bit
+            # lookup tables. The +0.5 rounds the linear values when converted to integers.
+            lut_max = PillowBackend.LINEAR_LUT_MAX
+            self._lut_srgb_to_linear = [
+                (_srgb_to_linear(v / 255) * lut_max) + 0.5 for v in range(256)
+            ]
+            self._lut_linear_to_srgb = [
+                round(_linear_to_srgb(v / lut_max) * 255) for v in range(lut_max + 1)
+            ]
         finally:
             linear_file.close()
             srgb_file.close()
@@ -92,17 +116,34 @@ class PillowBackend(object):
         """
         return "Pillow version: " + PIL.__version__
 
+    def get_icc_transform_stats(self):
+        """
+        Pillow implementation of imaging.get_icc_transform_stats(),
+        see the function documentation there for full details.
+        """
+        with self._icc_transforms_lock:
+            return {
+                'count': len(self._icc_transforms),
+                'capacity': PillowBackend.MAX_ICC_TRANSFORMS,
+                'hits': self._icc_transform_hits,
+                'misses': self._icc_transform_misses
+            }
+
     def supported_file_types(self):
         """
         Returns which image types are supported by the Pillow back-end.
         See the function documentation for imaging.supported_file_types() for
         more information.
         """
-        return [
+        file_types = [
             'gif',
             'jpg', 'jpeg', 'jpe', 'jfif', 'jif', 'pjpg', 'pjpeg',
             'png', 'tif', 'tiff'
         ]
+        # WebP is optional when Pillow is built
+        if features.check('webp'):
+            file_types.append('webp')
+        return file_types
 
     def supported_operations(self):
         """
@@ -139,8 +180,10 @@ class PillowBackend(object):
             'colorspace': False,
             'format': True,
             'quality': True,
+            'max_bytes': True,
             'resize_type': True,
             'resize_gamma': True,
+            'resize_gamma_lut': True,
             'strip': True
         }
 
@@ -151,15 +194,71 @@ class PillowBackend(object):
 
         This method does not support all the functionality of the ImageMagick version.
         """
+        return self.adjust_image_multi(image_data, data_type, [image_spec])[0]
+
+    def adjust_image_max_bytes(self, image_data, data_type, image_spec, quality_hint=0):
+        """
+        Pillow implementation of imaging.adjust_image_max_bytes(),
+        see the function documentation there for full details.
+        """
+        return self._adjust_image_multi(
+            image_data, data_type, [image_spec], [quality_hint]
+        )[0]
+
+    def adjust_image_multi(self, image_data, data_type, image_specs):
+        """
+        Pillow implementation of imaging.adjust_image_multi(),
+        see the function documentation there for full details.
+
+        The image is decoded once for all the image specs, and image specs that
+        share the same flip, rotation, and cropping also share the result of
+        those operations.
+        """
+        return [
+            data for (data, _) in self._adjust_image_multi(image_data, data_type, image_specs)
+        ]
+
+    def adjust_image_cascade(self, image_data, data_type, image_specs):
+        """
+        Pillow implementation of imaging.adjust_image_cascade(),
+        see the function documentation there for full details.
+
+        Each image is encoded in a background thread while the next one is
+        resized, and the decoded image is closed as soon as the remaining
+        images can all be resized from the previous one.
+        """
+        return [
+            data for (data, _) in self._adjust_image_multi(
+                image_data, data_type, image_specs, cascade=True
+            )
+        ]
+
+    def _adjust_image_multi(self, image_data, data_type, image_specs, quality_hints=None,
+                            cascade=False):
+        """
+        Implements adjust_image_multi(), returning a list of tuples of the
+        encoded image and the quality value it was encoded with. The optional
+        quality_hints list gives a quality_hint (see _encode_image) for each
+        image spec. If cascade is True, implements adjust_image_cascade().
+        """
         if not image_data:
             raise ValueError('Image must be supplied')
+        if not image_specs:
+            return []
 
         # Check for bad parameters, set default values for missing parameters
-        self._validate_image_spec(image_spec)
+        for image_spec in image_specs:
+            self._validate_image_spec(image_spec)
+
+        # When there is only one image to produce, each intermediate
+        # image can be closed as soon as the next one has been created
+        shared = len(image_specs) > 1
+        pre_images = {}
+        reduced_images = {}
+        encoder = ThreadPoolExecutor(max_workers=1) if cascade else None
 
         # Read image data, blow up here if a bad image
         image = self._load_image_data(image_data, data_type)
-        bufout = io.BytesIO()
         try:
             # Keep a copy of the original image's info
             original_info = image.info
@@ -177,13 +276,27 @@ class PillowBackend(object):
 
             # Prevent enlargements, but allowing for rotation.
             # If enabling enlargements, enforce some max value to prevent server attacks.
-            if image_spec['rotation'] == 0.0:
-                new_width = _limit_number(image_spec['width'], 0, image.width)
-                new_height = _limit_number(image_spec['height'], 0, image.height)
-            else:
-                rot_size = _rotated_size(image.width, image.height, image_spec['rotation'])
-                new_width = _limit_number(image_spec['width'], 0, rot_size[0] + 2)
-                new_height = _limit_number(image_spec['height'], 0, rot_size[1] + 2)
+            new_sizes = []
+            for image_spec in image_specs:
+                if image_spec['rotation'] == 0.0:
+                    new_width = _limit_number(image_spec['width'], 0, image.width)
+                    new_height = _limit_number(image_spec['height'], 0, image.height)
+                else:
+                    rot_size = _rotated_size(image.width, image.height, image_spec['rotation'])
+                    new_width = _limit_number(image_spec['width'], 0, rot_size[0] + 2)
+                    new_height = _limit_number(image_spec['height'], 0, rot_size[1] + 2)
+                new_sizes.append((new_width, new_height))
+
+            # For large downscales, decode JPEGs at a reduced size, large enough
+            # for the largest image required. Note that this changes image.size,
+            # so it has to come after the enlargement checks.
+            draft_scales = [
+                self._get_draft_scale(image, image_spec, new_width, new_height)
+                for image_spec, (new_width, new_height) in zip(image_specs, new_sizes)
+            ]
+            full_width = image.width
+            self._image_draft(image, max(draft_scales))
+            decoded_scale = image.width / full_width
 
             # Palette based images - there are a number of operations that assume RGB
             # (fill colour object, apply ICC profile (later), overlay transparency (later))
@@ -195,60 +308,183 @@ class PillowBackend(object):
                 )
                 self._restore_pillow_info(image, original_info)
 
-            # If the target format supports transparency and we need it,
-            # upgrade the image to RGBA
-            if image_spec['fill'] == 'none' or image_spec['fill'] == 'transparent':
-                if self._supports_transparency(image_spec['format']):
-                    if image.mode != 'LA' and image.mode != 'RGBA':
-                        image = self._image_change_mode(
-                            image,
-                            'LA' if image.mode == 'L' else 'RGBA'
-                        )
-                        self._restore_pillow_info(image, original_info)
-                else:
-                    image_spec['fill'] = '#ffffff'
+            def get_spec_image(draft_scale):
+                # The smaller images can start from a cheap reduction of the
+                # decoded image, as they would have from a smaller JPEG draft
+                reduce_factor = 1
+                while reduce_factor < 8 and draft_scale * 2 <= decoded_scale / reduce_factor:
+                    reduce_factor *= 2
+                if reduce_factor == 1:
+                    return image
+                if reduce_factor not in reduced_images:
+                    reduced_images[reduce_factor] = image.reduce(reduce_factor)
+                    self._restore_pillow_info(reduced_images[reduce_factor], original_info)
+                return reduced_images[reduce_factor]
+
+            def is_decoded_image(test_image):
+                return test_image is image or any(
+                    test_image is reduced_image for reduced_image in reduced_images.values()
+                )
 
-            # Set background colour, required for rotation or resizes that
-            # change the overall aspect ratio
-            try:
-                if image_spec['fill'] == 'auto':
-                    fill_rgb = self._auto_fill_colour(image)
-                elif image_spec['fill'] == 'none' or image_spec['fill'] == 'transparent':
-                    fill_rgb = None
-                elif image_spec['fill']:
-                    fill_rgb = ImageColor.getrgb(image_spec['fill'])
+            # For a cascade, the size of each image that only needs resizing
+            cascade_sizes = [
+                self._get_cascade_size(image, image_spec, new_width, new_height)
+                if cascade else None
+                for image_spec, (new_width, new_height) in zip(image_specs, new_sizes)
+            ]
+            cascade_image = None
+            encoding = None
+            image_closed = False
+
+            results = []
+            for idx, (image_spec, (new_width, new_height), draft_scale, quality_hint) in \
+                    enumerate(zip(image_specs, new_sizes, draft_scales,
+                                  quality_hints or [0] * len(image_specs))):
+                cascade_size = cascade_sizes[idx]
+                if cascade_size is None:
+                    results.append(self._adjust_decoded_image(
+                        get_spec_image(draft_scale), dict(original_info), image_spec,
+                        new_width, new_height, pre_images, shared, quality_hint
+                    ))
+                    continue
+
+                # Resize from the previous image in the cascade if it is large enough
+                if (cascade_image is not None and cascade_image.width >= cascade_size[0] and
+                        cascade_image.height >= cascade_size[1]):
+                    source_image = cascade_image
                 else:
-                    fill_rgb = ImageColor.getrgb('#ffffff')
-            except ValueError:
-                raise ValueError('Invalid or unsupported fill colour')
-
-            # The order of imaging operations is fixed, and defined in image_help.md#notes
-            # (1) Flip
-            if image_spec['flip'] == 'h' or image_spec['flip'] == 'v':
-                image = self._image_flip(image, image_spec['flip'])
-                self._restore_pillow_info(image, original_info)
-            # (2) Rotate
-            if image_spec['rotation']:
-                image = self._image_rotate(
-                    image,
-                    image_spec['rotation'],
-                    image_spec['resize_type'],
-                    fill_rgb
-                )
-                self._restore_pillow_info(image, original_info)
-            # (3) Crop
-            if (image_spec['top'], image_spec['left'], image_spec['bottom'], image_spec['right']) != (0.0, 0.0, 1.0, 1.0):
-                image = self._image_crop(
-                    image,
-                    image_spec['top'], image_spec['left'],
-                    image_spec['bottom'], image_spec['right'],
-                    image_spec['crop_fit'], new_width, new_height
+                    source_image = get_spec_image(draft_scale)
+                if source_image.size != cascade_size:
+                    next_image = self._image_resize_bare(
+                        source_image, cascade_size[0], cascade_size[1],
+                        image_spec['resize_type'], image_spec['resize_gamma'],
+                        image_spec['resize_gamma_lut'], auto_close=False
+                    )
+                    self._restore_pillow_info(next_image, original_info)
+                else:
+                    next_image = source_image
+                # Wait for the previous image to be encoded before closing it
+                if encoding is not None:
+                    encoding.result()
+                if (cascade_image is not None and cascade_image is not next_image and
+                        not is_decoded_image(cascade_image)):
+                    cascade_image.close()
+                cascade_image = next_image
+                encoding = encoder.submit(
+                    self._adjust_cascade_image,
+                    next_image, dict(original_info), image_spec, quality_hint
                 )
-                self._restore_pillow_info(image, original_info)
-                # If auto-fill is enabled and we didn't rotate
-                # (i.e. we haven't filled yet), work out a new fill colour, post-crop
-                if image_spec['fill'] == 'auto' and not image_spec['rotation']:
-                    fill_rgb = self._auto_fill_colour(image)
+                results.append(encoding)
+
+                # Free the decoded image once the rest of the images do not need it
+                if (not image_closed and not is_decoded_image(next_image) and
+                        all(size is not None and size[0] <= next_image.width and
+                            size[1] <= next_image.height
+                            for size in cascade_sizes[idx + 1:])):
+                    for pre_image, _ in pre_images.values():
+                        pre_image.close()
+                    for reduced_image in reduced_images.values():
+                        reduced_image.close()
+                    image.close()
+                    image_closed = True
+
+            return [
+                result.result() if isinstance(result, Future) else result
+                for result in results
+            ]
+        finally:
+            if encoder is not None:
+                encoder.shutdown(wait=True)
+                if cascade_image is not None:
+                    cascade_image.close()
+            for pre_image, _ in pre_images.values():
+                pre_image.close()
+            for reduced_image in reduced_images.values():
+                reduced_image.close()
+            image.close()
+
+    def _get_cascade_size(self, image, image_spec, new_width, new_height):
+        """
+        For adjust_image_cascade(), returns a tuple of the (width, height) that
+        an image spec resizes the decoded image to, as for _image_resize(), if
+        that is the first change it makes to the image. Otherwise returns None,
+        when the image spec cannot start from a different image in the cascade.
+        """
+        if (image_spec['flip'] or image_spec['rotation'] or
+                bool(new_width) == bool(new_height) or
+                (image_spec['top'], image_spec['left'],
+                 image_spec['bottom'], image_spec['right']) != (0.0, 0.0, 1.0, 1.0)):
+            return None
+        aspect = image.width / image.height
+        if new_width:
+            return (new_width, math.ceil(new_width / aspect))
+        return (math.ceil(aspect * new_height), new_height)
+
+    def _adjust_cascade_image(self, image, original_info, image_spec, quality_hint):
+        """
+        For adjust_image_cascade(), applies an image spec to an image that has
+        already been resized for it, as for _adjust_decoded_image(), returning
+        the same tuple. The image passed in is not closed.
+        """
+        pre_images = {}
+        try:
+            return self._adjust_decoded_image(
+                image, original_info, image_spec, 0, 0, pre_images, True, quality_hint
+            )
+        finally:
+            for pre_image, _ in pre_images.values():
+                if pre_image is not image:
+                    pre_image.close()
+
+    def _adjust_decoded_image(self, image, original_info, image_spec,
+                              new_width, new_height, pre_images, shared, quality_hint=0):
+        """
+        Applies an image spec to a decoded image, returning a tuple of the new
+        encoded image and the quality value used, as for _encode_image().
+        When shared is True, the decoded image is left open for use with other
+        image specs, and the results of the flip, rotate and crop operations are
+        stored in and re-used from the pre_images dictionary. Otherwise the
+        decoded image is closed along with each intermediate image.
+        """
+        # If the target format supports transparency and we need it,
+        # upgrade the image to RGBA
+        upgrade_alpha = False
+        if image_spec['fill'] == 'none' or image_spec['fill'] == 'transparent':
+            if self._supports_transparency(image_spec['format']):
+                upgrade_alpha = image.mode != 'LA' and image.mode != 'RGBA'
+            else:
+                image_spec['fill'] = '#ffffff'
+
+        # Get the image after flip, rotate and crop, which many image specs have in common
+        pre_key = (
+            id(image), upgrade_alpha, image_spec['fill'], image_spec['flip'],
+            image_spec['rotation'], image_spec['resize_type'] if image_spec['rotation'] else 0,
+            image_spec['top'], image_spec['left'], image_spec['bottom'], image_spec['right'],
+            (new_width, new_height) if image_spec['crop_fit'] else None
+        )
+        crop_box = None
+        if pre_key in pre_images:
+            image, fill_rgb = pre_images[pre_key]
+        else:
+            # Rather than crop and then resize, resize straight from the crop region,
+            # unless the resize has to convert the image first (then crop, convert
+            # only the region, and resize) or the cropped image can be shared
+            defer_crop = (
+                not shared and not upgrade_alpha and
+                (new_width != 0 or new_height != 0) and
+                image_spec['fill'] != 'auto' and
+                not (image.mode.startswith('RGB') and image_spec['resize_gamma'])
+            )
+            image, fill_rgb, crop_box = self._image_pre_steps(
+                image, original_info, image_spec,
+                upgrade_alpha, new_width, new_height, shared, defer_crop
+            )
+            if shared:
+                pre_images[pre_key] = (image, fill_rgb)
+
+        # Continue from here without closing any images that are shared
+        base_image = image
+        try:
             # (4) Resize
             if new_width != 0 or new_height != 0:
                 image = self._image_resize(
@@ -258,40 +494,210 @@ class PillowBackend(object):
                     image_spec['align_h'], image_spec['align_v'],
                     fill_rgb,
                     image_spec['resize_type'],
-                    image_spec['resize_gamma']
+                    image_spec['resize_gamma'],
+                    image_spec['resize_gamma_lut'],
+                    box=crop_box,
+                    auto_close=not shared or image is not base_image
                 )
                 self._restore_pillow_info(image, original_info)
             # (5) Blur/sharpen - P2
             # (6) Overlay - P2
             # (7) Tile
             if image_spec['tile'] >= (1, 4):
-                image = self._image_tile(image, image_spec['tile'])
+                image = self._image_tile(
+                    image, image_spec['tile'],
+                    auto_close=not shared or image is not base_image
+                )
                 self._restore_pillow_info(image, original_info)
             # (8) Apply ICC profile - P3
             # (9) Set colorspace - P3
             # (10) Strip (preparation, the strip is done by _get_pillow_save_options)
             if image_spec['strip']:
-                image = self._image_pre_strip(image)
+                image = self._image_pre_strip(
+                    image,
+                    auto_close=not shared or image is not base_image
+                )
                 self._restore_pillow_info(image, original_info)
 
             # Check/set the image mode for the output image format
-            image = self._set_pillow_save_mode(image, image_spec['format'], fill_rgb)
+            image = self._set_pillow_save_mode(
+                image, image_spec['format'], fill_rgb,
+                auto_close=not shared or image is not base_image
+            )
             if 'transparency' in image.info:
                 original_info['transparency'] = image.info['transparency']
             self._restore_pillow_info(image, original_info)
-            # Get the save parameters for the output image format
+            # Encode the image bytes and return encoded bytes
+            return self._encode_image(image, original_info, image_spec, quality_hint)
+        finally:
+            if not shared or image is not base_image:
+                image.close()
+
+    def _encode_image(self, image, original_info, image_spec, quality_hint=0):
+        """
+        Encodes an image in the output format of an image spec, returning a tuple
+        of the encoded bytes and the quality value used.
+
+        If the image spec has a max_bytes value, the already transformed image is
+        re-encoded as required to find the highest quality, up to the quality in
+        the image spec, that gives a file no larger than max_bytes. For the
+        lossless PNG format, only the compression level can be increased. If
+        max_bytes cannot be met, the smallest encoding is returned. A quality_hint
+        from a previous encoding of the same image is tried first, so that the
+        search usually takes only two extra encodings.
+        """
+        def encode(quality, optimize=False):
             save_opts = self._get_pillow_save_options(
                 image,
-                image_spec['format'], image_spec['quality'],
+                image_spec['format'], quality,
                 image_spec['dpi_x'], image_spec['dpi_y'],
                 original_info, image_spec['strip']
             )
-            # Encode the image bytes and return encoded bytes
-            image.save(bufout, **save_opts)
-            return bufout.getvalue()
-        finally:
-            image.close()
-            bufout.close()
+            if optimize:
+                save_opts['optimize'] = True
+            bufout = io.BytesIO()
+            try:
+                image.save(bufout, **save_opts)
+                return bufout.getvalue()
+            finally:
+                bufout.close()
+
+        max_bytes = image_spec['max_bytes']
+        quality = image_spec['quality']
+        lossy = self._supports_quality_search(image_spec['format'])
+        smallest = None
+        if not (max_bytes and lossy and 1 <= quality_hint < quality):
+            data = encode(quality)
+            if not max_bytes or len(data) <= max_bytes:
+                return (data, quality)
+            if self._get_pillow_format(image_spec['format']) == 'png':
+                # Try the highest compression level instead
+                png_data = encode(99, optimize=True)
+                return (png_data, 99) if len(png_data) < len(data) else (data, quality)
+            if not lossy:
+                return (data, quality)
+            smallest = (data, quality)
+
+        # Binary search the lower qualities, starting from the hint if there is one
+        best = None
+        low, high = 1, quality - 1
+        probe = quality_hint if low <= quality_hint <= high else (low + high) // 2
+        while low <= high:
+            data = encode(probe)
+            if len(data) <= max_bytes:
+                best = (data, probe)
+                low = probe + 1
+                # Check whether the hint is still the highest quality that fits
+                probe = low if probe == quality_hint else (low + high) // 2
+            else:
+                if smallest is None or len(data) < len(smallest[0]):
+                    smallest = (data, probe)
+                high = probe - 1
+                probe = (low + high) // 2
+        return best or smallest
+
+    def _image_pre_steps(self, image, original_info, image_spec,
+                         upgrade_alpha, new_width, new_height, shared, defer_crop=False):
+        """
+        Applies the transparency upgrade, flip, rotate and crop operations
+        of an image spec, returning a tuple of the new image, the fill colour
+        to use for the remaining operations, and the crop box if defer_crop
+        is True (when the image is not cropped, and the crop box is instead
+        for use by the resize), otherwise None. When shared is True, the image
+        passed in is not closed.
+        """
+        source_image = image
+        # Flips and right angle rotations do not need a fill colour, and can be
+        # performed together by a single transpose
+        right_angled = image_spec['rotation'] % 90 == 0
+        # Transparency is only needed before cropping for filling a rotation,
+        # otherwise it is cheaper to add to the cropped image
+        if upgrade_alpha and not right_angled:
+            image = self._image_change_mode(
+                image,
+                'LA' if image.mode == 'L' else 'RGBA',
+                auto_close=not shared
+            )
+            self._restore_pillow_info(image, original_info)
+
+        # Set background colour, required for rotation or resizes that
+        # change the overall aspect ratio
+        try:
+            if image_spec['fill'] == 'auto':
+                fill_rgb = self._auto_fill_colour(image)
+            elif image_spec['fill'] == 'none' or image_spec['fill'] == 'transparent':
+                fill_rgb = None
+            elif image_spec['fill']:
+                fill_rgb = ImageColor.getrgb(image_spec['fill'])
+            else:
+                fill_rgb = ImageColor.getrgb('#ffffff')
+        except ValueError:
+            if image is not source_image:
+                image.close()
+            raise ValueError('Invalid or unsupported fill colour')
+
+        # The order of imaging operations is fixed, and defined in image_help.md#notes
+        # (1) Flip and (2) Rotate by a right angle
+        if right_angled:
+            transpose_method = self._get_transpose_method(
+                image_spec['flip'], image_spec['rotation']
+            )
+            if transpose_method is not None:
+                image = self._image_transpose(
+                    image, transpose_method,
+                    auto_close=not shared or image is not source_image
+                )
+                self._restore_pillow_info(image, original_info)
+        else:
+            # (1) Flip
+            if image_spec['flip'] == 'h' or image_spec['flip'] == 'v':
+                image = self._image_flip(
+                    image, image_spec['flip'],
+                    auto_close=not shared or image is not source_image
+                )
+                self._restore_pillow_info(image, original_info)
+            # (2) Rotate
+            image = self._image_rotate(
+                image,
+                image_spec['rotation'],
+                image_spec['resize_type'],
+                fill_rgb,
+                auto_close=not shared or image is not source_image
+            )
+            self._restore_pillow_info(image, original_info)
+        # (3) Crop
+        crop_box = None
+        if (
+            image_spec['top'], image_spec['left'], image_spec['bottom'], image_spec['right']
+        ) != (0.0, 0.0, 1.0, 1.0):
+            if defer_crop:
+                crop_box = self._get_crop_box(
+                    image,
+                    image_spec['top'], image_spec['left'],
+                    image_spec['bottom'], image_spec['right'],
+                    image_spec['crop_fit'], new_width, new_height
+                )
+            else:
+                image = self._image_crop(
+                    image,
+                    image_spec['top'], image_spec['left'],
+                    image_spec['bottom'], image_spec['right'],
+                    image_spec['crop_fit'], new_width, new_height,
+                    auto_close=not shared or image is not source_image
+                )
+                self._restore_pillow_info(image, original_info)
+                # If auto-fill is enabled and we didn't rotate
+                # (i.e. we haven't filled yet), work out a new fill colour, post-crop
+                if image_spec['fill'] == 'auto' and not image_spec['rotation']:
+                    fill_rgb = self._auto_fill_colour(image)
+        if upgrade_alpha and right_angled:
+            image = self._image_change_mode(
+                image,
+                'LA' if image.mode == 'L' else 'RGBA',
+                auto_close=not shared or image is not source_image
+            )
+            self._restore_pillow_info(image, original_info)
+        return image, fill_rgb, crop_box
 
     def burst_pdf(self, pdf_data, dest_dir, dpi):
         """
@@ -336,7 +742,8 @@ class PillowBackend(object):
         Raises a ValueError if any of the parameters have invalid values.
         """
         # Remove None entries from dict
-        image_spec = {k: v for k, v in image_spec.items() if v is not None}
+        for k in [k for k, v in image_spec.items() if v is None]:
+            del image_spec[k]
         # Set default values / adjust parameters to safe values
         image_spec['page'] = _limit_number(image_spec.get('page', 1), 1, 999999)
         image_spec['width'] = image_spec.get('width', 0)
@@ -366,8 +773,10 @@ class PillowBackend(object):
         image_spec['colorspace'] = image_spec.get('colorspace', '')
         image_spec['format'] = image_spec.get('format', 'jpg')
         image_spec['quality'] = _limit_number(image_spec.get('quality', 80), 1, 100)
+        image_spec['max_bytes'] = max(image_spec.get('max_bytes', 0), 0)
         image_spec['resize_type'] = _limit_number(image_spec.get('resize_type', 3), 1, 3)
         image_spec['resize_gamma'] = image_spec.get('resize_gamma', True)
+        image_spec['resize_gamma_lut'] = image_spec.get('resize_gamma_lut', False)
         image_spec['strip'] = image_spec.get('strip', False)
 
         tile_spec = image_spec['tile']
@@ -530,11 +939,18 @@ class PillowBackend(object):
         """
         return self._get_pillow_format(format) in ['gif', 'png']
 
+    def _supports_quality_search(self, format):
+        """
+        Returns whether the given file format is lossy, so that its quality
+        can be reduced to meet a max_bytes limit.
+        """
+        return self._get_pillow_format(format) in ['jpeg', 'pjpg', 'pjpeg', 'webp']
+
     def _supports_icc_profile(self, format):
         """
         Returns whether the given file format supports an embedded ICC profile.
         """
-        return self._get_pillow_format(format) in ['jpeg', 'png']
+        return self._get_pillow_format(format) in ['jpeg', 'png', 'webp']
 
     def _restore_pillow_info(self, image, info_dict, info_keys=None):
         """
@@ -643,6 +1059,9 @@ class PillowBackend(object):
         # Set JPEG compression
         if save_opts['format'] in ['jpg', 'jpeg']:
             save_opts['quality'] = quality
+        # Set WebP compression
+        if save_opts['format'] == 'webp':
+            save_opts['quality'] = quality
         # Set PNG compression
         if save_opts['format'] == 'png':
             save_opts['compress_level'] = min(quality // 10, 9)
@@ -821,13 +1240,48 @@ class PillowBackend(object):
         # and there is no default/fallback profile.
         if image.mode.startswith('RGB') and 'icc_profile' in image.info:
             if image.info['icc_profile'] != SRGB_ICC_PROFILE:
-                builtin_profile = ImageCms.ImageCmsProfile(io.BytesIO(image.info['icc_profile']))
-                new_image = ImageCms.profileToProfile(image, builtin_profile, self.srgb_profile)
+                transform = self._get_icc_transform(
+                    image.info['icc_profile'], 'srgb', image.mode, image.mode
+                )
+                new_image = ImageCms.applyTransform(image, transform)
                 if auto_close:
                     image.close()
                 return new_image
         return image
 
+    def _get_icc_transform(self, icc_data, target, in_mode, out_mode, reverse=False,
+                           intent=0):
+        """
+        Returns an ImageCms transformation from the colour profile in icc_data to
+        the 'srgb' or 'linear' target profile, or from the target to icc_data if
+        reverse is True. The intent is an ImageCms rendering intent constant.
+
+        Transformations are kept in a size-limited, least-recently-used cache
+        keyed by a hash of icc_data, because building them is expensive and most
+        images with a colour profile share one of only a few profiles.
+        """
+        key = (hashlib.sha1(icc_data).digest(), target, in_mode, out_mode, reverse, intent)
+        with self._icc_transforms_lock:
+            transform = self._icc_transforms.get(key)
+            if transform is not None:
+                self._icc_transforms.move_to_end(key)
+                self._icc_transform_hits += 1
+                return transform
+            self._icc_transform_misses += 1
+
+        icc_profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_data))
+        target_profile = self.srgb_profile if target == 'srgb' else self.linear_rgb_profile
+        if reverse:
+            icc_profile, target_profile = target_profile, icc_profile
+        transform = ImageCms.buildTransform(
+            icc_profile, target_profile, in_mode, out_mode, intent
+        )
+        with self._icc_transforms_lock:
+            self._icc_transforms[key] = transform
+            while len(self._icc_transforms) > PillowBackend.MAX_ICC_TRANSFORMS:
+                self._icc_transforms.popitem(last=False)
+        return transform
+
     def _image_flip(self, image, flip, auto_close=True):
         """
         Copies and flips an image left to right ('h') or top to bottom ('v'),
@@ -841,6 +1295,39 @@ class PillowBackend(object):
             image.close()
         return new_image
 
+    def _get_transpose_method(self, flip, angle):
+        """
+        Returns the Pillow transpose method that flips an image left to right
+        ('h') or top to bottom ('v') or neither (''), then rotates it clockwise
+        by an angle that is a multiple of 90 degrees, or None if together
+        these leave the image unchanged.
+        """
+        if flip != 'h' and flip != 'v':
+            flip = ''
+        return {
+            ('', 90): Image.ROTATE_270,
+            ('', 180): Image.ROTATE_180,
+            ('', 270): Image.ROTATE_90,
+            ('h', 0): Image.FLIP_LEFT_RIGHT,
+            ('h', 90): Image.TRANSVERSE,
+            ('h', 180): Image.FLIP_TOP_BOTTOM,
+            ('h', 270): Image.TRANSPOSE,
+            ('v', 0): Image.FLIP_TOP_BOTTOM,
+            ('v', 90): Image.TRANSPOSE,
+            ('v', 180): Image.FLIP_LEFT_RIGHT,
+            ('v', 270): Image.TRANSVERSE,
+        }.get((flip, angle % 360))
+
+    def _image_transpose(self, image, method, auto_close=True):
+        """
+        Copies and transposes an image with a Pillow transpose method,
+        returning the new copy.
+        """
+        new_image = image.transpose(method)
+        if auto_close:
+            image.close()
+        return new_image
+
     def _image_rotate(self, image, angle, quality, fill_rgb, auto_close=True):
         """
         Copies and rotates an image clockwise, returning the new copy.
@@ -855,12 +1342,11 @@ class PillowBackend(object):
             image.close()
         return new_image
 
-    def _image_crop(self, image, crop_top, crop_left, crop_bottom, crop_right,
-                    crop_auto_fit, target_width, target_height, auto_close=True):
+    def _get_crop_box(self, image, crop_top, crop_left, crop_bottom, crop_right,
+                      crop_auto_fit, target_width, target_height):
         """
-        Copies and crops an image, returning the new copy.
-        If target_width is set and target_height is set and auto-fit is True, the
-        requested crop will be expanded in one direction to better match the target size.
+        Returns the (left, top, right, bottom) pixel box to crop an image to,
+        as for _image_crop(), or None if the crop does not change the image.
         """
         # Get the cropping pixels
         top_px = math.ceil(image.height * crop_top)
@@ -877,32 +1363,108 @@ class PillowBackend(object):
                     target_width, target_height
                 )
             if right_px > left_px and bottom_px > top_px:
-                # Crop to the numbers
-                new_image = image.crop((left_px, top_px, right_px, bottom_px))
-                if auto_close:
-                    image.close()
-                return new_image
+                return (left_px, top_px, right_px, bottom_px)
+        return None
+
+    def _image_crop(self, image, crop_top, crop_left, crop_bottom, crop_right,
+                    crop_auto_fit, target_width, target_height, auto_close=True):
+        """
+        Copies and crops an image, returning the new copy.
+        If target_width is set and target_height is set and auto-fit is True, the
+        requested crop will be expanded in one direction to better match the target size.
+        """
+        crop_box = self._get_crop_box(
+            image, crop_top, crop_left, crop_bottom, crop_right,
+            crop_auto_fit, target_width, target_height
+        )
+        if crop_box is not None:
+            # Crop to the numbers
+            new_image = image.crop(crop_box)
+            if auto_close:
+                image.close()
+            return new_image
         # Return unchanged image
         return image
 
-    def _image_resize_bare(self, image, width, height, quality, gamma_correct, auto_close=True):
+    def _get_draft_scale(self, image, image_spec, width, height):
+        """
+        Returns the scale at which a JPEG image can be decoded for an image spec
+        with the requested width and height, keeping the decoded image at least
+        JPEG_DRAFT_MARGIN times larger than required so that the final resize
+        still determines the image quality. Returns 1 if the image cannot be
+        decoded at a reduced size.
+        """
+        if image.format != 'JPEG' or (width == 0 and height == 0):
+            return 1
+        # Get the size of the area that will be resized, after rotation and cropping
+        (full_width, full_height) = image.size
+        if image_spec['rotation']:
+            (full_width, full_height) = _rotated_size(
+                full_width, full_height, image_spec['rotation']
+            )
+        region_width = full_width * (image_spec['right'] - image_spec['left'])
+        region_height = full_height * (image_spec['bottom'] - image_spec['top'])
+        if region_width <= 0 or region_height <= 0:
+            return 1
+        # If both width and height are set, the region is fitted inside them
+        scales = []
+        if width:
+            scales.append(width / region_width)
+        if height:
+            scales.append(height / region_height)
+        return min(scales) * PillowBackend.JPEG_DRAFT_MARGIN
+
+    def _image_draft(self, image, scale):
+        """
+        Configures a JPEG image to be decoded at 1/2, 1/4 or 1/8 scale when
+        the scale from _get_draft_scale() allows, which is much faster and uses
+        much less memory than decoding the full image only to reduce it in size.
+        This must be called before the image pixels are loaded.
+        """
+        if scale <= 0.5:
+            image.draft(None, (
+                math.ceil(image.width * scale),
+                math.ceil(image.height * scale)
+            ))
+
+    def _image_resize_bare(self, image, width, height, quality, gamma_correct,
+                           gamma_lut=False, box=None, auto_close=True):
         """
         Resizes an image, returning a resized copy.
         The quality number can be from 1 (fastest) to 3 (best quality).
         The gamma correction flag controls whether sRGB images are gamma corrected
         during the resize (giving a better quality image but very slow processing).
+        The gamma lookup table flag selects a faster method of gamma correction for
+        RGB images that do not have an embedded colour profile.
+        The optional box is a (left, top, right, bottom) region of the image to
+        resize, which saves cropping the image first.
         """
         use_image = image
-        builtin_profile = None
+        builtin_icc = None
         # Use gamma correction when resizing sRGB images - http://www.4p8.com/eric.brasseur/gamma.html
         # Since Pillow does not have any colorspace awareness, we'll assume that
         # anything in "RGB" mode without an embedded profile is actually sRGB.
         # This topic is discussed at https://github.com/python-pillow/Pillow/issues/1604
         do_gamma_correct = image.mode.startswith('RGB') and gamma_correct
+        if do_gamma_correct and box is not None:
+            # Only convert the colours of the region
+            new_image = self._image_resize_bare(
+                image.crop(box), width, height, quality, gamma_correct, gamma_lut
+            )
+            if auto_close:
+                image.close()
+            return new_image
+        if do_gamma_correct and gamma_lut and image.mode == 'RGB' and \
+                'icc_profile' not in image.info:
+            new_image = self._image_resize_gamma_lut(image, width, height, quality)
+            if auto_close:
+                image.close()
+            return new_image
         if do_gamma_correct:
             if 'icc_profile' in image.info:
-                builtin_profile = ImageCms.ImageCmsProfile(io.BytesIO(image.info['icc_profile']))
-                use_image = ImageCms.profileToProfile(image, builtin_profile, self.linear_rgb_profile)
+                builtin_icc = image.info['icc_profile']
+                transform = self._get_icc_transform(builtin_icc, 'linear', image.mode, image.mode)
+                use_image = ImageCms.applyTransform(image, transform)
             else:
                 transform = self._transform_rgba_srgb_to_linear if image.mode.endswith('A') else \
                             self._transform_rgb_srgb_to_linear
@@ -910,11 +1472,15 @@ class PillowBackend(object):
         # Actual resize here
         new_image = use_image.resize(
             (width, height),
-            resample=self._get_pillow_resample(quality)
+            resample=self._get_pillow_resample(quality),
+            box=box
         )
         if do_gamma_correct:
-            if builtin_profile:
-                new_image = ImageCms.profileToProfile(new_image, self.linear_rgb_profile, builtin_profile)
+            if builtin_icc:
+                transform = self._get_icc_transform(
+                    builtin_icc, 'linear', new_image.mode, new_image.mode, reverse=True
+                )
+                new_image = ImageCms.applyTransform(new_image, transform)
             else:
                 transform = self._transform_rgba_linear_to_srgb if new_image.mode.endswith('A') else \
                             self._transform_rgb_linear_to_srgb
@@ -926,9 +1492,31 @@ class PillowBackend(object):
             image.close()
         return new_image
 
+    def _image_resize_gamma_lut(self, image, width, height, quality):
+        """
+        Resizes an sRGB image in linear light, returning a resized copy.
+        This expands each 8 bit band to floating point linear values with a lookup
+        table, resizes the bands at that precision, then uses a second lookup table
+        to return to 8 bit sRGB. This is faster and more accurate than converting
+        the whole image to and from an 8 bit linear colour profile.
+        """
+        resample = self._get_pillow_resample(quality)
+        new_bands = []
+        for band in image.split():
+            linear_band = band.point(self._lut_srgb_to_linear, 'F')
+            band.close()
+            new_band = linear_band.resize((width, height), resample=resample)
+            linear_band.close()
+            int_band = new_band.convert('I')
+            new_band.close()
+            # Pillow clamps the out of range values that resampling can produce
+            new_bands.append(int_band.point(self._lut_linear_to_srgb, 'L'))
+            int_band.close()
+        return Image.merge(image.mode, new_bands)
+
     def _image_resize(self, image, width, height, size_auto_fit,
                       align_h, align_v, fill_rgb, quality, gamma_correct,
-                      auto_close=True):
+                      gamma_lut=False, box=None, auto_close=True):
         """
         Resizes an image, returning a resized copy.
         Width or height can be 0 to use the image's original width or height.
@@ -944,15 +1532,21 @@ class PillowBackend(object):
         The quality number can be from 1 (fastest) to 3 (best quality).
         The gamma correction flag controls whether sRGB images are gamma corrected
         during the resize (giving a better quality image but very slow processing).
+        The gamma lookup table flag and optional box are as for _image_resize_bare(),
+        with the box (if given) being treated as the whole image.
         """
-        cur_aspect = image.width / image.height
+        if box is not None:
+            (src_width, src_height) = (box[2] - box[0], box[3] - box[1])
+        else:
+            (src_width, src_height) = image.size
+        cur_aspect = src_width / src_height
         resize_canvas = False
 
         # Determine the final image dimensions
         if width == 0 and height == 0:
             # Keep the old dimensions
-            width = image.width
-            height = image.height
+            width = src_width
+            height = src_height
         elif width == 0 or height == 0:
             # Auto-resize based on the one dimension specified
             if width == 0:
@@ -978,10 +1572,13 @@ class PillowBackend(object):
         new_image = None
         if not resize_canvas:
             # Plain image resize
-            if width != image.width or height != image.height:
+            if width != src_width or height != src_height:
                 new_image = self._image_resize_bare(
-                    image, width, height, quality, gamma_correct, auto_close=False
+                    image, width, height, quality, gamma_correct, gamma_lut, box,
+                    auto_close=False
                 )
+            elif box is not None:
+                new_image = image.crop(box)
         else:
             canvas_width = width
             canvas_height = height
@@ -1002,10 +1599,13 @@ class PillowBackend(object):
                 height = canvas_height
 
             # First perform plain image resize
-            if width != image.width or height != image.height:
+            if width != src_width or height != src_height:
                 new_image = self._image_resize_bare(
-                    image, width, height, quality, gamma_correct, auto_close=False
+                    image, width, height, quality, gamma_correct, gamma_lut, box,
+                    auto_close=False
                 )
+            elif box is not None:
+                new_image = image.crop(box)
 
             # Then adjust the canvas if required
             if width != canvas_width or height != canvas_height:
@@ -1343,3 +1943,21 @@ def _limit_number(val, min_val, max_val):
     elif val > max_val:
         return max_val
     return val
+
+
+def _srgb_to_linear(val):
+    """
+    Returns the linear light value 0 to 1 for an sRGB encoded value 0 to 1.
+    """
+    if val <= 0.04045:
+        return val / 12.92
+    return ((val + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(val):
+    """
+    Returns the sRGB encoded value 0 to 1 for a linear light value 0 to 1.
+    """
+    if val <= 0.0031308:
+        return val * 12.92
+    return (1.055 * (val ** (1 / 2.4))) - 0.055
@@ -74,6 +74,58 @@ SYS_PERMISSIONS_TEXT = {
 }
 
 
+class FolderPermissionTree(object):
+    """
+    An in-memory tree of folder permissions, with one node per folder path
+    component. Each node holds the access levels of the groups that have a
+    folder permission for that folder, so that the nearest folder permission
+    for any folder and group can be found without accessing the database.
+
+    The tree is read-only once created. It is tagged with the folder
+    permissions data version number that it was created for.
+    """
+    def __init__(self, version, folder_permissions):
+        """
+        Creates the tree from a list of (folder path, group ID, access level)
+        tuples, as returned from DataManager.list_folder_permission_paths().
+        """
+        self.version = version
+        # Nodes are tuples of ({child name: node}, {group ID: access level})
+        self._root = ({}, {})
+        for (path, group_id, access) in folder_permissions:
+            node = self._root
+            for name in self._split_path(path):
+                node = node[0].setdefault(name, ({}, {}))
+            node[1][group_id] = access
+
+    def get_nearest_access(self, folder_path, group_ids):
+        """
+        Returns a dictionary of {group ID: access level} for the given groups,
+        taken from the nearest folder permission for each group, looking first
+        at the folder path and then at each of its parents up to the root folder.
+        Groups that have no folder permission in any of these folders are not
+        included in the returned dictionary.
+        """
+        nodes = [self._root]
+        for name in self._split_path(folder_path):
+            node = nodes[-1][0].get(name)
+            if node is None:
+                break
+            nodes.append(node)
+        nodes.reverse()
+        group_access = {}
+        for group_id in group_ids:
+            for node in nodes:
+                access = node[1].get(group_id)
+                if access is not None:
+                    group_access[group_id] = access
+                    break
+        return group_access
+
+    def _split_path(self, path):
+        return [name for name in filepath_normalize(path).split(os.path.sep) if name]
+
+
 class PermissionsManager(object):
     """
     Provides permissions checking routines for the image server,
@@ -88,6 +140,10 @@ class PermissionsManager(object):
     granular, span across groups, and employ inheritance) and accessing them
     requires the app's singleton instance of PermissionsManager.
 
+    The folder permissions themselves are loaded into an in-memory tree in each
+    process, so that calculating the access level for a folder does not require
+    a database query for each folder level and group.
+
     Folder permissions for unknown users are cached in our own in-memory cache.
     Because this looks only at the Public group, it has a finite (and relatively
     small) size, and entries can be stored "permanently" (until the permissions
@@ -119,6 +175,8 @@ class PermissionsManager(object):
         self._fp_data_version = 0
         self._fp_last_check = None
         self._fp_public_cache = KeyValueCache()      # Public (unknown user) folder permissions
+        self._fp_tree = None                         # All folder permissions, by path
+        self._fp_tree_lock = threading.Lock()
         # Our current folio permissions data version number.
         # If the database has a newer version we need to re-read it.
         self._foliop_data_version = 0
@@ -398,73 +456,56 @@ class PermissionsManager(object):
         db_session = self._db.db_get_session()
         db_commit = False
         try:
-            # Get the folder and public group objects
+            # Get the folder object
             db_folder = db_session.merge(folder, load=False) if hasattr(folder, 'path') else \
                         auto_sync_folder(folder, self._db, self._tasks, _db_session=db_session)
-            db_public_group = self._db.get_group(
-                group_id=Group.ID_PUBLIC,
-                load_users=False,
-                _db_session=db_session
-            )
             # Handle non-existent folder
             if db_folder is None and not folder_must_exist:
                 db_folder = _get_nearest_parent_folder(folder_path, self._db, db_session)
-            # Hopefully won't need these
+            # Hopefully won't need this
             if db_folder is None:
                 raise DoesNotExistError(folder_path)
-            if db_public_group is None:
-                raise DoesNotExistError('Public group')
+
+            # Get the groups to look at
+            if user is None:
+                group_ids = [Group.ID_PUBLIC]
+            else:
+                db_user = user if self._db.attr_is_loaded(user, 'groups') else \
+                          self._db.get_user(user.id, load_groups=True, _db_session=db_session)
+                # Hopefully won't need this
+                if db_user is None:
+                    raise DoesNotExistError('User %d' % user.id)
+                group_ids = [Group.ID_PUBLIC] + [g.id for g in db_user.groups]
+
+            # Get the nearest folder permission for each group from memory
+            fp_tree = self._get_folder_permission_tree(current_version)
+            group_access = fp_tree.get_nearest_access(db_folder.path, group_ids)
 
             # Get the Public group access
-            public_permission = self._db.get_nearest_folder_permission(
-                db_folder,
-                db_public_group,
-                _db_session=db_session
-            )
-            if public_permission is None:
+            public_access = group_access.get(Group.ID_PUBLIC)
+            if public_access is None:
                 # Hopefully never get here
                 self._logger.error('No root folder permission found for the Public group')
-                public_permission = FolderPermission(
-                    db_folder, db_public_group, FolderPermission.ACCESS_NONE
-                )
+                public_access = FolderPermission.ACCESS_NONE
 
             if user is None:
                 # Debug log only
                 if self._settings['DEBUG']:
                     self._logger.debug(
                         'Public access to folder ' + folder_path +
-                        ' is ' + str(public_permission)
+                        ' is ' + str(public_access)
                     )
                 # Add result to cache and return it
                 self._fp_public_cache.set(
                     folder_path,
-                    (public_permission.access, current_version)
+                    (public_access, current_version)
                 )
                 db_commit = True
-                return public_permission.access
+                return public_access
             else:
-                db_user = user if self._db.attr_is_loaded(user, 'groups') else \
-                          self._db.get_user(user.id, load_groups=True, _db_session=db_session)
-                # Hopefully won't need this
-                if db_user is None:
-                    raise DoesNotExistError('User %d' % user.id)
-
-                # Look at access for each of the user's groups
-                final_access = FolderPermission.ACCESS_NONE
-                for db_user_group in db_user.groups:
-                    g_permission = self._db.get_nearest_folder_permission(
-                        db_folder,
-                        db_user_group,
-                        _db_session=db_session
-                    )
-                    # The final access = the highest level from all the groups
-                    if g_permission is not None and g_permission.access > final_access:
-                        final_access = g_permission.access
-                        # Fast path
-                        if final_access == FolderPermission.ACCESS_ALL:
-                            break
-                # Use the public group access as a fallback
-                final_access = max(public_permission.access, final_access)
+                # The final access = the highest level from all the groups,
+                # using the public group access as a fallback
+                final_access = max([public_access] + list(group_access.values()))
                 # Debug log only
                 if self._settings['DEBUG']:
                     self._logger.debug(
@@ -699,6 +740,27 @@ class PermissionsManager(object):
                     self._foliop_last_check = datetime.utcnow()
                     self._data_refresh_lock.release()
 
+    def _get_folder_permission_tree(self, version):
+        """
+        Returns a FolderPermissionTree containing all the folder permissions
+        in the database, loading it if we do not yet have one for the given
+        folder permissions data version number.
+        """
+        fp_tree = self._fp_tree
+        if fp_tree is None or fp_tree.version != version:
+            with self._fp_tree_lock:
+                fp_tree = self._fp_tree
+                if fp_tree is None or fp_tree.version != version:
+                    fp_tree = FolderPermissionTree(
+                        version,
+                        self._db.list_folder_permission_paths()
+                    )
+                    self._fp_tree = fp_tree
+                    self._logger.debug(
+                        'Folder permissions loaded for version ' + str(version)
+                    )
+        return fp_tree
+
     def _get_cache_key(self, user, path):
         """
         Returns the cache key to use for caching a user+folder permission.
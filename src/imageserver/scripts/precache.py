@@ -40,70 +40,223 @@
 #
 # Images that are already cached are not re-generated.
 #
+# A single scanner thread walks the directory tree and feeds matching files
+# into a bounded queue, from which a pool of worker threads generates the
+# templated images. Each file is handled by one worker, which generates all
+# of the templates together from a single read and decode of the original image.
+#
+# When a checkpoint file is given, each directory is recorded there once all
+# of its files have been processed, and those directories are skipped when the
+# utility is re-run with the same checkpoint file.
+#
 # Usage: su <qis user>
 #        (optional) export QIS_SETTINGS=<path to your settings.py>
-#        python precache.py [-silent] start_dir file_spec(s) template_name(s)
+#        python precache.py [-silent] [-workers=n] [-rate=n] [-checkpoint=file]
+#                           start_dir file_spec(s) template_name(s)
 #
 
 import fnmatch
 import os
+import queue
 import site
 import signal
 import sys
+import threading
+import time
 
 RETURN_OK = 0
 RETURN_MISSING_PARAMS = 1
 RETURN_BAD_PARAMS = 2
 RETURN_CACHE_ERROR = 3
 
-silent = False
-
+# Stop when the cache reaches this level
+CACHE_FULL_PERCENT = 80
+# How often to check the cache level and report progress
+PROGRESS_INTERVAL_SECS = 10
+# How many files to queue up per worker thread
+QUEUE_SIZE_PER_WORKER = 10
 
-class CacheFullException(Exception):
-    """
-    Raised when the image server cache is full.
-    """
-    pass
+silent = False
 
 
 class PreCacheStats():
     """
-    Pre-caching statistics handler.
+    Pre-caching statistics handler. This class is thread-safe.
     """
     def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.time()
         self.total_dir_count = 0
         self.total_file_count = 0
         self.dir_skipped_count = 0
+        self.dir_resumed_count = 0
+        self.files_done_count = 0
         self.images_created_count = 0
         self.images_error_count = 0
         self.images_already_cached_count = 0
 
+    def _inc(self, counter_name):
+        with self._lock:
+            setattr(self, counter_name, getattr(self, counter_name) + 1)
+
     def inc_total_dir_count(self):
-        self.total_dir_count = self.total_dir_count + 1
+        self._inc('total_dir_count')
 
     def inc_total_file_count(self):
-        self.total_file_count = self.total_file_count + 1
+        self._inc('total_file_count')
 
     def inc_dir_skipped_count(self):
-        self.dir_skipped_count = self.dir_skipped_count + 1
+        self._inc('dir_skipped_count')
+
+    def inc_dir_resumed_count(self):
+        self._inc('dir_resumed_count')
+
+    def inc_files_done_count(self):
+        self._inc('files_done_count')
 
     def inc_images_created_count(self):
-        self.images_created_count = self.images_created_count + 1
+        self._inc('images_created_count')
 
     def inc_images_error_count(self):
-        self.images_error_count = self.images_error_count + 1
+        self._inc('images_error_count')
 
     def inc_images_already_cached_count(self):
-        self.images_already_cached_count = self.images_already_cached_count + 1
+        self._inc('images_already_cached_count')
+
+    def files_per_second(self):
+        """
+        Returns the average number of files processed per second so far.
+        """
+        elapsed = time.time() - self.start_time
+        return (self.files_done_count / elapsed) if elapsed > 0 else 0.0
+
+
+class PreCacheCheckpoint():
+    """
+    Records the directories that have been completely processed, so that an
+    interrupted run can be resumed. The checkpoint file is a plain text file
+    containing the run parameters on the first line followed by one completed
+    directory (relative to IMAGES_BASE_DIR) per line. This class is thread-safe.
+    """
+    def __init__(self, file_path, file_specs, templates):
+        """
+        Opens or creates the checkpoint file at file_path, or if file_path is
+        empty, creates a checkpoint object that records nothing. Raises a
+        ValueError if the checkpoint file was created for different file specs
+        or templates, or an OSError if the file cannot be read or written.
+        """
+        self._lock = threading.Lock()
+        self._done_dirs = set()
+        self._file = None
+        if not file_path:
+            return
+        signature = '# %s %s' % (','.join(file_specs), ','.join(templates))
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf8') as f:
+                lines = f.read().splitlines()
+            if lines and lines[0] != signature:
+                raise ValueError(
+                    'Checkpoint file %s was created for different file specs or '
+                    'templates (%s). Delete it or use another file.' % (
+                        file_path, lines[0][2:]
+                    )
+                )
+            self._done_dirs.update(lines[1:])
+            self._file = open(file_path, 'a', encoding='utf8')
+            if not lines:
+                self._write(signature)
+        else:
+            self._file = open(file_path, 'w', encoding='utf8')
+            self._write(signature)
+
+    def is_done(self, relative_dir):
+        """
+        Returns whether a directory was recorded as complete by a previous run.
+        """
+        return relative_dir in self._done_dirs
+
+    def set_done(self, relative_dir):
+        """
+        Records that all files in a directory have been processed.
+        """
+        if self._file is not None:
+            with self._lock:
+                self._write(relative_dir)
+
+    def close(self):
+        if self._file is not None:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+    def _write(self, line):
+        # Flush every line so that nothing is lost if the process is killed
+        self._file.write(line + '\n')
+        self._file.flush()
+
+
+class DirectoryTracker():
+    """
+    Counts the files outstanding in each directory so that a directory can be
+    checkpointed once its last file has been processed. This class is thread-safe.
+    """
+    def __init__(self, checkpoint):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._checkpoint = checkpoint
+
+    def add_dir(self, relative_dir, file_count):
+        if file_count == 0:
+            self._checkpoint.set_done(relative_dir)
+        else:
+            with self._lock:
+                self._pending[relative_dir] = file_count
+
+    def file_done(self, relative_dir):
+        with self._lock:
+            remaining = self._pending[relative_dir] - 1
+            if remaining == 0:
+                del self._pending[relative_dir]
+            else:
+                self._pending[relative_dir] = remaining
+        if remaining == 0:
+            self._checkpoint.set_done(relative_dir)
 
 
-def precache_images(start_dir, file_specs, templates):
+class RateLimiter():
+    """
+    Spaces out calls to wait() so that they return no more than a given
+    number of times per second, across all threads. A rate of 0 is unlimited.
+    """
+    def __init__(self, rate):
+        self._lock = threading.Lock()
+        self._interval = (1.0 / rate) if rate > 0 else 0
+        self._next_time = time.time()
+
+    def wait(self, stop_event):
+        """
+        Blocks until the caller is allowed to proceed, or the stop event is set.
+        """
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.time()
+            slot_time = max(self._next_time, now)
+            self._next_time = slot_time + self._interval
+        if slot_time > now:
+            stop_event.wait(slot_time - now)
+
+
+def precache_images(start_dir, file_specs, templates,
+                    workers=None, rate=0, checkpoint_file=None):
     """
     Performs the main pre-caching function as described by the file header.
+    The workers parameter sets the number of image processing threads to run
+    (default is the number of CPUs), rate sets the maximum number of files to
+    process per second (default 0 for unlimited), and checkpoint_file is an
+    optional file path for recording progress and resuming a previous run.
     """
     from imageserver.flask_app import app
-    from imageserver.filesystem_sync import auto_sync_existing_file
-    from imageserver.image_attrs import ImageAttrs
     from imageserver.util import add_sep
 
     # Disable logging to prevent app startup and image errors going to main log
@@ -113,84 +266,94 @@ def precache_images(start_dir, file_specs, templates):
     rc = validate_params(start_dir, file_specs, templates)
     if (rc != RETURN_OK):
         return rc
+    if not workers or workers < 1:
+        workers = os.cpu_count() or 1
+
+    # Open or create the checkpoint file
+    try:
+        checkpoint = PreCacheCheckpoint(checkpoint_file, file_specs, templates)
+    except (ValueError, OSError) as e:
+        error(str(e))
+        return RETURN_BAD_PARAMS
 
     # Get base path with trailing /
     images_base_dir = add_sep(os.path.abspath(app.config['IMAGES_BASE_DIR']))
 
     # Init stats and stop conditions
     stats = PreCacheStats()
+    tracker = DirectoryTracker(checkpoint)
+    limiter = RateLimiter(rate)
+    work_queue = queue.Queue(maxsize=workers * QUEUE_SIZE_PER_WORKER)
+    stop_event = threading.Event()
     last_cache_pct = 0
     cache_full = False
     keyboard_interrupt = False
 
-    # Get directory walking errors
-    def walk_err(os_error):
-        stats.inc_dir_skipped_count()
-
-    # Walk directory tree
+    def scan_files():
+        try:
+            scan_directories(
+                start_dir, images_base_dir, file_specs,
+                checkpoint, tracker, work_queue, stop_event, stats
+            )
+        except Exception as e:
+            log('ERROR: Directory scan failed: ' + str(e))
+        finally:
+            # Tell the workers there is nothing more to come
+            for _ in range(workers):
+                work_queue.put(None)
+
+    def process_files():
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            if stop_event.is_set():
+                # Drain the queue, leaving the directory incomplete
+                continue
+            limiter.wait(stop_event)
+            relative_dir, file_name = item
+            precache_file(app, relative_dir, file_name, templates, stats)
+            stats.inc_files_done_count()
+            tracker.file_done(relative_dir)
+
+    log('Starting %d worker thread(s)%s' % (
+        workers, (', max %s files per second' % rate) if rate > 0 else ''
+    ))
+    threads = [threading.Thread(target=scan_files, name='precache-scanner')]
+    threads.extend([
+        threading.Thread(target=process_files, name='precache-worker-%d' % (i + 1))
+        for i in range(workers)
+    ])
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    # Monitor progress until done or the cache is full (or now self-emptying)
     try:
-        for cur_dir, sub_dirs, files in os.walk(
-            start_dir, onerror=walk_err, followlinks=True
-        ):
-            log(cur_dir)
-            stats.inc_total_dir_count()
-            # Remove files and directories beginning with '.'
-            for d in sub_dirs:
-                if d.startswith('.'):
-                    sub_dirs.remove(d)
-            for f in files:
-                if f.startswith('.'):
-                    files.remove(f)
-            # Get relative path from IMAGES_BASE_DIR/
-            if not cur_dir.startswith(images_base_dir):
-                log('ERROR: Cannot calculate relative image path from ' + str(cur_dir))
-                stats.inc_dir_skipped_count()
-            else:
-                relative_dir = cur_dir[len(images_base_dir):]
-                # Apply file specs
-                for file_spec in file_specs:
-                    file_matches = fnmatch.filter(files, file_spec)
-                    for file_name in file_matches:
-                        # Check whether the cache is full (or now self-emptying) once in a while
-                        if stats.total_file_count % 10 == 0:
-                            cache_pct = app.cache_engine.size_percent()
-                            log('\tCache level %d%%' % cache_pct)
-                            if (cache_pct < last_cache_pct) or (cache_pct >= 80):
-                                raise CacheFullException()
-                            else:
-                                last_cache_pct = cache_pct
-                        # Process matched file
-                        stats.inc_total_file_count()
-                        for template in templates:
-                            try:
-                                log('\tProcessing %s with template %s' % (file_name, template))
-                                image_path = os.path.join(relative_dir, file_name)
-                                db_image = auto_sync_existing_file(
-                                    image_path, app.data_engine, app.task_engine
-                                )
-                                image_attrs = ImageAttrs(
-                                    db_image.src, db_image.id, template=template
-                                )
-                                app.image_engine.finalise_image_attrs(image_attrs)
-                                gen_image = app.image_engine.get_image(image_attrs)
-                                if gen_image.is_from_cache():
-                                    log('\tImage already in cache')
-                                    stats.inc_images_already_cached_count()
-                                else:
-                                    log('\tGenerated %s image, %d bytes' % (
-                                        gen_image.attrs().format(), len(gen_image.data())
-                                    ))
-                                    stats.inc_images_created_count()
-                            except KeyboardInterrupt as kbe:
-                                raise kbe
-                            except Exception as e:
-                                log('ERROR: ' + str(e))
-                                stats.inc_images_error_count()
-    except CacheFullException:
-        cache_full = True
+        while any(t.is_alive() for t in threads):
+            threads[-1].join(PROGRESS_INTERVAL_SECS)
+            if not any(t.is_alive() for t in threads):
+                break
+            cache_pct = app.cache_engine.size_percent()
+            log_progress(stats, work_queue, cache_pct)
+            if (cache_pct < last_cache_pct) or (cache_pct >= CACHE_FULL_PERCENT):
+                cache_full = True
+                break
+            last_cache_pct = cache_pct
     except KeyboardInterrupt:
         keyboard_interrupt = True
 
+    # Let the workers finish their current files
+    if cache_full or keyboard_interrupt:
+        log('Stopping, waiting for current images to complete...')
+        stop_event.set()
+        try:
+            for t in threads:
+                t.join()
+        except KeyboardInterrupt:
+            pass
+    checkpoint.close()
+
     # Show stop reason and stats
     if keyboard_interrupt:
         log('---\nInterrupted by user.\n---')
@@ -202,14 +365,124 @@ def precache_images(start_dir, file_specs, templates):
     log('%d matching file(s) found in %d directories.' % (
         stats.total_file_count, stats.total_dir_count
     ))
+    log('%d file(s) processed in %d seconds (%.1f per second).' % (
+        stats.files_done_count, time.time() - stats.start_time, stats.files_per_second()
+    ))
     log('%d image(s) were generated and cached.' % stats.images_created_count)
     log('%d image(s) were already in cache.' % stats.images_already_cached_count)
     log('%d image(s) skipped due to error.' % stats.images_error_count)
     log('%d directories skipped due to error.' % stats.dir_skipped_count)
+    log('%d directories skipped as completed by a previous run.' % stats.dir_resumed_count)
     log('Cache is now %d%% full.' % app.cache_engine.size_percent())
     return RETURN_OK
 
 
+def scan_directories(start_dir, images_base_dir, file_specs,
+                     checkpoint, tracker, work_queue, stop_event, stats):
+    """
+    Walks the directory tree from start_dir, adding a (relative directory,
+    file name) tuple to work_queue for every file that matches file_specs,
+    until there are no more files or until stop_event is set.
+    """
+    from imageserver.util import add_sep
+
+    # Get directory walking errors
+    def walk_err(os_error):
+        stats.inc_dir_skipped_count()
+
+    for cur_dir, sub_dirs, files in os.walk(
+        start_dir, onerror=walk_err, followlinks=True
+    ):
+        if stop_event.is_set():
+            return
+        log(cur_dir)
+        stats.inc_total_dir_count()
+        # Remove files and directories beginning with '.'
+        # and walk in a consistent order
+        sub_dirs[:] = sorted(d for d in sub_dirs if not d.startswith('.'))
+        files = sorted(f for f in files if not f.startswith('.'))
+        # Get relative path from IMAGES_BASE_DIR/
+        cur_dir = add_sep(os.path.abspath(cur_dir))
+        if not cur_dir.startswith(images_base_dir):
+            log('ERROR: Cannot calculate relative image path from ' + str(cur_dir))
+            stats.inc_dir_skipped_count()
+            continue
+        relative_dir = cur_dir[len(images_base_dir):].rstrip(os.path.sep)
+        if checkpoint.is_done(relative_dir):
+            stats.inc_dir_resumed_count()
+            continue
+        # Apply file specs, each file only once
+        file_matches = [
+            f for f in files
+            if any(fnmatch.fnmatch(f, file_spec) for file_spec in file_specs)
+        ]
+        tracker.add_dir(relative_dir, len(file_matches))
+        for file_name in file_matches:
+            stats.inc_total_file_count()
+            while True:
+                if stop_event.is_set():
+                    return
+                try:
+                    work_queue.put((relative_dir, file_name), timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+
+def precache_file(app, relative_dir, file_name, templates, stats):
+    """
+    Generates and caches the images for one file with all the given templates.
+    """
+    from imageserver.filesystem_sync import auto_sync_existing_file
+    from imageserver.image_attrs import ImageAttrs
+
+    image_path = os.path.join(relative_dir, file_name)
+    try:
+        db_image = auto_sync_existing_file(
+            image_path, app.data_engine, app.task_engine
+        )
+        if db_image is None:
+            raise ValueError('File not found: ' + image_path)
+    except Exception as e:
+        log('ERROR: %s: %s' % (image_path, str(e)))
+        for _ in templates:
+            stats.inc_images_error_count()
+        return
+
+    try:
+        image_attrs_list = []
+        for template in templates:
+            image_attrs = ImageAttrs(db_image.src, db_image.id, template=template)
+            app.image_engine.finalise_image_attrs(image_attrs)
+            image_attrs_list.append(image_attrs)
+        gen_images = app.image_engine.get_image_variants(image_attrs_list)
+    except Exception as e:
+        gen_images = [e] * len(templates)
+
+    for (template, gen_image) in zip(templates, gen_images):
+        if gen_image is None:
+            gen_image = ValueError('File could not be read')
+        if isinstance(gen_image, Exception):
+            log('ERROR: %s with template %s: %s' % (image_path, template, str(gen_image)))
+            stats.inc_images_error_count()
+        elif gen_image.is_from_cache():
+            stats.inc_images_already_cached_count()
+        else:
+            stats.inc_images_created_count()
+
+
+def log_progress(stats, work_queue, cache_pct):
+    """
+    Outputs a one-line progress and throughput report.
+    """
+    log('\t%d of %d file(s) processed, %d queued, %.1f per second, '
+        '%d generated, %d errors, cache level %d%%' % (
+            stats.files_done_count, stats.total_file_count, work_queue.qsize(),
+            stats.files_per_second(), stats.images_created_count,
+            stats.images_error_count, cache_pct
+        ))
+
+
 def validate_params(start_dir, file_specs, templates):
     """
     Validates the command line parameters, returning 0 on success or a code
@@ -275,35 +548,54 @@ def show_usage():
     print('CPU usage for as long as it is running. The utility will stop either when there')
     print('are no more files to process, or when the cache is 80% full.')
     print('\nUsage: su <qis user>')
-    print('       python precache.py [-silent] start_dir file_spec(s) template(s)')
+    print('       python precache.py [-silent] [-workers=n] [-rate=n] [-checkpoint=file]')
+    print('                          start_dir file_spec(s) template(s)')
     print('Where:')
-    print('       -silent   (optional) suppresses output to the console.')
-    print('       start_dir is the directory to search recursively.')
-    print('       file_spec is one or more image file names to match.')
-    print('       template  is one or more template names defined in the image server that')
-    print('                 describe how the images found are to be processed.')
-    print('\nExample: python precache.py /home/images/ *.jpg,*.tif MediumJpeg,SmallJpeg')
-    print('\nWhen specifying multiple templates to generate different sizes of image,')
-    print('as in the example, order the templates with the largest image size first')
-    print('to speed up processing (the second template can use the output from the first).')
+    print('       -silent     (optional) suppresses output to the console.')
+    print('       -workers    (optional) is the number of images to process in parallel.')
+    print('                   The default is the number of CPUs.')
+    print('       -rate       (optional) is the maximum number of files to process per')
+    print('                   second. The default is unlimited.')
+    print('       -checkpoint (optional) is a file in which to record completed directories.')
+    print('                   Re-running with the same checkpoint file skips those')
+    print('                   directories, resuming an earlier run that was interrupted.')
+    print('       start_dir   is the directory to search recursively.')
+    print('       file_spec   is one or more image file names to match.')
+    print('       template    is one or more template names defined in the image server')
+    print('                   that describe how the images found are to be processed.')
+    print('\nExample: python precache.py -workers=8 -checkpoint=/tmp/precache.txt \\')
+    print('            /home/images/ *.jpg,*.tif MediumJpeg,SmallJpeg')
+    print('\nWhen specifying multiple templates, all the templates for each image are')
+    print('generated together, so that each original image only needs to be read once.')
 
 
 def get_parameters():
     """
-    Returns a tuple of 3 items for the parameters provided on the command line.
-    These are: the start directory as a string, the file specs as a list, and
-    the template names as a list. Either a value of None or an empty list is
-    returned if the command line parameter was missing.
+    Returns a tuple of 6 items for the parameters provided on the command line.
+    These are: the start directory as a string, the file specs as a list, the
+    template names as a list, the number of workers as an integer, the rate
+    limit as a float, and the checkpoint file path as a string. Either a value
+    of None, zero, or an empty list is returned if the command line parameter
+    was missing. Raises a ValueError if a numeric parameter is invalid.
     """
     start_dir = None
     file_specs = []
     templates = []
+    workers = None
+    rate = 0
+    checkpoint_file = None
     for arg in sys.argv:
         if arg == __file__:
             pass
         elif arg == '-silent':
             global silent
             silent = True
+        elif arg.startswith('-workers='):
+            workers = int(arg[len('-workers='):])
+        elif arg.startswith('-rate='):
+            rate = float(arg[len('-rate='):])
+        elif arg.startswith('-checkpoint='):
+            checkpoint_file = arg[len('-checkpoint='):]
         elif start_dir is None:
             start_dir = arg
         elif len(file_specs) == 0:
@@ -311,7 +603,7 @@ def get_parameters():
         else:
             templates = arg.lower().split(',')
 
-    return start_dir, file_specs, templates
+    return start_dir, file_specs, templates, workers, rate, checkpoint_file
 
 
 if __name__ == '__main__':
@@ -321,12 +613,14 @@ if __name__ == '__main__':
         site.addsitedir('../..')
         site.addsitedir('../../../lib/python%d.%d/site-packages' % (pver.major, pver.minor))
         # Get params
-        start_dir, file_specs, templates = get_parameters()
+        start_dir, file_specs, templates, workers, rate, checkpoint_file = get_parameters()
         if not start_dir or not file_specs or not templates:
             show_usage()
             exit(RETURN_MISSING_PARAMS)
         else:
-            rc = precache_images(start_dir, file_specs, templates)
+            rc = precache_images(
+                start_dir, file_specs, templates, workers, rate, checkpoint_file
+            )
             exit(rc)
 
     except Exception as e:
@@ -449,6 +449,7 @@ Publisher.webFieldToTemplateKey = function(param) {
 		case 'intent': return 'icc_intent';
 		case 'bpc': return 'icc_bpc';
 		case 'dpi': return 'dpi_x';
+		case 'maxbytes': return 'max_bytes';
 		// TemplateAttrs
 		case 'attach': return 'attachment';
 		case 'expiry': return 'expiry_secs';
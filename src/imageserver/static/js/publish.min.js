@@ -95,7 +95,7 @@ if(g!==h){Publisher.refreshCropImage();}Publisher.onChange();};Publisher.webFiel
 case"tmp":return"template";case"halign":return"align_h";case"valign":return"align_v";case"angle":return"rotation";
 case"autocropfit":return"crop_fit";case"autosizefit":return"size_fit";case"overlay":return"overlay_src";
 case"ovpos":return"overlay_pos";case"ovsize":return"overlay_size";case"ovopacity":return"overlay_opacity";
-case"icc":return"icc_profile";case"intent":return"icc_intent";case"bpc":return"icc_bpc";case"dpi":return"dpi_x";
+case"icc":return"icc_profile";case"intent":return"icc_intent";case"bpc":return"icc_bpc";case"dpi":return"dpi_x";case"maxbytes":return"max_bytes";
 case"attach":return"attachment";case"expiry":return"expiry_secs";case"stats":return"record_stats";default:return a;
 }};Publisher.templateToKV=function(b){var c={};for(var a in b){c[a]=b[a].value;}return c;};Publisher.fromPx=function(d,b,a){var c=d/a;
 switch(b){case"px":return d;case"in":return c.toFixed(3);case"mm":return(c/0.0393701).toFixed(3);default:return 0;
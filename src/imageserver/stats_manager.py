@@ -30,10 +30,12 @@
 # 04Jan2013  Matt  Move run_server to a static method, do not call from client constructor
 #
 
+import atexit
 import json
+import os
 import socket
 import time
-from threading import Lock
+from threading import Event, Lock, Thread
 
 import imageserver.auxiliary.stats_server as stats_server
 from imageserver.util import this_is_computer
@@ -48,13 +50,19 @@ class StatsManager(object):
     Provides the ability to launch a stats recording server process,
     and a set of client functions that can be called to record image accesses.
     """
-    def __init__(self, logger, server_host, server_port):
+    def __init__(self, logger, server_host, server_port, batch_msecs=0, batch_events=0):
         """
         Initialises a stats logging client.
 
         logger       - a logger for client messages
         server_host  - the name or IP address of the stats server
         server_port  - the port number of the stats server
+        batch_msecs  - when greater than 0, the stats are added up in this process
+                       and sent to the server as a single binary frame at this
+                       interval, instead of being sent once per request
+        batch_events - when batching, also send the stats early if this number
+                       of events have been logged since the last send,
+                       or 0 for no limit
 
         The log functions connect to the stats server automatically.
         Statistics can be disabled by providing an empty string for server_host
@@ -66,6 +74,17 @@ class StatsManager(object):
         self._sock = None
         self._sock_lock = Lock()
         self._sock_last_connect = 0
+        # Local aggregation, {image_id: [stats values in FRAME_FIELDS order + max_request_seconds]}
+        self._batch_secs = max(batch_msecs, 0) / 1000.0
+        self._batch_events = max(batch_events, 0)
+        self._agg = {}
+        self._agg_events = 0
+        self._agg_lock = Lock()
+        self._flush_event = Event()
+        self._thread_lock = Lock()
+        self._thread_pid = 0
+        if self._batch_secs:
+            atexit.register(self.flush)
         # Do not send stats if we have no host name or port
         self.set_enabled(server_host and (server_port > 0))
 
@@ -104,7 +123,8 @@ class StatsManager(object):
 
     def _send(self, data):
         """
-        Internal function that sends an object to the stats server.
+        Internal function that sends an object to the stats server,
+        or if data is a bytes object, sends it unchanged.
         Returns a boolean indicating success.
         Due to TCP buffering it is possible for a few objects to be accepted
         for sending (and returning success) after the remote end of the connection
@@ -123,7 +143,11 @@ class StatsManager(object):
                             return False
 
             with self._sock_lock:
-                self._sock.send(bytes(json.dumps(data) + "\r\n", "utf8"))
+                if isinstance(data, bytes):
+                    # Frames can be large, and must not be partially sent
+                    self._sock.sendall(data)
+                else:
+                    self._sock.sendall(bytes(json.dumps(data) + "\r\n", "utf8"))
             return True
 
         except Exception as e:
@@ -132,6 +156,90 @@ class StatsManager(object):
                 self._client_close()
             return False
 
+    def _aggregate(self, image_id, views, cached_views, downloads, size,
+                   duration_secs, write_image_stats):
+        """
+        Internal function that adds an image request to the local stats totals,
+        for sending to the stats server later in a single frame by flush().
+        """
+        if not self._enabled:
+            return
+        self._start_flush_thread()
+        with self._agg_lock:
+            agg = self._agg
+            if image_id and not write_image_stats:
+                # Bump requests in both system stats and image stats
+                istats = agg.get(image_id)
+                if istats is None:
+                    istats = agg[image_id] = [0, 0, 0, 0, 0, 0.0, 0.0]
+                istats[0] += 1
+                # Then update system stats only
+                requests = 0
+                image_id = 0
+            else:
+                requests = 1
+            istats = agg.get(image_id)
+            if istats is None:
+                istats = agg[image_id] = [0, 0, 0, 0, 0, 0.0, 0.0]
+            istats[0] += requests
+            istats[1] += views
+            istats[2] += cached_views
+            istats[3] += downloads
+            istats[4] += size
+            istats[5] += duration_secs
+            if duration_secs > istats[6]:
+                istats[6] = duration_secs
+            self._agg_events += 1
+            send_now = self._batch_events and self._agg_events >= self._batch_events
+        if send_now:
+            self._flush_event.set()
+
+    def _start_flush_thread(self):
+        """
+        Starts the background thread that sends the local stats totals, if it
+        is not running, which includes the case where this process has been forked.
+        In a forked process, the totals inherited from the parent process are
+        discarded, as the parent process will send them.
+        """
+        pid = os.getpid()
+        if self._thread_pid != pid:
+            with self._thread_lock:
+                if self._thread_pid != pid:
+                    self._agg = {}
+                    self._agg_events = 0
+                    self._agg_lock = Lock()
+                    self._flush_event = Event()
+                    flush_thread = Thread(
+                        target=self._flush_thread,
+                        name='StatsClientFlush'
+                    )
+                    flush_thread.daemon = True
+                    flush_thread.start()
+                    self._thread_pid = pid
+
+    def _flush_thread(self):
+        while True:
+            self._flush_event.wait(self._batch_secs)
+            self._flush_event.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the stats totals that have been added up in this process to the
+        stats server, and resets the totals. This is called automatically
+        when the stats client was created with batch_msecs greater than 0.
+        Returns a boolean indicating success.
+        """
+        with self._agg_lock:
+            if not self._agg:
+                return True
+            agg, self._agg = self._agg, {}
+            self._agg_events = 0
+        frame = [stats_server.FRAME_MARKER, stats_server.FRAME_HEADER.pack(len(agg))]
+        for image_id, istats in agg.items():
+            frame.append(stats_server.FRAME_RECORD.pack(image_id, *istats))
+        return self._send(b''.join(frame))
+
     def set_enabled(self, enabled):
         """
         Enables or disables the logging of statistics.
@@ -144,7 +252,9 @@ class StatsManager(object):
         Specify the image ID as 0 to update only the system statistics, or set
         write_image_stats False to update only the request count for an image.
         """
-        if image_id and not write_image_stats:
+        if self._batch_secs:
+            self._aggregate(image_id, 0, 0, 0, 0, duration_secs, write_image_stats)
+        elif image_id and not write_image_stats:
             self._send({
                 # Bump requests in both system stats and image stats
                 image_id: {"requests": 1},
@@ -168,7 +278,9 @@ class StatsManager(object):
         Specify the image ID as 0 to update only the system statistics, or set
         write_image_stats False to update only the request count for an image.
         """
-        if image_id and not write_image_stats:
+        if self._batch_secs:
+            self._aggregate(image_id, 1, 1 * from_cache, 0, size, duration_secs, write_image_stats)
+        elif image_id and not write_image_stats:
             self._send({
                 # Bump requests in both system stats and image stats
                 image_id: {"requests": 1},
@@ -198,7 +310,9 @@ class StatsManager(object):
         Specify the image ID as 0 to update only the system statistics, or set
         write_image_stats False to update only the request count for an image.
         """
-        if image_id and not write_image_stats:
+        if self._batch_secs:
+            self._aggregate(image_id, 0, 0, 1, size, duration_secs, write_image_stats)
+        elif image_id and not write_image_stats:
             self._send({
                 # Bump requests in both system stats and image stats
                 image_id: {"requests": 1},
@@ -341,6 +341,17 @@ def uncache_image(**kwargs):
     app.image_engine._uncache_image_id(image_id)
 
 
+def uncache_image_generations(**kwargs):
+    """
+    A task to delete the cached images for a particular image ID that are from
+    previous cache generations of the image.
+    """
+    from .flask_app import app
+
+    (image_id, ) = _extract_parameters(['image_id'], **kwargs)
+    app.image_engine._uncache_image_generations(image_id)
+
+
 def uncache_folder_images(**kwargs):
     """
     A task to delete all cached active images in a particular folder,
@@ -357,6 +368,9 @@ def uncache_folder_images(**kwargs):
     if not db_folder:
         app.log.warning('Folder ID %d does not exist' % folder_id)
         return
+    # With cache generation numbers, 1 change uncaches the whole folder tree
+    if recursive and app.image_engine._uncache_folder(db_folder.path):
+        return
     # Get both active and deleted, in case we are clearing deleted images
     image_ids = app.data_engine.list_image_ids(db_folder, recursive)
     for image_id in image_ids:
@@ -443,7 +457,7 @@ def create_image_pyramid(**kwargs):
 
     # The idea here is to generate images that will be picked up by
     # ImageManager._get_base_image() for faster future image requests
-    pcount = 0
+    want_list = []
     sqrt2 = 1.4142135623731
     aspect = float(start_width) / float(start_height)
     width = start_width
@@ -468,8 +482,17 @@ def create_image_pyramid(**kwargs):
             width, height, image_id
         ))
         app.image_engine.finalise_image_attrs(want_attrs)
-        app.image_engine.get_image(want_attrs, cache_result=True)
-        pcount += 1
+        want_list.append(want_attrs)
+
+    # Decode the image once, and create each size by reducing the one before.
+    # Images still in cache from a previous run are not generated again.
+    pcount = 0
+    results = app.image_engine.get_image_variants(want_list, cache_result=True, cascade=True)
+    for (want_attrs, result) in zip(want_list, results):
+        if isinstance(result, Exception):
+            app.log.error('Pyramid failed to create %s: %s' % (str(want_attrs), str(result)))
+        elif result is not None:
+            pcount += 1
 
     app.log.debug(
         'Pyramid created %d image(s) for image ID %d' % (pcount, image_id)
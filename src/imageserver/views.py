@@ -38,6 +38,7 @@ import time
 import flask
 from flask import make_response, request, send_file
 import werkzeug.exceptions as httpexc
+from werkzeug.wsgi import FileWrapper, wrap_file
 
 from .errors import DBError, DoesNotExistError, ImageError, SecurityError, ServerTooBusyError
 from .filesystem_manager import path_exists
@@ -45,12 +46,14 @@ from .filesystem_sync import on_image_db_create_anon_history
 from .flask_app import app, logger
 from .flask_app import data_engine, image_engine, permissions_engine, stats_engine
 from .image_attrs import ImageAttrs
+from .image_manager import ImageManager
 from .models import FolderPermission
 from .session_manager import get_session_user
 from .session_manager import logged_in as session_logged_in
 from .util import filepath_parent, invoke_http_async, validate_string
-from .util import parse_boolean, parse_colour, parse_float, parse_int, parse_tile_spec
+from .util import parse_boolean
 from .util import default_value, etag, unicode_to_utf8
+from .views_util import get_image_attrs_from_args, public_image_limits_post_image_checks
 from .views_util import log_security_error, safe_error_str
 
 
@@ -83,38 +86,8 @@ def image():
         allow_uncache = app.config['BENCHMARKING'] or app.config['DEBUG']
         args = request.args
 
-        # Get URL parameters for the image
+        # Get URL parameters for handling options (the image parameters are below)
         src         = args.get('src', '')
-        page        = args.get('page', None)
-        iformat     = args.get('format', None)
-        template    = args.get('tmp', None)
-        width       = args.get('width', None)
-        height      = args.get('height', None)
-        halign      = args.get('halign', None)
-        valign      = args.get('valign', None)
-        autosizefit = args.get('autosizefit', None)
-        rotation    = args.get('angle', None)
-        flip        = args.get('flip', None)
-        top         = args.get('top', None)
-        left        = args.get('left', None)
-        bottom      = args.get('bottom', None)
-        right       = args.get('right', None)
-        autocropfit = args.get('autocropfit', None)
-        fill        = args.get('fill', None)
-        quality     = args.get('quality', None)
-        sharpen     = args.get('sharpen', None)
-        ov_src      = args.get('overlay', None)
-        ov_size     = args.get('ovsize', None)
-        ov_opacity  = args.get('ovopacity', None)
-        ov_pos      = args.get('ovpos', None)
-        icc_profile = args.get('icc', None)
-        icc_intent  = args.get('intent', None)
-        icc_bpc     = args.get('bpc', None)
-        colorspace  = args.get('colorspace', None)
-        strip       = args.get('strip', None)
-        dpi         = args.get('dpi', None)
-        tile        = args.get('tile', None)
-        # Get URL parameters for handling options
         attach      = args.get('attach', None)
         xref        = args.get('xref', None)
         stats       = args.get('stats', None)
@@ -122,50 +95,8 @@ def image():
         cache       = args.get('cache', '1') if logged_in or allow_uncache else '1'
         recache     = args.get('recache', None) if allow_uncache else None
 
-        # eRez compatibility mode
-        src = erez_params_compat(src)
-
         # Convert non-string parameters to the correct data types
         try:
-            # Image options
-            if page is not None:
-                page = parse_int(page)
-            if width is not None:
-                width = parse_int(width)
-            if height is not None:
-                height = parse_int(height)
-            if autosizefit is not None:
-                autosizefit = parse_boolean(autosizefit)
-            if rotation is not None:
-                rotation = parse_float(rotation)
-            if top is not None:
-                top = parse_float(top)
-            if left is not None:
-                left = parse_float(left)
-            if bottom is not None:
-                bottom = parse_float(bottom)
-            if right is not None:
-                right = parse_float(right)
-            if autocropfit is not None:
-                autocropfit = parse_boolean(autocropfit)
-            if fill is not None:
-                fill = parse_colour(fill)
-            if quality is not None:
-                quality = parse_int(quality)
-            if sharpen is not None:
-                sharpen = parse_int(sharpen)
-            if ov_size is not None:
-                ov_size = parse_float(ov_size)
-            if ov_opacity is not None:
-                ov_opacity = parse_float(ov_opacity)
-            if icc_bpc is not None:
-                icc_bpc = parse_boolean(icc_bpc)
-            if strip is not None:
-                strip = parse_boolean(strip)
-            if dpi is not None:
-                dpi = parse_int(dpi)
-            if tile is not None:
-                tile = parse_tile_spec(tile)
             # Handling options
             if attach is not None:
                 attach = parse_boolean(attach)
@@ -181,25 +112,13 @@ def image():
         except (ValueError, TypeError) as e:
             raise httpexc.BadRequest(safe_error_str(e))
 
-        # Package and validate the parameters
+        # Package and validate the image parameters
         try:
-            # #2694 Enforce public image limits - perform easy parameter checks
-            if not logged_in:
-                width, height, autosizefit = _public_image_limits_pre_image_checks(
-                    width, height, autosizefit, tile, template
-                )
-            # Store and normalise all the parameters
-            image_attrs = ImageAttrs(src, -1, page, iformat, template,
-                                     width, height, halign, valign,
-                                     rotation, flip,
-                                     top, left, bottom, right, autocropfit,
-                                     autosizefit, fill, quality, sharpen,
-                                     ov_src, ov_size, ov_pos, ov_opacity,
-                                     icc_profile, icc_intent, icc_bpc,
-                                     colorspace, strip, dpi, tile)
-            image_engine.finalise_image_attrs(image_attrs)
-        except ValueError as e:
+            image_attrs = get_image_attrs_from_args(args, logged_in)
+        except (ValueError, TypeError) as e:
             raise httpexc.BadRequest(safe_error_str(e))
+        # With format=auto the response depends on the client's Accept header
+        auto_format = args.get('format', '').lower() == 'auto'
 
         # Get/create the database ID (from cache, validating path on create)
         image_id = data_engine.get_or_create_image_id(
@@ -220,9 +139,9 @@ def image():
             get_session_user()
         )
         # Ditto for overlays
-        if ov_src:
+        if image_attrs.overlay_src():
             permissions_engine.ensure_folder_permitted(
-                filepath_parent(ov_src),
+                filepath_parent(image_attrs.overlay_src()),
                 FolderPermission.ACCESS_VIEW,
                 get_session_user()
             )
@@ -236,13 +155,22 @@ def image():
             )
             if etag_valid:
                 # Success HTTP 304
-                return make_304_response(image_attrs, False, modified_time)
-
-        # Get the requested image data
-        image_wrapper = image_engine.get_image(
-            image_attrs,
-            'refresh' if recache else cache
-        )
+                response = make_304_response(image_attrs, False, modified_time)
+                if auto_format:
+                    response.vary.add('Accept')
+                return response
+
+        # Get the requested image data, streaming unaltered
+        # images that are too large to cache from disk
+        image_wrapper = None
+        if not recache:
+            image_wrapper = image_engine.get_image_passthrough(image_attrs)
+        if (image_wrapper is None):
+            image_wrapper = image_engine.get_image(
+                image_attrs,
+                'refresh' if recache else cache,
+                stream=True
+            )
         if (image_wrapper is None):
             raise DoesNotExistError()
 
@@ -250,18 +178,20 @@ def image():
         #       of images that passed the initial parameter checks
         if not logged_in:
             try:
-                _public_image_limits_post_image_checks(
+                public_image_limits_post_image_checks(
                     image_attrs.width(),
                     image_attrs.height(),
                     image_attrs.template(),
-                    image_wrapper.data(),
-                    image_wrapper.attrs().format()
+                    image_wrapper
                 )
             except ValueError as e:
                 raise httpexc.BadRequest(safe_error_str(e))  # As for the pre-check
 
         # Success HTTP 200
-        return make_image_response(image_wrapper, False, stats, attach, xref)
+        response = make_image_response(image_wrapper, False, stats, attach, xref)
+        if auto_format:
+            response.vary.add('Accept')
+        return response
     except httpexc.HTTPException:
         # Pass through HTTP 4xx and 5xx
         raise
@@ -346,9 +276,10 @@ def original():
                 # Success HTTP 304
                 return make_304_response(image_attrs, True, modified_time)
 
-        # Read the image file
+        # Get the image file, to be streamed from disk
         image_wrapper = image_engine.get_image_original(
-            image_attrs
+            image_attrs,
+            stream=True
         )
         if (image_wrapper is None):
             raise DoesNotExistError()
@@ -383,15 +314,125 @@ def original():
         raise httpexc.InternalServerError(safe_error_str(e))
 
 
-def erez_params_compat(src):
+# Deep Zoom (DZI) image tile serving - return the tile pyramid descriptor
+@app.route('/tiles/<path:src>.dzi', methods=['GET'])
+def dzi_descriptor(src):
+    logger.debug('GET ' + request.url)
+    try:
+        image_attrs = _get_dzi_image_attrs(src, request.args.get('format', 'jpg'))
+        (width, height) = image_engine.get_dzi_image_size(image_attrs)
+        if not width or not height:
+            raise DoesNotExistError()
+
+        # Success HTTP 200
+        response = make_response(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            'TileSize="%d" Overlap="%d" Format="%s">'
+            '<Size Width="%d" Height="%d"/></Image>' % (
+                ImageManager.DZI_TILE_SIZE,
+                ImageManager.DZI_TILE_OVERLAP,
+                image_attrs.format(),
+                width,
+                height
+            )
+        )
+        response.mimetype = 'application/xml'
+        return response
+    except httpexc.HTTPException:
+        # Pass through HTTP 4xx and 5xx
+        raise
+    except SecurityError as e:
+        if app.config['DEBUG']:
+            raise
+        log_security_error(e, request)
+        raise httpexc.Forbidden()
+    except DoesNotExistError:
+        logger.warning('404 Not found: ' + src)
+        raise httpexc.NotFound(src)
+    except Exception as e:
+        if app.config['DEBUG']:
+            raise
+        logger.error('500 Error for ' + request.url + '\n' + str(e))
+        raise httpexc.InternalServerError(safe_error_str(e))
+
+
+# Deep Zoom (DZI) image tile serving - return a tile from the tile pyramid
+@app.route('/tiles/<path:src>_files/<int:level>/<int:column>_<int:row>.<iformat>',
+           methods=['GET'])
+def dzi_tile(src, level, column, row, iformat):
+    logger.debug('GET ' + request.url)
+    try:
+        image_attrs = _get_dzi_image_attrs(src, iformat)
+        try:
+            image_wrapper = image_engine.get_dzi_tile(image_attrs, level, column, row)
+        except ValueError as e:
+            raise httpexc.NotFound(safe_error_str(e))
+        if (image_wrapper is None):
+            raise DoesNotExistError()
+
+        # Success HTTP 200
+        return make_image_response(image_wrapper, False)
+    except httpexc.HTTPException:
+        # Pass through HTTP 4xx and 5xx
+        raise
+    except ServerTooBusyError:
+        logger.warning('503 Too busy for ' + request.url)
+        raise httpexc.ServiceUnavailable()
+    except ImageError as e:
+        logger.warning('415 Invalid image file \'' + src + '\' : ' + str(e))
+        raise httpexc.UnsupportedMediaType(safe_error_str(e))
+    except SecurityError as e:
+        if app.config['DEBUG']:
+            raise
+        log_security_error(e, request)
+        raise httpexc.Forbidden()
+    except DoesNotExistError:
+        logger.warning('404 Not found: ' + src)
+        raise httpexc.NotFound(src)
+    except Exception as e:
+        if app.config['DEBUG']:
+            raise
+        logger.error('500 Error for ' + request.url + '\n' + str(e))
+        raise httpexc.InternalServerError(safe_error_str(e))
+
+
+def _get_dzi_image_attrs(src, iformat):
     """
-    Performs adjustments to URL parameters to provide compatibility with eRez
+    For the Deep Zoom (DZI) URLs, returns an ImageAttrs object for the image
+    file src and the tile image format, with the database ID set, after
+    checking that the current user has view permission for the image.
+
+    Raises a BadRequest exception if the parameters are invalid,
+    a DoesNotExistError if the image has been deleted, or a SecurityError
+    if the user does not have the required permission.
     """
-    if src.endswith('.tif') and src[-10:-4].rfind('.') != -1:
-        src = src[0:-4]
-    elif src.endswith('.tiff') and src[-11:-5].rfind('.') != -1:
-        src = src[0:-5]
-    return src
+    try:
+        image_attrs = ImageAttrs(src, iformat=iformat.lower())
+        image_attrs.validate()
+    except ValueError as e:
+        raise httpexc.BadRequest(safe_error_str(e))
+
+    # Get/create the database ID (from cache, validating path on create)
+    image_id = data_engine.get_or_create_image_id(
+        image_attrs.filename(),
+        return_deleted=False,
+        on_create=on_image_db_create_anon_history
+    )
+    if (image_id == 0):
+        raise DoesNotExistError()  # Deleted
+    elif (image_id < 0):
+        raise DBError('Failed to add image to database')
+    image_attrs.set_database_id(image_id)
+
+    # Require view permission or file admin. As for the tile parameter,
+    # the public image size limits do not apply.
+    permissions_engine.ensure_folder_permitted(
+        image_attrs.folder_path(),
+        FolderPermission.ACCESS_VIEW,
+        get_session_user()
+    )
+    return image_attrs
 
 
 def handle_image_xref(xref):
@@ -433,7 +474,10 @@ def make_image_response(image_wrapper, is_original, stats=None, as_attachment=No
         handle_image_xref(xref)
 
     # Create the HTTP response
-    if _USE_SENDFILE:
+    if image_wrapper.file_path():
+        response = _make_file_response(image_wrapper.file_path(), image_wrapper.data_size())
+        response.mimetype = image_attrs.mime_type()
+    elif _USE_SENDFILE:
         response = send_file(
             io.BytesIO(image_wrapper.data()),
             image_attrs.mime_type()
@@ -453,6 +497,13 @@ def make_image_response(image_wrapper, is_original, stats=None, as_attachment=No
     # Set custom cache info header
     response.headers['X-From-Cache'] = str(image_wrapper.is_from_cache())
 
+    # Report the image size used when the requested size may have been rounded
+    if app.config['IMAGE_SIZE_LADDER'] and not is_original:
+        if image_attrs.width():
+            response.headers['X-Image-Width'] = str(image_attrs.width())
+        if image_attrs.height():
+            response.headers['X-Image-Height'] = str(image_attrs.height())
+
     # URL attachment param overrides what the returned object wants
     attach = (
         as_attachment if as_attachment is not None
@@ -464,14 +515,23 @@ def make_image_response(image_wrapper, is_original, stats=None, as_attachment=No
         cd_type = 'attachment' if attach else 'inline'
         response.headers['Content-Disposition'] = cd_type + '; filename="' + fname + '"'
 
+    # For a file response, support HTTP Range requests. This is done last so
+    # that If-Range can be checked against the final ETag. Range requests on a
+    # data response are not supported, as cached images are relatively small.
+    if image_wrapper.file_path():
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.make_conditional(
+            request, accept_ranges=True, complete_length=image_wrapper.data_size()
+        )
+
     if app.config['DEBUG']:
         logger.debug(
-            'Sending ' + str(len(image_wrapper.data())) + ' bytes for ' + str(image_attrs)
+            'Sending ' + str(image_wrapper.data_size()) + ' bytes for ' + str(image_attrs)
         )
 
     _log_stats(
         image_attrs.database_id(),
-        len(image_wrapper.data()),
+        image_wrapper.data_size(),
         is_original,
         image_wrapper.is_from_cache(),
         image_wrapper.record_stats() if stats is None else stats
@@ -479,6 +539,25 @@ def make_image_response(image_wrapper, is_original, stats=None, as_attachment=No
     return response
 
 
+def _make_file_response(file_path, file_size):
+    """
+    Returns a Flask response object that streams a file from disk without
+    reading it into memory. Where the WSGI server provides a wsgi.file_wrapper
+    (e.g. mod_wsgi) this allows the server to send the file using sendfile.
+    Raises an IOError if the file cannot be opened.
+    """
+    f = open(file_path, 'rb')
+    if request.range is not None:
+        # Werkzeug's own wrapper can seek to the start of the requested range,
+        # whereas a server's file_wrapper would have to read up to it
+        data = FileWrapper(f)
+    else:
+        data = wrap_file(request.environ, f)
+    response = app.response_class(data, direct_passthrough=True)
+    response.content_length = file_size
+    return response
+
+
 def make_304_response(image_attrs, is_original, last_modified_time):
     """
     Returns a HTTP 304 "Not Modified" Flask response object for the given image.
@@ -561,107 +640,6 @@ def _etag_is_valid(image_attrs, check_etag, is_original):
     return ((current_etag == check_etag), modified_time)
 
 
-def _public_image_limits_pre_image_checks(req_width, req_height, req_autosizefit,
-                                          req_tile, req_template):
-    """
-    To be called when no one is logged in, enforces the image dimension limits
-    defined by the PUBLIC_MAX_IMAGE_WIDTH and PUBLIC_MAX_IMAGE_HEIGHT settings.
-    If a template is specified, the template dimensions take precedence.
-    Or if no dimensions were requested, returns default value(s) for them.
-
-    Returns a tuple of replacement (width, height, autosizefit) values that
-    should be used for the rest of the image request.
-
-    Raises a ValueError if the requested image dimensions would exceed the
-    defined limits.
-    """
-    limit_w = app.config['PUBLIC_MAX_IMAGE_WIDTH'] or 0
-    limit_h = app.config['PUBLIC_MAX_IMAGE_HEIGHT'] or 0
-    if (limit_w or limit_h) and req_tile is None:
-        logger.debug(
-            'Public image limits, checking parameters vs %d x %d limit' % (limit_w, limit_h)
-        )
-
-        # For v1 only, v2 will get these from a default template
-        default_w = limit_w
-        default_h = limit_h
-
-        # If we're using a template, get the template dimensions
-        template_w = 0
-        template_h = 0
-        if req_template:
-            try:
-                templ = image_engine.get_template(req_template)
-                template_w = templ.get_image_attrs().width() or 0
-                template_h = templ.get_image_attrs().height() or 0
-            except ValueError:
-                # Validation (yet to come) will reject the bad template name
-                pass
-
-        # v1.32.1 - if template contradicts the limit, template takes precedence
-        if limit_w and template_w and template_w > limit_w:
-            limit_w = template_w
-        if limit_h and template_h and template_h > limit_h:
-            limit_h = template_h
-
-        # Check the requested size vs the limits
-        if req_width and limit_w and req_width > limit_w:
-            raise ValueError('width: exceeds public image limit')
-        if req_height and limit_h and req_height > limit_h:
-            raise ValueError('height: exceeds public image limit')
-
-        # Check if we need to size-limit an otherwise unlimited image request
-        # Note: In v2 this will be done with new default values in ImageAttrs
-        if not req_width and not req_height and not template_w and not template_h:
-            req_width = default_w if default_w else 0
-            req_height = default_h if default_h else 0
-            # Unless explicitly set otherwise, prevent padding
-            if req_width and req_height and req_autosizefit is None:
-                req_autosizefit = True
-            logger.debug(
-                'Public image limits, unsized image set as %d x %d' % (req_width, req_height)
-            )
-
-    return req_width, req_height, req_autosizefit
-
-
-def _public_image_limits_post_image_checks(req_width, req_height, req_template,
-                                           image_data, image_format):
-    """
-    To be called when no one is logged in, checks that the image actually
-    generated conforms to the limits defined by the PUBLIC_MAX_IMAGE_WIDTH
-    and PUBLIC_MAX_IMAGE_HEIGHT settings.
-
-    As an optimisation, this function only has any effect for the conditions
-    that would not have been caught by the "pre-image" checks.
-    Specifically, this is when either:
-
-    * only PUBLIC_MAX_IMAGE_WIDTH is set, but only an image height was given
-    or
-    * only PUBLIC_MAX_IMAGE_HEIGHT is set, but only an image width was given
-
-    Raises a ValueError if the generated image dimensions have exceeded the
-    defined limits.
-    """
-    if not req_template:
-        limit_w = app.config['PUBLIC_MAX_IMAGE_WIDTH'] or 0
-        limit_h = app.config['PUBLIC_MAX_IMAGE_HEIGHT'] or 0
-        # We have to inspect the image, so only do this for the 2 conditions
-        # that the pre-image checks couldn't do
-        if (limit_w and not limit_h and req_height and not req_width) or \
-           (limit_h and not limit_w and req_width and not req_height):
-            logger.debug('Public image limits, checking generated image dimensions')
-            image_w, image_h = image_engine.get_image_data_dimensions(
-                image_data, image_format
-            )
-            logger.debug('Public image limits, generated image is %d x %d' % (image_w, image_h))
-            if image_w and image_h:
-                if limit_w and image_w > limit_w:
-                    raise ValueError('width: exceeds public image limit')
-                if limit_h and image_h > limit_h:
-                    raise ValueError('height: exceeds public image limit')
-
-
 def _log_stats(image_id, data_len, is_original, from_cache, write_image_stats=True):
     """
     Logs statistics about an image request/response with the stats manager.
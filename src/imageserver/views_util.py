@@ -48,11 +48,13 @@ from . import __about__
 from . import imaging
 from .api_util import make_api_error_response
 from .errors import AuthenticationError, SecurityError
-from .flask_app import app, logger, permissions_engine
+from .flask_app import app, logger, image_engine, permissions_engine
 from .flask_util import get_port, internal_url_for, external_url_for
+from .image_attrs import ImageAttrs
 from .models import FolderPermission, SystemPermissions
 from .session_manager import get_session_user, logged_in
 from .util import get_file_extension, filepath_filename, unicode_to_utf8
+from .util import parse_boolean, parse_colour, parse_float, parse_int, parse_tile_spec
 
 
 # Settings that should not be output in error messages
@@ -308,6 +310,247 @@ def safe_error_str(error):
     return _safe_str(error)
 
 
+def get_image_attrs_from_args(args, logged_in):
+    """
+    Returns a finalised ImageAttrs object for the image parameters (as for the
+    /image URL) in the args dictionary, enforcing the public image limits if
+    no one is logged in. The database ID in the returned object is not set.
+    A format of 'auto' is replaced by the best image format that the current
+    request's Accept header allows, or by no format for the default format.
+
+    Raises a ValueError or TypeError if any of the parameters are invalid.
+    """
+    # Get URL parameters for the image
+    src         = args.get('src', '')
+    page        = args.get('page', None)
+    iformat     = args.get('format', None)
+    template    = args.get('tmp', None)
+    width       = args.get('width', None)
+    height      = args.get('height', None)
+    halign      = args.get('halign', None)
+    valign      = args.get('valign', None)
+    autosizefit = args.get('autosizefit', None)
+    rotation    = args.get('angle', None)
+    flip        = args.get('flip', None)
+    top         = args.get('top', None)
+    left        = args.get('left', None)
+    bottom      = args.get('bottom', None)
+    right       = args.get('right', None)
+    autocropfit = args.get('autocropfit', None)
+    fill        = args.get('fill', None)
+    quality     = args.get('quality', None)
+    max_bytes   = args.get('maxbytes', None)
+    sharpen     = args.get('sharpen', None)
+    ov_src      = args.get('overlay', None)
+    ov_size     = args.get('ovsize', None)
+    ov_opacity  = args.get('ovopacity', None)
+    ov_pos      = args.get('ovpos', None)
+    icc_profile = args.get('icc', None)
+    icc_intent  = args.get('intent', None)
+    icc_bpc     = args.get('bpc', None)
+    colorspace  = args.get('colorspace', None)
+    strip       = args.get('strip', None)
+    dpi         = args.get('dpi', None)
+    tile        = args.get('tile', None)
+
+    # eRez compatibility mode
+    src = erez_params_compat(src)
+
+    # Convert non-string parameters to the correct data types
+    if iformat is not None and iformat.lower() == 'auto':
+        iformat = image_engine.get_auto_image_format(
+            [mime_type for (mime_type, q) in request.accept_mimetypes if q > 0]
+        )
+    if page is not None:
+        page = parse_int(page)
+    if width is not None:
+        width = parse_int(width)
+    if height is not None:
+        height = parse_int(height)
+    if autosizefit is not None:
+        autosizefit = parse_boolean(autosizefit)
+    if rotation is not None:
+        rotation = parse_float(rotation)
+    if top is not None:
+        top = parse_float(top)
+    if left is not None:
+        left = parse_float(left)
+    if bottom is not None:
+        bottom = parse_float(bottom)
+    if right is not None:
+        right = parse_float(right)
+    if autocropfit is not None:
+        autocropfit = parse_boolean(autocropfit)
+    if fill is not None:
+        fill = parse_colour(fill)
+    if quality is not None:
+        quality = parse_int(quality)
+    if max_bytes is not None:
+        max_bytes = parse_int(max_bytes)
+    if sharpen is not None:
+        sharpen = parse_int(sharpen)
+    if ov_size is not None:
+        ov_size = parse_float(ov_size)
+    if ov_opacity is not None:
+        ov_opacity = parse_float(ov_opacity)
+    if icc_bpc is not None:
+        icc_bpc = parse_boolean(icc_bpc)
+    if strip is not None:
+        strip = parse_boolean(strip)
+    if dpi is not None:
+        dpi = parse_int(dpi)
+    if tile is not None:
+        tile = parse_tile_spec(tile)
+
+    # #2694 Enforce public image limits - perform easy parameter checks
+    if not logged_in:
+        width, height, autosizefit = _public_image_limits_pre_image_checks(
+            width, height, autosizefit, tile, template
+        )
+    # Round the requested size up to a standard size, if enabled, unless that
+    # would exceed the public image limits. But not for tiles, where the tile
+    # grid depends on the exact image size.
+    if tile is None:
+        ladder_width, ladder_height = image_engine.get_ladder_image_size(width, height)
+        if (ladder_width, ladder_height) != (width, height):
+            try:
+                if not logged_in:
+                    _public_image_limits_pre_image_checks(
+                        ladder_width, ladder_height, autosizefit, tile, template
+                    )
+                width, height = ladder_width, ladder_height
+            except ValueError:
+                pass
+    # Store and normalise all the parameters
+    image_attrs = ImageAttrs(src, -1, page, iformat, template,
+                             width, height, halign, valign,
+                             rotation, flip,
+                             top, left, bottom, right, autocropfit,
+                             autosizefit, fill, quality, sharpen,
+                             ov_src, ov_size, ov_pos, ov_opacity,
+                             icc_profile, icc_intent, icc_bpc,
+                             colorspace, strip, dpi, tile, max_bytes)
+    image_engine.finalise_image_attrs(image_attrs)
+    return image_attrs
+
+
+def erez_params_compat(src):
+    """
+    Performs adjustments to URL parameters to provide compatibility with eRez
+    """
+    if src.endswith('.tif') and src[-10:-4].rfind('.') != -1:
+        src = src[0:-4]
+    elif src.endswith('.tiff') and src[-11:-5].rfind('.') != -1:
+        src = src[0:-5]
+    return src
+
+
+def _public_image_limits_pre_image_checks(req_width, req_height, req_autosizefit,
+                                          req_tile, req_template):
+    """
+    To be called when no one is logged in, enforces the image dimension limits
+    defined by the PUBLIC_MAX_IMAGE_WIDTH and PUBLIC_MAX_IMAGE_HEIGHT settings.
+    If a template is specified, the template dimensions take precedence.
+    Or if no dimensions were requested, returns default value(s) for them.
+
+    Returns a tuple of replacement (width, height, autosizefit) values that
+    should be used for the rest of the image request.
+
+    Raises a ValueError if the requested image dimensions would exceed the
+    defined limits.
+    """
+    limit_w = app.config['PUBLIC_MAX_IMAGE_WIDTH'] or 0
+    limit_h = app.config['PUBLIC_MAX_IMAGE_HEIGHT'] or 0
+    if (limit_w or limit_h) and req_tile is None:
+        logger.debug(
+            'Public image limits, checking parameters vs %d x %d limit' % (limit_w, limit_h)
+        )
+
+        # For v1 only, v2 will get these from a default template
+        default_w = limit_w
+        default_h = limit_h
+
+        # If we're using a template, get the template dimensions
+        template_w = 0
+        template_h = 0
+        if req_template:
+            try:
+                templ = image_engine.get_template(req_template)
+                template_w = templ.get_image_attrs().width() or 0
+                template_h = templ.get_image_attrs().height() or 0
+            except ValueError:
+                # Validation (yet to come) will reject the bad template name
+                pass
+
+        # v1.32.1 - if template contradicts the limit, template takes precedence
+        if limit_w and template_w and template_w > limit_w:
+            limit_w = template_w
+        if limit_h and template_h and template_h > limit_h:
+            limit_h = template_h
+
+        # Check the requested size vs the limits
+        if req_width and limit_w and req_width > limit_w:
+            raise ValueError('width: exceeds public image limit')
+        if req_height and limit_h and req_height > limit_h:
+            raise ValueError('height: exceeds public image limit')
+
+        # Check if we need to size-limit an otherwise unlimited image request
+        # Note: In v2 this will be done with new default values in ImageAttrs
+        if not req_width and not req_height and not template_w and not template_h:
+            req_width = default_w if default_w else 0
+            req_height = default_h if default_h else 0
+            # Unless explicitly set otherwise, prevent padding
+            if req_width and req_height and req_autosizefit is None:
+                req_autosizefit = True
+            logger.debug(
+                'Public image limits, unsized image set as %d x %d' % (req_width, req_height)
+            )
+
+    return req_width, req_height, req_autosizefit
+
+
+def public_image_limits_post_image_checks(req_width, req_height, req_template,
+                                          image_wrapper):
+    """
+    To be called when no one is logged in, checks that the image actually
+    generated conforms to the limits defined by the PUBLIC_MAX_IMAGE_WIDTH
+    and PUBLIC_MAX_IMAGE_HEIGHT settings. The image is given as the
+    ImageWrapper returned for the request, and is only read if necessary.
+
+    As an optimisation, this function only has any effect for the conditions
+    that would not have been caught by the "pre-image" checks.
+    Specifically, this is when either:
+
+    * only PUBLIC_MAX_IMAGE_WIDTH is set, but only an image height was given
+    or
+    * only PUBLIC_MAX_IMAGE_HEIGHT is set, but only an image width was given
+
+    Raises a ValueError if the generated image dimensions have exceeded the
+    defined limits.
+    """
+    if not req_template:
+        limit_w = app.config['PUBLIC_MAX_IMAGE_WIDTH'] or 0
+        limit_h = app.config['PUBLIC_MAX_IMAGE_HEIGHT'] or 0
+        # We have to inspect the image, so only do this for the 2 conditions
+        # that the pre-image checks couldn't do
+        if (limit_w and not limit_h and req_height and not req_width) or \
+           (limit_h and not limit_w and req_width and not req_height):
+            logger.debug('Public image limits, checking generated image dimensions')
+            image_data = image_wrapper.data()
+            if image_data is None and image_wrapper.file_path():
+                with open(image_wrapper.file_path(), 'rb') as f:
+                    image_data = f.read()
+            image_w, image_h = image_engine.get_image_data_dimensions(
+                image_data, image_wrapper.attrs().format()
+            )
+            logger.debug('Public image limits, generated image is %d x %d' % (image_w, image_h))
+            if image_w and image_h:
+                if limit_w and image_w > limit_w:
+                    raise ValueError('width: exceeds public image limit')
+                if limit_h and image_h > limit_h:
+                    raise ValueError('height: exceeds public image limit')
+
+
 def login_point(from_web):
     """
     Defines a decorator specifically for the login page that enforces the
@@ -341,6 +341,48 @@ class ImageServerAPITests(main_tests.BaseTestCase):
         finally:
             delete_file(temp_file)
 
+    # Batch image generation
+    def test_api_batch(self):
+        from email.parser import BytesParser
+        # Bad parameters
+        rv = self.app.post('/api/v1/batch/', data='{}', content_type='application/json')
+        self.assert_json_response_code(rv, API_CODES.INVALID_PARAM)
+        image_specs = [
+            {'src': 'test_images/cathedral.jpg', 'width': 200, 'format': 'png'},
+            {'src': 'test_images/cathedral.jpg', 'width': 100},
+            {'src': 'test_images/cathedral.jpg', 'width': 200, 'format': 'png'},
+            {'src': 'test_images/not_here.jpg'},
+            {'src': '../../../etc/passwd'},
+            {'src': 'test_images/cathedral.jpg', 'width': 'wide'}
+        ]
+        for _ in range(2):
+            rv = self.app.post(
+                '/api/v1/batch/',
+                data=json.dumps(image_specs),
+                content_type='application/json'
+            )
+            self.assertEqual(rv.status_code, API_CODES.SUCCESS)
+            self.assertTrue(rv.headers['Content-Type'].startswith('multipart/mixed'))
+            msg = BytesParser().parsebytes(
+                b'Content-Type: ' + rv.headers['Content-Type'].encode('ascii') +
+                b'\r\n\r\n' + rv.data
+            )
+            parts = msg.get_payload()
+            self.assertEqual([p['Content-ID'] for p in parts], ['0', '1', '2', '3', '4', '5'])
+            self.assertEqual(
+                [p.get_content_type() for p in parts],
+                ['image/png', 'image/jpeg', 'image/png',
+                 'application/json', 'application/json', 'application/json']
+            )
+            self.assertEqual(parts[0].get_payload(decode=True), parts[2].get_payload(decode=True))
+            for (idx, code) in [(3, API_CODES.NOT_FOUND),
+                                (4, API_CODES.UNAUTHORISED),
+                                (5, API_CODES.INVALID_PARAM)]:
+                err = json.loads(parts[idx].get_payload(decode=True).decode('utf8'))
+                self.assertEqual(err['status'], code)
+        # The second time around should all be from cache
+        self.assertEqual([p['X-From-Cache'] for p in parts[:3]], ['True', 'True', 'True'])
+
     # Database admin API - images
     def test_data_api_images(self):
         # Get image ID
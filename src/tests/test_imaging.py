@@ -335,6 +335,38 @@ class CommonImageTests(main_tests.BaseTestCase, ImagingTestCase):
         self.assertEqual(w, 1600)
         self.assertEqual(h, 1200)
 
+    # Test rounding of requested image sizes up to a ladder of standard sizes - back end independent
+    def test_image_size_ladder(self):
+        # Off by default
+        self.assertEqual(im.get_ladder_image_size(301, 0), (301, 0))
+        # Geometric ladder 16, 19, 23, 28, 34 ... 251, 302, 362 ...
+        flask_app.config['IMAGE_SIZE_LADDER'] = 1.2
+        self.assertEqual(im.get_ladder_image_size(301, 0), (302, 0))
+        self.assertEqual(im.get_ladder_image_size(302, 0), (302, 0))
+        self.assertEqual(im.get_ladder_image_size(300, 200), (302, 201))
+        rv = self.app.get('/image?src=test_images/cathedral.jpg&format=png&width=301')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['X-Image-Width'], '302')
+        (w, h) = get_png_dimensions(rv.data)
+        self.assertEqual(w, 302)
+        # A nearby size should be served from the same cached image
+        rv = self.app.get('/image?src=test_images/cathedral.jpg&format=png&width=299')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['X-From-Cache'], 'True')
+        (w, h) = get_png_dimensions(rv.data)
+        self.assertEqual(w, 302)
+        # The public image limits should not be exceeded
+        flask_app.config['PUBLIC_MAX_IMAGE_WIDTH'] = 301
+        rv = self.app.get('/image?src=test_images/cathedral.jpg&format=png&width=301')
+        self.assertEqual(rv.status_code, 200)
+        (w, h) = get_png_dimensions(rv.data)
+        self.assertEqual(w, 301)
+        # A fixed list of sizes, with sizes above the top one left alone
+        flask_app.config['IMAGE_SIZE_LADDER'] = [800, 100, 400, 200]
+        self.assertEqual(im.get_ladder_image_size(150, 0), (200, 0))
+        self.assertEqual(im.get_ladder_image_size(0, 350), (0, 400))
+        self.assertEqual(im.get_ladder_image_size(900, 0), (900, 0))
+
     # Test serving of public image with a template and lower public limits - back end independent
     def test_template_public_image_lower_limits(self):
         flask_app.config['PUBLIC_MAX_IMAGE_WIDTH'] = 100
@@ -596,6 +628,40 @@ class CommonImageTests(main_tests.BaseTestCase, ImagingTestCase):
                 self.assertIn('image/png', rv.headers['Content-Type'])
                 self.assertImageMatch(rv.data, self.get_test_image_path('width-500.png'))
 
+    # Test automatic choice of format from the HTTP Accept header
+    def test_auto_format_image(self):
+        for be in CommonImageTests.Backends:
+            main_tests.select_backend(be)
+            with self.subTest(backend=be):
+                if 'webp' not in im.get_image_formats():
+                    continue
+                test_url = '/image?src=test_images/cathedral.jpg&width=500&format=auto'
+                # Browsers that accept WebP should get WebP
+                webp_headers = {'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8'}
+                rv = self.app.get(test_url, headers=webp_headers)
+                self.assertEqual(rv.status_code, 200)
+                self.assertIn('image/webp', rv.headers['Content-Type'])
+                self.assertIn('Accept', rv.headers['Vary'])
+                self.assertEqual(rv.data[8:12], b'WEBP')
+                webp_etag = rv.headers['ETag']
+                # Others should get the default format, and a different ETag
+                rv = self.app.get(test_url, headers={'Accept': 'image/*,*/*;q=0.8'})
+                self.assertEqual(rv.status_code, 200)
+                self.assertIn('image/jpeg', rv.headers['Content-Type'])
+                self.assertIn('Accept', rv.headers['Vary'])
+                self.assertNotEqual(rv.headers['ETag'], webp_etag)
+                rv = self.app.get(test_url, headers={'Accept': 'image/webp;q=0'})
+                self.assertIn('image/jpeg', rv.headers['Content-Type'])
+                # Which should be the same image as asking for the default format
+                rv2 = self.app.get('/image?src=test_images/cathedral.jpg&width=500')
+                self.assertEqual(rv2.headers['ETag'], rv.headers['ETag'])
+                self.assertNotIn('Vary', rv2.headers)
+                # Conditional requests should still work
+                webp_headers['If-None-Match'] = webp_etag
+                rv = self.app.get(test_url, headers=webp_headers)
+                self.assertEqual(rv.status_code, 304)
+                self.assertIn('Accept', rv.headers['Vary'])
+
     # Progressive JPG tests
     def test_pjpeg_format(self):
         for be in CommonImageTests.Backends:
@@ -778,6 +844,270 @@ class PillowTests(main_tests.BaseTestCase, ImagingTestCase):
         self.assertTrue(flask_app.config['IMAGE_RESIZE_GAMMA_CORRECT'])
         self.assertFalse(flask_app.config['PDF_BURST_TO_PNG'])
 
+    # Tests that large JPEG downscales decoded at a reduced size still look right
+    def test_jpeg_draft_resize(self):
+        from unittest import mock
+        from imageserver.imaging_pillow import PillowBackend
+        with open(get_abs_path('test_images/cathedral.jpg'), 'rb') as f:
+            image_data = f.read()
+        for image_spec in [
+            {'width': 150, 'format': 'png'},
+            {'width': 200, 'height': 200, 'format': 'png'},
+            {'width': 100, 'top': 0.1, 'left': 0.1, 'bottom': 0.9, 'right': 0.6, 'format': 'png'},
+            {'width': 150, 'rotation': 45, 'format': 'png'}
+        ]:
+            draft_image = imaging.adjust_image(image_data, 'jpg', dict(image_spec))
+            # A huge margin disables draft mode
+            with mock.patch.object(PillowBackend, 'JPEG_DRAFT_MARGIN', 1000):
+                full_image = imaging.adjust_image(image_data, 'jpg', dict(image_spec))
+            self.assertImageMatch(draft_image, io.BytesIO(full_image))
+
+    # Tests that generating several images from one decode looks the same as one at a time
+    def test_adjust_image_multi(self):
+        with open(get_abs_path('test_images/cathedral.jpg'), 'rb') as f:
+            image_data = f.read()
+        image_specs = [
+            {'width': 800, 'format': 'png'},
+            {'width': 400, 'format': 'png'},
+            {'width': 150, 'format': 'png'},
+            {'width': 150, 'rotation': 90, 'format': 'png'},
+            {'width': 200, 'height': 200, 'top': 0.1, 'bottom': 0.7, 'crop_fit': True, 'format': 'png'},
+            {'width': 100, 'flip': 'h', 'format': 'png'},
+            {'width': 200, 'tile': (2, 4), 'format': 'png'}
+        ]
+        multi_images = imaging.adjust_image_multi(
+            image_data, 'jpg', [dict(image_spec) for image_spec in image_specs]
+        )
+        self.assertEqual(len(multi_images), len(image_specs))
+        for (image_spec, multi_image) in zip(image_specs, multi_images):
+            single_image = imaging.adjust_image(image_data, 'jpg', dict(image_spec))
+            self.assertImageMatch(multi_image, io.BytesIO(single_image))
+        # An invalid spec fails them all
+        self.assertRaises(
+            ValueError,
+            imaging.adjust_image_multi,
+            image_data, 'jpg', [{'width': 100}, {'width': 100, 'flip': 'xx'}]
+        )
+
+    # Tests encoding images to a maximum file size
+    def test_max_bytes(self):
+        from unittest import mock
+        from imageserver.imaging_pillow import PillowBackend
+        with open(get_abs_path('test_images/cathedral.jpg'), 'rb') as f:
+            image_data = f.read()
+        image_spec = {'width': 800, 'format': 'jpg', 'quality': 90}
+        full_size = len(imaging.adjust_image(image_data, 'jpg', dict(image_spec)))
+        # The highest quality that fits should be found
+        image_spec['max_bytes'] = full_size // 2
+        (new_image, quality) = imaging.adjust_image_max_bytes(
+            image_data, 'jpg', dict(image_spec)
+        )
+        self.assertLessEqual(len(new_image), full_size // 2)
+        self.assertLess(quality, 90)
+        image_spec['quality'] = quality + 1
+        self.assertGreater(
+            len(imaging.adjust_image(image_data, 'jpg', dict(image_spec, max_bytes=0))),
+            full_size // 2
+        )
+        image_spec['quality'] = 90
+        # With the right hint, only the hint and the next quality up should be tried
+        with mock.patch.object(
+            PillowBackend, '_get_pillow_save_options',
+            side_effect=PillowBackend._get_pillow_save_options, autospec=True
+        ) as save_opts:
+            (hint_image, hint_quality) = imaging.adjust_image_max_bytes(
+                image_data, 'jpg', dict(image_spec), quality
+            )
+            self.assertEqual(save_opts.call_count, 2)
+        self.assertEqual(hint_quality, quality)
+        self.assertEqual(hint_image, new_image)
+        # A wrong hint should still give the same result
+        (_, hint_quality) = imaging.adjust_image_max_bytes(
+            image_data, 'jpg', dict(image_spec), 5
+        )
+        self.assertEqual(hint_quality, quality)
+        # An impossible limit gives the smallest image
+        image_spec['max_bytes'] = 100
+        (new_image, quality) = imaging.adjust_image_max_bytes(
+            image_data, 'jpg', dict(image_spec)
+        )
+        self.assertEqual(quality, 1)
+        # Via the web, the quality should be recorded for when the image is re-generated
+        rv = self.app.get('/image?src=test_images/cathedral.jpg&width=800&maxbytes=50000')
+        self.assertEqual(rv.status_code, 200)
+        self.assertLessEqual(len(rv.data), 50000)
+        image_attrs = ImageAttrs('test_images/cathedral.jpg', width=800, max_bytes=50000)
+        im.finalise_image_attrs(image_attrs)
+        image_attrs.set_database_id(dm.get_image(src='test_images/cathedral.jpg').id)
+        image_metadata = cm.raw_get(image_attrs.get_metadata_cache_key())
+        self.assertGreater(image_metadata['quality'], 0)
+        self.assertLessEqual(image_metadata['quality'], 80)
+
+    # Tests that a cascade of image sizes resizes each image from the one before
+    def test_adjust_image_cascade(self):
+        from unittest import mock
+        from imageserver.imaging_pillow import PillowBackend
+        with open(get_abs_path('test_images/cathedral.jpg'), 'rb') as f:
+            image_data = f.read()
+        widths = [1131, 800, 566, 400]
+        multi_images = imaging.adjust_image_multi(
+            image_data, 'jpg', [{'width': w} for w in widths]
+        )
+        with mock.patch.object(
+            PillowBackend, '_image_resize_bare',
+            side_effect=PillowBackend._image_resize_bare, autospec=True
+        ) as resize:
+            cascade_images = imaging.adjust_image_cascade(
+                image_data, 'jpg', [{'width': w} for w in widths]
+            )
+            resized_from = [call[0][1].width for call in resize.call_args_list]
+        self.assertEqual(resized_from, [1600, 1131, 800, 566])
+        for (multi_image, cascade_image) in zip(multi_images, cascade_images):
+            self.assertEqual(
+                imaging.get_image_dimensions(cascade_image, 'jpg'),
+                imaging.get_image_dimensions(multi_image, 'jpg')
+            )
+        # Other changes, and images larger than the one before, start from the original
+        cascade_images = imaging.adjust_image_cascade(image_data, 'jpg', [
+            {'width': 400}, {'width': 200, 'top': 0.5}, {'height': 700}, {'width': 50}
+        ])
+        self.assertEqual(
+            [imaging.get_image_dimensions(ci, 'jpg') for ci in cascade_images],
+            [(400, 300), (200, 75), (934, 700), (50, 38)]
+        )
+
+    # Tests gamma correction with lookup tables gives the same result as with profiles
+    def test_resize_gamma_lut(self):
+        from unittest import mock
+        from imageserver.imaging_pillow import PillowBackend
+        with open(get_abs_path('test_images/gamma_dalai_lama_gray_tft.jpg'), 'rb') as f:
+            image_data = f.read()
+        image_spec = {'width': 150, 'format': 'png', 'resize_gamma_lut': True}
+        lut_image = imaging.adjust_image(image_data, 'jpg', image_spec)
+        self.assertImageMatch(lut_image, self.get_test_image_path('gamma_dalai_lama_150.png'))
+        # Images with an embedded colour profile should still be resized using the profile
+        with open(get_abs_path('test_images/book-ecirgb.jpg'), 'rb') as f:
+            image_data = f.read()
+        with mock.patch.object(PillowBackend, '_image_resize_gamma_lut') as lut_resize:
+            imaging.adjust_image(image_data, 'jpg', image_spec)
+            lut_resize.assert_not_called()
+
+    # Tests that colour profile transformations are re-used for the same profile
+    def test_icc_transform_cache(self):
+        with open(get_abs_path('test_images/book-ecirgb.jpg'), 'rb') as f:
+            image_data = f.read()
+        image_spec = {'width': 150, 'strip': True}
+        first_image = imaging.adjust_image(image_data, 'jpg', image_spec)
+        stats = imaging.get_icc_transform_stats()
+        self.assertGreater(stats['count'], 0)
+        second_image = imaging.adjust_image(image_data, 'jpg', image_spec)
+        new_stats = imaging.get_icc_transform_stats()
+        self.assertEqual(new_stats['misses'], stats['misses'])
+        self.assertEqual(new_stats['hits'], stats['hits'] + 3)
+        self.assertEqual(second_image, first_image)
+
+    # Tests that flips and rotations, and crops and resizes, are combined where possible
+    def test_combined_operations(self):
+        from unittest import mock
+        from imageserver.imaging_pillow import PillowBackend
+        with open(get_abs_path('test_images/cathedral.jpg'), 'rb') as f:
+            image_data = f.read()
+        # Flip and right angle rotation should be one transpose
+        with mock.patch.object(PillowBackend, '_image_flip') as flip, \
+             mock.patch.object(PillowBackend, '_image_rotate') as rotate:
+            combined_image = imaging.adjust_image(
+                image_data, 'jpg', {'flip': 'h', 'rotation': 90, 'format': 'png'}
+            )
+            flip.assert_not_called()
+            rotate.assert_not_called()
+        expect_image = PillowImage.open(io.BytesIO(image_data))
+        expect_image = expect_image.transpose(PillowImage.FLIP_LEFT_RIGHT).rotate(-90, expand=True)
+        expect_data = io.BytesIO()
+        expect_image.save(expect_data, 'png')
+        self.assertImageMatch(combined_image, expect_data, tolerance=0)
+        # Crop then resize should be one resize, unless the cropped image is shared
+        image_spec = {
+            'top': 0.1, 'left': 0.2, 'bottom': 0.8, 'right': 0.9,
+            'width': 400, 'resize_gamma': False, 'format': 'png'
+        }
+        with mock.patch.object(PillowBackend, '_image_crop') as crop:
+            combined_image = imaging.adjust_image(image_data, 'jpg', dict(image_spec))
+            crop.assert_not_called()
+        shared_image = imaging.adjust_image_multi(
+            image_data, 'jpg', [dict(image_spec), dict(image_spec)]
+        )[0]
+        self.assertImageMatch(combined_image, io.BytesIO(shared_image))
+
+    # Tests imaging in worker processes gives the same results as in-process
+    def test_imaging_worker_processes(self):
+        from concurrent import futures
+        from concurrent.futures.process import BrokenProcessPool
+        from unittest import mock
+        from imageserver.errors import ServerTooBusyError
+        with open(get_abs_path('test_images/dorset.jpg'), 'rb') as f:
+            image_data = f.read()
+        image_spec = {'width': 200, 'format': 'png', 'strip': True}
+        local_image = imaging.adjust_image(image_data, 'jpg', image_spec)
+        local_dims = imaging.get_image_dimensions(image_data, 'jpg')
+        try:
+            imaging.init(
+                'pillow',
+                flask_app.config['GHOSTSCRIPT_PATH'],
+                flask_app.config['TEMP_DIR'],
+                flask_app.config['PDF_BURST_DPI'],
+                workers=2,
+                queue_size=0
+            )
+            self.assertEqual(imaging.adjust_image(image_data, 'jpg', image_spec), local_image)
+            self.assertEqual(imaging.get_image_dimensions(image_data, 'jpg'), local_dims)
+            # Jobs should be refused when the workers and queue are full
+            for _ in range(2):
+                imaging._executor._slots.acquire()
+            try:
+                self.assertRaises(
+                    ServerTooBusyError,
+                    imaging.adjust_image, image_data, 'jpg', image_spec
+                )
+                # Except for reading the image dimensions
+                self.assertEqual(imaging.get_image_dimensions(image_data, 'jpg'), local_dims)
+            finally:
+                for _ in range(2):
+                    imaging._executor._slots.release()
+            # A crashed pool should be reported as busy, not as a bad image
+            broken_pool = mock.Mock()
+            broken_pool.submit.side_effect = BrokenProcessPool()
+            with mock.patch.object(imaging._executor, '_get_pool', return_value=broken_pool):
+                self.assertRaises(
+                    ServerTooBusyError,
+                    imaging.adjust_image, image_data, 'jpg', image_spec
+                )
+            # A job that was in a crashed pool should be re-run on its own
+            crashed_job = futures.Future()
+            crashed_job.set_exception(BrokenProcessPool())
+            broken_pool.submit.side_effect = None
+            broken_pool.submit.return_value = crashed_job
+            with mock.patch.object(imaging._executor, '_get_pool', return_value=broken_pool):
+                self.assertEqual(imaging.adjust_image(image_data, 'jpg', image_spec), local_image)
+                # Re-runs should only run one at a time
+                imaging._executor._isolated_slot.acquire()
+                try:
+                    with mock.patch.object(imaging._executor, '_job_timeout', 0.1):
+                        self.assertRaises(
+                            ServerTooBusyError,
+                            imaging.adjust_image, image_data, 'jpg', image_spec
+                        )
+                finally:
+                    imaging._executor._isolated_slot.release()
+            # The queue slots are released as each job finishes
+            for _ in range(10):
+                if imaging._executor._slots._value == 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(imaging._executor._slots._value, 2)
+            self.assertEqual(imaging._executor._isolated_slot._value, 1)
+        finally:
+            main_tests.select_backend('pillow')
+
 
 # Tests that should be run only on the ImageMagick back end
 @unittest.skipIf(
@@ -66,6 +66,9 @@ class BytesIOConnection(object):
     def send(self, data):
         return self.buf.write(data)
 
+    def sendall(self, data):
+        self.buf.write(data)
+
     def value(self):
         return self.buf.getvalue()
 
@@ -208,6 +211,81 @@ class StatsHandlerTests(main_tests.FlaskTestCase):
             {'requests': 1}
         )
 
+    @mock.patch('imageserver.stats_manager.StatsManager._client_connect')
+    def test_batched_stats(self, mock_connect):
+        sc = StatsManager(logger, 'Mock', 1, 60000, 0)
+        sc._sock = BytesIOConnection()
+        sc.log_view(7, 1024, False, 0.25)
+        sc.log_view(7, 1024, True, 0.5)
+        sc.log_view(8, 2048, True, 0.125, False)
+        sc.log_request(8, 1)
+        sc.log_download(9, 4096, 0.75)
+        # Nothing should be sent until the stats are flushed
+        self.assertEqual(sc._sock.value(), b'')
+        self.assertTrue(sc.flush())
+        # The totals should be sent as 1 frame of 3 images + system
+        self.assertEqual(
+            len(sc._sock.value()),
+            1 + stats_server.FRAME_HEADER.size + (4 * stats_server.FRAME_RECORD.size)
+        )
+        server = self._mock_server_call(sc._sock.value())
+        self.assertEqual(
+            server.sys_cache,
+            {'requests': 5, 'views': 3, 'cached_views': 2, 'downloads': 1,
+             'bytes': 8192, 'request_seconds': 2.625, 'max_request_seconds': 1}
+        )
+        self.assertEqual(
+            server.img_cache.get(7),
+            {'requests': 2, 'views': 2, 'cached_views': 1, 'bytes': 2048,
+             'request_seconds': 0.75, 'max_request_seconds': 0.5}
+        )
+        self.assertEqual(
+            server.img_cache.get(8),
+            {'requests': 2, 'request_seconds': 1, 'max_request_seconds': 1}
+        )
+        self.assertEqual(
+            server.img_cache.get(9),
+            {'requests': 1, 'downloads': 1, 'bytes': 4096,
+             'request_seconds': 0.75, 'max_request_seconds': 0.75}
+        )
+        # The totals should now be reset
+        self.assertEqual(sc._agg, {})
+
+    @mock.patch('imageserver.stats_manager.StatsManager._client_connect')
+    def test_batched_stats_after_fork(self, mock_connect):
+        sc = StatsManager(logger, 'Mock', 1, 60000, 0)
+        sc._sock = BytesIOConnection()
+        sc.log_view(7, 1024, False, 0.25)
+        # A forked process should not send the totals inherited from its parent
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            sc.log_view(8, 2048, False, 0.5)
+            self.assertTrue(sc.flush())
+        server = self._mock_server_call(sc._sock.value())
+        self.assertIsNone(server.img_cache.get(7))
+        self.assertEqual(
+            server.img_cache.get(8),
+            {'requests': 1, 'views': 1, 'bytes': 2048,
+             'request_seconds': 0.5, 'max_request_seconds': 0.5}
+        )
+
+    @mock.patch('imageserver.stats_manager.StatsManager._client_connect')
+    def test_batched_and_json_stats(self, mock_connect):
+        # The server should accept a mix of JSON and binary messages
+        sc = StatsManager(logger, 'Mock', 1)
+        sc._sock = BytesIOConnection()
+        sc.log_view(7, 1024, False, 0.25)
+        sc_batch = StatsManager(logger, 'Mock', 1, 60000, 0)
+        sc_batch._sock = sc._sock
+        sc_batch.log_view(7, 1024, True, 0.5)
+        sc_batch.flush()
+        sc.log_request(7, 0.125)
+        server = self._mock_server_call(sc._sock.value())
+        self.assertEqual(
+            server.img_cache.get(7),
+            {'requests': 3, 'views': 2, 'cached_views': 1, 'bytes': 2048,
+             'request_seconds': 0.875, 'max_request_seconds': 0.5}
+        )
+
 
 class StatsServerTests(main_tests.FlaskTestCase):
     # Utility - ensure the stats server connection is up and delete any pending
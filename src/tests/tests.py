@@ -38,6 +38,7 @@
 #
 
 import json
+import math
 import os
 import shutil
 import subprocess
@@ -78,11 +79,12 @@ from imageserver.filesystem_sync import (
 )
 from imageserver.flask_util import internal_url_for
 from imageserver.image_attrs import ImageAttrs
+from imageserver.image_manager import ImageManager
 from imageserver.models import (
     Folder, Group, User, Image, ImageHistory, ImageTemplate,
     FolderPermission, SystemPermissions
 )
-from imageserver.permissions_manager import _trace_to_str
+from imageserver.permissions_manager import FolderPermissionTree, _trace_to_str
 from imageserver.session_manager import get_session_user
 from imageserver.scripts.cache_util import delete_image_ids
 from imageserver.template_attrs import TemplateAttrs
@@ -951,6 +953,17 @@ class ImageServerMiscTests(BaseTestCase):
         i = ImageAttrs('', 1, icc_profile='', icc_intent='relative', icc_bpc=True)
         i.normalise_values()
         self.assertEqual(i.get_cache_key(), 'IMG:1')
+        # Cache generation number
+        i = ImageAttrs('', 1, width=200)
+        i.set_generation(123)
+        self.assertEqual(i.get_cache_key(), 'IMG:1,U123,W200')
+        # Max file size, where 0 means no limit
+        i = ImageAttrs('', 1, width=200, max_bytes=20000)
+        i.normalise_values()
+        self.assertEqual(i.get_cache_key(), 'IMG:1,W200,M20000')
+        i = ImageAttrs('', 1, width=200, max_bytes=0)
+        i.normalise_values()
+        self.assertEqual(i.get_cache_key(), 'IMG:1,W200')
 
     # Test requested image attributes get applied and processed properly
     def test_image_attrs_precedence(self):
@@ -989,6 +1002,144 @@ class ImageServerMiscTests(BaseTestCase):
         )
         self.assertIsNone(ia.dpi())
 
+    # Test that concurrent requests for the same new image only generate it once
+    def test_image_generation_coalescing(self):
+        import threading
+        image_obj = auto_sync_existing_file('test_images/dorset.jpg', dm, tm)
+        image_attrs = ImageAttrs('test_images/dorset.jpg', image_obj.id, width=123, rotation=45)
+        im.reset_image(image_attrs)
+        results = []
+        with mock.patch.object(im, '_adjust_image', wraps=im._adjust_image) as mockadjust:
+            threads = [
+                threading.Thread(target=lambda: results.append(im.get_image(image_attrs)))
+                for _ in range(5)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(mockadjust.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len([r for r in results if r.is_from_cache()]), 4)
+        self.assertEqual(len(im._flights), 0)
+
+    # Test that coalesced requests share an image that was not added to cache
+    def test_image_generation_coalescing_uncached(self):
+        import threading
+        image_obj = auto_sync_existing_file('test_images/dorset.jpg', dm, tm)
+        image_attrs = ImageAttrs('test_images/dorset.jpg', image_obj.id, width=124, rotation=45)
+        im.reset_image(image_attrs)
+        adjust_image = im._adjust_image
+
+        def slow_adjust_image(*args):
+            time.sleep(0.5)
+            return adjust_image(*args)
+
+        results = []
+        with mock.patch.object(im, '_admit_to_cache', return_value=False), \
+             mock.patch.object(im, '_adjust_image', side_effect=slow_adjust_image) as mockadjust:
+            threads = [
+                threading.Thread(target=lambda: results.append(im.get_image(image_attrs)))
+                for _ in range(5)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(mockadjust.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len([r for r in results if r.is_from_cache()]), 0)
+        self.assertEqual(len(set(r.data() for r in results)), 1)
+        self.assertIsNone(cm.get(image_attrs.get_cache_key()))
+        self.assertEqual(len(im._flights), 0)
+
+    # Test that several variants of an image are generated from one decode of the original
+    def test_get_image_variants(self):
+        image_obj = auto_sync_existing_file('test_images/dorset.jpg', dm, tm)
+        variant_attrs = [
+            ImageAttrs('test_images/dorset.jpg', image_obj.id, width=500),
+            ImageAttrs('test_images/dorset.jpg', image_obj.id, width=200, rotation=90),
+            ImageAttrs('test_images/dorset.jpg', image_obj.id, width=100, iformat='png'),
+            ImageAttrs('test_images/dorset.jpg', image_obj.id, width=100, iformat='png')
+        ]
+        for image_attrs in variant_attrs:
+            im.finalise_image_attrs(image_attrs)
+        im.reset_image(variant_attrs[0])
+        with mock.patch.object(imaging, 'adjust_image_multi', wraps=imaging.adjust_image_multi) as mockmulti:
+            with mock.patch.object(imaging, 'adjust_image', wraps=imaging.adjust_image) as mockadjust:
+                results = im.get_image_variants(variant_attrs)
+                self.assertEqual(mockmulti.call_count, 1)
+                self.assertEqual(mockadjust.call_count, 0)
+        self.assertEqual([r.is_from_cache() for r in results], [False, False, False, True])
+        for (image_attrs, result) in zip(variant_attrs, results):
+            self.assertEqual(result.attrs(), image_attrs)
+            self.assertEqual(result.data(), cm.get(image_attrs.get_cache_key()))
+        # Should all come from cache the second time
+        results = im.get_image_variants(variant_attrs)
+        self.assertTrue(all(r.is_from_cache() for r in results))
+        # Should not clear an image lock that another client holds
+        im.reset_image(variant_attrs[0])
+        other_key = variant_attrs[1].get_cache_key()
+        im._set_image_lock(other_key, 10)
+        try:
+            im._generate_image_variants(variant_attrs[:2], True)
+            self.assertTrue(im._is_image_lock(other_key))
+            self.assertFalse(im._is_image_lock(variant_attrs[0].get_cache_key()))
+        finally:
+            im._clear_image_lock(other_key)
+        # Must all be for the same file
+        self.assertRaises(
+            ValueError,
+            im.get_image_variants,
+            [variant_attrs[0], ImageAttrs('test_images/cathedral.jpg', width=100)]
+        )
+
+    # Test the invalidation of cached images with cache generation numbers
+    def test_image_cache_generations(self):
+        image_obj = auto_sync_existing_file('test_images/dorset.jpg', dm, tm)
+        flask_app.config['IMAGE_CACHE_GENERATIONS'] = True
+        try:
+            def get_attrs():
+                return im.finalise_image_attrs(
+                    ImageAttrs('test_images/dorset.jpg', image_obj.id, width=200)
+                )
+            image_attrs = get_attrs()
+            self.assertFalse(im.get_image(image_attrs).is_from_cache())
+            gen1 = image_attrs.generation()
+            self.assertGreater(gen1, 0)
+            self.assertTrue(im.get_image(get_attrs()).is_from_cache())
+            # Uncaching the image should change the generation number
+            im._uncache_image_id(image_obj.id)
+            image_attrs = get_attrs()
+            self.assertFalse(im.get_image(image_attrs).is_from_cache())
+            gen2 = image_attrs.generation()
+            self.assertGreater(gen2, gen1)
+            # The old image should not be used as a base image
+            image_attrs = im.finalise_image_attrs(
+                ImageAttrs('test_images/dorset.jpg', image_obj.id, width=100)
+            )
+            im._set_image_generations([image_attrs])
+            base_image = im._get_base_image(image_attrs)
+            self.assertIsNotNone(base_image)
+            self.assertEqual(base_image.attrs().generation(), gen2)
+            # The old entries should be deleted by the background task
+            self.assertTrue(any(
+                m['metadata'].generation() == gen1
+                for m in cm.search(searchfield1__eq=image_obj.id)
+            ))
+            im._uncache_image_generations(image_obj.id)
+            self.assertEqual(
+                set(m['metadata'].generation() for m in cm.search(searchfield1__eq=image_obj.id)),
+                {gen2}
+            )
+            # Uncaching a parent folder should change it too
+            self.assertTrue(im._uncache_folder('/'))
+            image_attrs = get_attrs()
+            self.assertFalse(im.get_image(image_attrs).is_from_cache())
+            self.assertGreater(image_attrs.generation(), gen2)
+        finally:
+            flask_app.config['IMAGE_CACHE_GENERATIONS'] = False
+
     # Test the identification of suitable base images in cache
     def test_base_image_detection(self):
         image_obj = auto_sync_existing_file('test_images/dorset.jpg', dm, tm)
@@ -1210,6 +1361,129 @@ class ImageServerMiscTests(BaseTestCase):
         base = im._get_base_image(im.finalise_image_attrs(try_attrs))
         assert base is not None and base.attrs().width() == 500
 
+    # Test that the other tiles in a grid are generated along with the first tile
+    def test_tile_grids(self):
+        orig_img = auto_sync_existing_file('test_images/cathedral.jpg', dm, tm)
+        orig_attrs = ImageAttrs(orig_img.src, orig_img.id)
+        tile_url = '/image?src=test_images/cathedral.jpg&width=800&strip=0&tile=%d:16'
+        try:
+            # Get the tiles without grid generation
+            im.reset_image(orig_attrs)
+            tiles = [self.app.get(tile_url % n).data for n in range(1, 17)]
+            im.reset_image(orig_attrs)
+            flask_app.config['IMAGE_TILE_GRIDS'] = True
+            rv = self.app.get(tile_url % 6)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.headers['X-From-Cache'], 'False')
+            self.assertEqual(rv.data, tiles[5])
+            # The other tiles should now all be cached
+            for n in range(1, 17):
+                rv = self.app.get(tile_url % n)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.headers['X-From-Cache'], 'True')
+                self.assertEqual(rv.data, tiles[n - 1])
+        finally:
+            im.reset_image(orig_attrs)
+
+    # Test the Deep Zoom (DZI) tile pyramid descriptor and tiles
+    def test_dzi_tiles(self):
+        from imageserver.filesystem_manager import get_file_data
+        orig_img = auto_sync_existing_file('test_images/cathedral.jpg', dm, tm)
+        orig_attrs = ImageAttrs(orig_img.src, orig_img.id)
+        tile_url = '/tiles/test_images/cathedral.jpg_files/%d/%d_%d.jpg'
+        try:
+            im.reset_image(orig_attrs)
+            rv = self.app.get('/tiles/test_images/cathedral.jpg.dzi')
+            self.assertEqual(rv.status_code, 200)
+            self.assertIn('application/xml', rv.headers['Content-Type'])
+            descriptor = rv.data.decode('utf8')
+            self.assertIn('TileSize="254" Overlap="1" Format="jpg"', descriptor)
+            self.assertIn('<Size Width="1600" Height="1200"/>', descriptor)
+            # 1600x1200 should be levels 0 to 11, where level 9 is 400x300
+            levels = ImageManager.get_dzi_levels(1600, 1200)
+            self.assertEqual(len(levels), 12)
+            self.assertEqual(levels[0], (1, 1))
+            self.assertEqual(levels[9], (400, 300))
+            # The original image should be read only once for the lower levels
+            with mock.patch(
+                'imageserver.image_manager.get_file_data', wraps=get_file_data
+            ) as read_file:
+                rv = self.app.get(tile_url % (9, 1, 0))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(im.get_image_data_dimensions(rv.data, 'jpg'), (147, 255))
+                rv = self.app.get(tile_url % (9, 1, 1))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(im.get_image_data_dimensions(rv.data, 'jpg'), (147, 47))
+                rv = self.app.get(tile_url % (7, 0, 0))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(im.get_image_data_dimensions(rv.data, 'jpg'), (100, 75))
+                self.assertEqual(read_file.call_count, 1)
+            # Tiles should be cached
+            rv = self.app.get(tile_url % (9, 1, 0))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.headers['X-From-Cache'], 'True')
+            # Tiles outside the pyramid
+            rv = self.app.get(tile_url % (12, 0, 0))
+            self.assertEqual(rv.status_code, 404)
+            rv = self.app.get(tile_url % (9, 2, 0))
+            self.assertEqual(rv.status_code, 404)
+            rv = self.app.get('/tiles/test_images/nosuchfile.jpg.dzi')
+            self.assertEqual(rv.status_code, 404)
+        finally:
+            im.reset_image(orig_attrs)
+
+    # Test Deep Zoom (DZI) tiles at levels larger than the maximum image size
+    def test_dzi_tiles_large_levels(self):
+        from imageserver.filesystem_manager import get_file_data
+        orig_img = auto_sync_existing_file('test_images/cathedral.jpg', dm, tm)
+        orig_attrs = ImageAttrs(orig_img.src, orig_img.id)
+        tile_url = '/tiles/test_images/cathedral.jpg_files/%d/%d_%d.jpg'
+        old_max_dimension = flask_app.config['MAX_IMAGE_DIMENSION']
+        try:
+            im.reset_image(orig_attrs)
+            # Level 10 of 1600x1200 is 800x600, level 11 is the full size image
+            flask_app.config['MAX_IMAGE_DIMENSION'] = 500
+            ImageAttrs.reset_validators()
+            levels = ImageManager.get_dzi_levels(1600, 1200)
+            self.assertEqual(im._get_dzi_max_image_level(levels), 9)
+            # The tiles at the top levels should be cut from the original image,
+            # with the other tiles in the same block cut from the same decode
+            with mock.patch.object(
+                im, '_get_dzi_level_image', wraps=im._get_dzi_level_image
+            ) as level_image, mock.patch(
+                'imageserver.image_manager.get_file_data', wraps=get_file_data
+            ) as read_file:
+                rv = self.app.get(tile_url % (10, 0, 0))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(im.get_image_data_dimensions(rv.data, 'jpg'), (255, 255))
+                rv = self.app.get(tile_url % (11, 6, 4))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(im.get_image_data_dimensions(rv.data, 'jpg'), (77, 185))
+                rv = self.app.get(tile_url % (11, 3, 2))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.headers['X-From-Cache'], 'True')
+                self.assertEqual(im.get_image_data_dimensions(rv.data, 'jpg'), (256, 256))
+                self.assertEqual(read_file.call_count, 2)
+                self.assertEqual(level_image.call_count, 0)
+                # And the lower levels from level images, starting at level 9
+                rv = self.app.get(tile_url % (8, 0, 0))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(im.get_image_data_dimensions(rv.data, 'jpg'), (200, 150))
+                self.assertEqual(level_image.call_count, 2)
+            # The tile cropping should select exact pixels even in huge levels
+            huge_levels = ImageManager.get_dzi_levels(200000, 1000)
+            (_, tile_crop) = im._get_dzi_tile_attrs(
+                orig_attrs, huge_levels, len(huge_levels) - 1, 500, 2
+            )
+            self.assertEqual(
+                [math.ceil(v * 200000) for v in (tile_crop[1], tile_crop[3])],
+                [500 * 254 - 1, 501 * 254 + 1]
+            )
+        finally:
+            flask_app.config['MAX_IMAGE_DIMENSION'] = old_max_dimension
+            ImageAttrs.reset_validators()
+            im.reset_image(orig_attrs)
+
     # Test changing the default template values
     def test_default_template_settings(self):
         try:
@@ -1362,6 +1636,121 @@ class ImageServerMiscTests(BaseTestCase):
         finally:
             os.remove(tempfile)
 
+    # Test that originals are streamed from disk with support for HTTP Range requests
+    def test_original_range_requests(self):
+        with open(get_abs_path('test_images/cathedral.jpg'), 'rb') as f:
+            file_data = f.read()
+        rv = self.app.get('/original?src=test_images/cathedral.jpg')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers.get('Accept-Ranges'), 'bytes')
+        self.assertEqual(rv.data, file_data)
+        # Partial content
+        rv = self.app.get(
+            '/original?src=test_images/cathedral.jpg',
+            headers={'Range': 'bytes=1000-1999'}
+        )
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.headers.get('Content-Range'), 'bytes 1000-1999/%d' % len(file_data))
+        self.assertEqual(rv.headers.get('Content-Length'), '1000')
+        self.assertEqual(rv.data, file_data[1000:2000])
+        # Suffix range
+        rv = self.app.get(
+            '/original?src=test_images/cathedral.jpg',
+            headers={'Range': 'bytes=-100'}
+        )
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, file_data[-100:])
+        # Unsatisfiable range
+        rv = self.app.get(
+            '/original?src=test_images/cathedral.jpg',
+            headers={'Range': 'bytes=%d-' % (len(file_data) + 1)}
+        )
+        self.assertEqual(rv.status_code, 416)
+        # If-Range with an old ETag should return the whole file
+        rv = self.app.get(
+            '/original?src=test_images/cathedral.jpg',
+            headers={'Range': 'bytes=0-99', 'If-Range': '"not-the-etag"'}
+        )
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(rv.data), len(file_data))
+
+    # Test that unaltered images too large for the cache are streamed from disk
+    def test_image_passthrough_streaming(self):
+        image_obj = auto_sync_existing_file('test_images/cathedral.jpg', dm, tm)
+        image_attrs = ImageAttrs('test_images/cathedral.jpg', image_obj.id)
+        self.assertIsNone(im.get_image_passthrough(image_attrs))
+        with mock.patch.object(ImageManager, 'PASSTHROUGH_STREAM_MIN_SIZE', 1000):
+            image_wrapper = im.get_image_passthrough(image_attrs)
+            self.assertIsNotNone(image_wrapper)
+            self.assertIsNone(image_wrapper.data())
+            self.assertEqual(image_wrapper.data_size(), 648496)
+            self.assertEqual(image_wrapper.file_path(), get_abs_path('test_images/cathedral.jpg'))
+            # But not altered images
+            image_attrs = ImageAttrs('test_images/cathedral.jpg', image_obj.id, width=200)
+            self.assertIsNone(im.get_image_passthrough(image_attrs))
+
+    # Test that rarely requested images are not cached when the cache is full
+    def test_image_cache_admission(self):
+        from imageserver.cache_manager import FrequencySketch
+        image_obj = auto_sync_existing_file('test_images/cathedral.jpg', dm, tm)
+        image_attrs = ImageAttrs('test_images/cathedral.jpg', image_obj.id, width=230)
+        im.finalise_image_attrs(image_attrs)
+        im.reset_image(image_attrs)
+        old_min_secs = flask_app.config['IMAGE_CACHE_ADMISSION_MIN_SECS']
+        try:
+            flask_app.config['IMAGE_CACHE_ADMISSION_MIN_SECS'] = 60
+            with mock.patch.object(im, '_admission_sketch', FrequencySketch()), \
+                 mock.patch.object(im, '_admission_counts', {'admitted': 0, 'rejected': 0}), \
+                 mock.patch.object(im, '_is_cache_nearly_full', return_value=True):
+                # First request should not be cached
+                image_wrapper = im.get_image(image_attrs)
+                self.assertFalse(image_wrapper.is_from_cache())
+                self.assertIsNone(cm.get(image_attrs.get_cache_key()))
+                # Second request should be cached
+                image_wrapper = im.get_image(image_attrs)
+                self.assertFalse(image_wrapper.is_from_cache())
+                self.assertIsNotNone(cm.get(image_attrs.get_cache_key()))
+                self.assertTrue(im.get_image(image_attrs).is_from_cache())
+                stats = im.get_cache_admission_stats()
+                self.assertEqual(stats['admitted'], 1)
+                self.assertEqual(stats['rejected'], 1)
+                self.assertEqual(stats['admit_ratio'], 0.5)
+                # Unless the image is expensive to generate
+                flask_app.config['IMAGE_CACHE_ADMISSION_MIN_SECS'] = 0
+                image_attrs = ImageAttrs('test_images/cathedral.jpg', image_obj.id, width=231)
+                im.finalise_image_attrs(image_attrs)
+                im.get_image(image_attrs)
+                self.assertIsNotNone(cm.get(image_attrs.get_cache_key()))
+            self.assertIsNone(im.get_cache_admission_stats())
+        finally:
+            flask_app.config['IMAGE_CACHE_ADMISSION_MIN_SECS'] = old_min_secs
+            im.reset_image(image_attrs)
+
+    # Test that images in the disk cache are streamed from the cache file
+    def test_image_disk_cache_streaming(self):
+        from imageserver.cache_manager import DiskCache
+        cache_dir = '/tmp/qis_disk_cache'
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            with mock.patch.object(cm, '_disk_cache', DiskCache(cache_dir, 10 * 1024 * 1024)):
+                image_obj = auto_sync_existing_file('test_images/cathedral.jpg', dm, tm)
+                image_attrs = ImageAttrs('test_images/cathedral.jpg', image_obj.id, width=210)
+                im.finalise_image_attrs(image_attrs)
+                image_data = im.get_image(image_attrs, 'refresh').data()
+                # Eject the image from memcached only
+                cm.raw_delete(image_attrs.get_cache_key() + '_1')
+                image_wrapper = im.get_image(image_attrs, stream=True)
+                self.assertTrue(image_wrapper.is_from_cache())
+                self.assertIsNone(image_wrapper.data())
+                self.assertEqual(image_wrapper.data_size(), len(image_data))
+                self.assertTrue(image_wrapper.file_path().startswith(cache_dir))
+                # Otherwise the image data should be read from the disk cache
+                image_wrapper = im.get_image(image_attrs)
+                self.assertTrue(image_wrapper.is_from_cache())
+                self.assertEqual(image_wrapper.data(), image_data)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
     # Image management database tests
     def test_db_auto_population(self):
         folder_path = 'test_images'
@@ -1933,6 +2322,36 @@ class ImageServerMiscTests(BaseTestCase):
             set_default_public_permission(FolderPermission.ACCESS_DOWNLOAD)
             set_default_internal_permission(FolderPermission.ACCESS_DOWNLOAD)
 
+    # Test the in-memory folder permissions lookups
+    def test_folder_permission_tree(self):
+        fp_tree = FolderPermissionTree(1, [
+            ('/', Group.ID_PUBLIC, FolderPermission.ACCESS_VIEW),
+            ('/', 10, FolderPermission.ACCESS_NONE),
+            ('/a', 10, FolderPermission.ACCESS_DOWNLOAD),
+            ('/a/b/c', Group.ID_PUBLIC, FolderPermission.ACCESS_NONE),
+            ('/a/b/c', 11, FolderPermission.ACCESS_EDIT),
+            ('/ab', 10, FolderPermission.ACCESS_ALL),
+        ])
+        self.assertEqual(fp_tree.version, 1)
+        self.assertEqual(
+            fp_tree.get_nearest_access('/', [Group.ID_PUBLIC, 10, 11]),
+            {Group.ID_PUBLIC: FolderPermission.ACCESS_VIEW, 10: FolderPermission.ACCESS_NONE}
+        )
+        self.assertEqual(
+            fp_tree.get_nearest_access('/a/b', [Group.ID_PUBLIC, 10, 11]),
+            {Group.ID_PUBLIC: FolderPermission.ACCESS_VIEW, 10: FolderPermission.ACCESS_DOWNLOAD}
+        )
+        self.assertEqual(
+            fp_tree.get_nearest_access('a/b/c/d/', [Group.ID_PUBLIC, 10, 11]),
+            {Group.ID_PUBLIC: FolderPermission.ACCESS_NONE, 10: FolderPermission.ACCESS_DOWNLOAD,
+             11: FolderPermission.ACCESS_EDIT}
+        )
+        self.assertEqual(
+            fp_tree.get_nearest_access('/abc', [Group.ID_PUBLIC, 10]),
+            {Group.ID_PUBLIC: FolderPermission.ACCESS_VIEW, 10: FolderPermission.ACCESS_NONE}
+        )
+        self.assertEqual(fp_tree.get_nearest_access('/a', [12]), {})
+
     # Test image and page access (folder permissions)
     def test_folder_permissions(self):
         temp_file = '/tmp/qis_uploadfile.jpg'
@@ -2351,6 +2770,38 @@ class ImageServerCacheTests(BaseTestCase):
         ret = cm.raw_get('knight')
         self.assertIsNone(ret)
 
+    # Test adding many managed objects and atomic values in one call
+    def test_cache_engine_multi(self):
+        from imageserver.cache_manager import MAX_SLOT_SIZE
+        big_obj = b'x' * MAX_SLOT_SIZE + b'y' * 100
+        try:
+            self.assertIsNone(cm.get('ni'), 'Test object already in cache - reset cache and re-run tests')
+            with mock.patch.object(cm, 'raw_putn', wraps=cm.raw_putn) as raw_putn:
+                ok = cm.putn({'ni': b'shrubbery', 'ekke': 'ptang', 'zoo': big_obj}, 0, {
+                    'ni': {
+                        'searchfield1': -2, 'searchfield2': 100, 'searchfield3': 100,
+                        'searchfield4': None, 'searchfield5': None, 'metadata': 'Herring'
+                    }
+                })
+                self.assertTrue(ok)
+                # The single chunk objects should be added in one call
+                self.assertEqual(raw_putn.call_count, 1)
+            self.assertEqual(cm.get('ni'), b'shrubbery')
+            self.assertEqual(cm.get('ekke'), 'ptang')
+            self.assertEqual(cm.get('zoo'), big_obj)
+            ret = cm.search(order=None, max_rows=1, searchfield1__eq=-2)
+            self.assertEqual(len(ret), 1)
+            self.assertEqual(ret[0]['key'], 'ni')
+            # Atomic adds only succeed for keys that are not already set
+            self.assertTrue(cm.raw_put('ni_lock', 'LOCK'))
+            added = cm.raw_atomic_addn({'ni_lock': 'LOCK', 'ekke_lock': 'LOCK'})
+            self.assertEqual(added, ['ekke_lock'])
+            self.assertEqual(cm.raw_atomic_addn({'ni_lock': 'LOCK', 'ekke_lock': 'LOCK'}), [])
+        finally:
+            for key in ['ni', 'ekke', 'zoo']:
+                cm.delete(key)
+            cm.raw_deleten(['ni_lock', 'ekke_lock'])
+
     # Test managed cache
     def test_cache_engine(self):
         ret = cm.get('grail')
@@ -2380,6 +2831,249 @@ class ImageServerCacheTests(BaseTestCase):
         ret = cm.get('grail')
         self.assertIsNone(ret, 'Failed to delete object from cache')
 
+    # Test fused fetching of a managed object with its metadata and other keys
+    def test_cache_engine_fused(self):
+        from imageserver.cache_manager import LocalCache, MAX_SLOT_SIZE
+        big_obj = b'x' * MAX_SLOT_SIZE + b'y' * 100
+        try:
+            (obj, meta, extras) = cm.get_fused('coconut', 'coconut_md', ['coconut_lock'])
+            self.assertIsNone(obj)
+            self.assertIsNone(meta)
+            self.assertEqual(extras, {})
+            # A single chunk object, its metadata and the extras in one call
+            self.assertTrue(cm.put('swallow', b'African'))
+            self.assertTrue(cm.raw_put('swallow_md', {'modified': 1}))
+            self.assertTrue(cm.raw_put('coconut_lock', 'LOCK'))
+            with mock.patch.object(cm, 'raw_getn', wraps=cm.raw_getn) as raw_getn:
+                (obj, meta, extras) = cm.get_fused('swallow', 'swallow_md', ['coconut_lock'])
+                self.assertEqual(raw_getn.call_count, 1)
+            self.assertEqual(obj, b'African')
+            self.assertEqual(meta, {'modified': 1})
+            self.assertEqual(extras, {'coconut_lock': 'LOCK'})
+            # Without metadata, the second chunk is fetched separately
+            self.assertTrue(cm.put('coconut', big_obj))
+            (obj, meta, extras) = cm.get_fused('coconut', 'coconut_md', ['coconut_lock'])
+            self.assertEqual(obj, big_obj)
+            self.assertIsNone(meta)
+            # With the metadata known locally, all chunks are fetched in one call
+            with mock.patch.object(cm, '_local_cache', LocalCache(16 * MAX_SLOT_SIZE, 60)):
+                self.assertTrue(cm.raw_put('coconut_md', {'size': len(big_obj)}, local_cache=True))
+                with mock.patch.object(cm, 'raw_getn', wraps=cm.raw_getn) as raw_getn:
+                    (obj, meta, extras) = cm.get_fused('coconut', 'coconut_md', ['coconut_lock'])
+                    self.assertEqual(raw_getn.call_count, 1)
+                self.assertEqual(obj, big_obj)
+                self.assertEqual(meta, {'size': len(big_obj)})
+                self.assertEqual(extras, {'coconut_lock': 'LOCK'})
+            # A missing chunk should be a cache miss
+            cm.raw_delete('coconut_2')
+            (obj, _, _) = cm.get_fused('coconut', 'coconut_md')
+            self.assertIsNone(obj)
+        finally:
+            cm.delete('coconut')
+            cm.delete('swallow')
+            cm.raw_deleten(['coconut_md', 'swallow_md', 'coconut_lock'])
+
+    # Test managed cache with the cache control index in memcached
+    def test_cache_engine_memcached_index(self):
+        from imageserver.cache_manager import CacheManager, INDEX_MEMCACHED
+        icm = CacheManager(
+            lm,
+            flask_app.config['MEMCACHED_SERVERS'],
+            flask_app.config['CACHE_DATABASE_CONNECTION'],
+            1,
+            index_mode=INDEX_MEMCACHED,
+            index_flush_secs=60
+        )
+        try:
+            for (key, sf2, md) in [('shrubbery', 100, 'Ni'), ('herring', 50, 'Ekke')]:
+                ok = icm.put(key, 'A ' + key, 0, {
+                    'searchfield1': -2, 'searchfield2': sf2, 'searchfield3': 100,
+                    'searchfield4': None, 'searchfield5': None, 'metadata': md
+                })
+                self.assertTrue(ok)
+            # Search from the index, before the database has been written to
+            self.assertEqual(len(icm._db_search(None, 10, {'searchfield1__eq': -2})), 0)
+            ret = icm.search(order='-size', max_rows=10, searchfield1__eq=-2, searchfield4__eq=None)
+            self.assertEqual([r['key'] for r in ret], ['shrubbery', 'herring'])
+            ret = icm.search(searchfield1__eq=[-2, -3], searchfield2__gt=99)
+            self.assertEqual(len(ret), 1)
+            self.assertEqual(ret[0]['key'], 'shrubbery')
+            self.assertEqual(ret[0]['metadata'], 'Ni')
+            # Delete should update the index
+            self.assertTrue(icm.delete('herring'))
+            ret = icm.search(searchfield1__eq=-2)
+            self.assertEqual([r['key'] for r in ret], ['shrubbery'])
+            # Database should be written in batches
+            icm._index.flush()
+            ret = icm._db_search(None, 10, {'searchfield1__eq': -2})
+            self.assertEqual([r['key'] for r in ret], ['shrubbery'])
+            # Index should be re-built from the database if lost
+            icm.raw_delete('CACHECTL:-2')
+            ret = icm.search(searchfield1__eq=-2, searchfield3__lte=100)
+            self.assertEqual([r['key'] for r in ret], ['shrubbery'])
+            self.assertIsNotNone(icm.raw_get('CACHECTL:-2'))
+        finally:
+            icm.delete('shrubbery')
+            icm.delete('herring')
+            icm.raw_deleten(['CACHECTL:-2', 'CACHECTL:-3'])
+            icm.close()
+
+    # Test the in-process local cache
+    def test_local_cache(self):
+        from imageserver.cache_manager import LocalCache
+        lc = LocalCache(800, 60)
+        self.assertIsNone(lc.get('dead parrot'))
+        lc.put('dead parrot', b'x' * 100)
+        self.assertEqual(lc.get('dead parrot'), b'x' * 100)
+        # Too large for the cache (> 1/8 of capacity)
+        lc.put('lumberjack', b'x' * 101)
+        self.assertIsNone(lc.get('lumberjack'))
+        # Least recently used entries should be evicted first
+        for i in range(8):
+            lc.put('spam' + str(i), b'x' * 100)
+        self.assertIsNone(lc.get('dead parrot'))
+        self.assertEqual(lc.get('spam7'), b'x' * 100)
+        stats = lc.stats()
+        self.assertEqual(stats['count'], 8)
+        self.assertEqual(stats['size'], 800)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        # Prefix deletion
+        lc.delete_prefix('spam1')
+        self.assertIsNone(lc.get('spam1'))
+        self.assertEqual(lc.stats()['count'], 7)
+        # Prefix deletion with a separator, matching the exact key too
+        lc.put('IMG:1', b'x')
+        lc.put('IMG:1,W100', b'x')
+        lc.put('IMG:10', b'x')
+        lc.delete_prefix('IMG:1', ',')
+        self.assertIsNone(lc.get('IMG:1'))
+        self.assertIsNone(lc.get('IMG:1,W100'))
+        self.assertEqual(lc.get('IMG:10'), b'x')
+        # Expiry
+        lc = LocalCache(800, 0)
+        lc.put('dead parrot', b'x')
+        self.assertIsNone(lc.get('dead parrot'))
+
+    # Test the cache admission frequency sketch
+    def test_frequency_sketch(self):
+        from imageserver.cache_manager import FrequencySketch
+        fs = FrequencySketch(1000)
+        self.assertEqual(fs.frequency('spam'), 0)
+        fs.increment('spam')
+        fs.increment('spam')
+        self.assertEqual(fs.frequency('spam'), 2)
+        self.assertEqual(fs.frequency('eggs'), 0)
+        # Counts are capped
+        for _ in range(50):
+            fs.increment('eggs')
+        self.assertEqual(fs.frequency('eggs'), FrequencySketch.MAX_COUNT)
+        # Counts are halved after every 10 * width increments (1000 --> 1024)
+        for i in range(10 * 1024 - 2 - FrequencySketch.MAX_COUNT):
+            fs.increment('bacon' + str(i))
+        self.assertLessEqual(fs.frequency('eggs'), FrequencySketch.MAX_COUNT // 2 + 1)
+
+    # Test the local disk cache
+    def test_disk_cache(self):
+        import threading
+        from imageserver.cache_manager import DiskCache
+        cache_dir = '/tmp/qis_disk_cache'
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            dc = DiskCache(cache_dir, 800)
+            self.assertIsNone(dc.get('dead parrot'))
+            self.assertTrue(dc.put('dead parrot', b'x' * 100))
+            self.assertEqual(dc.get('dead parrot'), b'x' * 100)
+            (file_path, file_size) = dc.get_file('dead parrot')
+            self.assertTrue(file_path.startswith(cache_dir))
+            self.assertEqual(file_size, 100)
+            # Too large for the cache (> 1/8 of capacity), or not binary
+            self.assertFalse(dc.put('lumberjack', b'x' * 101))
+            self.assertFalse(dc.put('lumberjack', 'x'))
+            self.assertIsNone(dc.get('lumberjack'))
+            # Least recently used entries should be evicted first
+            for i in range(8):
+                self.assertTrue(dc.put('spam' + str(i), b'x' * 100))
+            self.assertIsNone(dc.get('dead parrot'))
+            self.assertFalse(os.path.exists(file_path))
+            stats = dc.stats()
+            self.assertEqual(stats['count'], 8)
+            self.assertEqual(stats['size'], 800)
+            self.assertEqual(stats['evictions'], 1)
+            # The index should be re-built on startup, without any temp files
+            (file_path, _) = dc.get_file('spam0')
+            temp_path = os.path.join(os.path.dirname(file_path), '.tmp_crashed')
+            with open(temp_path, 'wb') as f:
+                f.write(b'x' * 50)
+            os.utime(temp_path, (0, 0))
+            self.assertTrue(dc.sync(10))
+            dc = DiskCache(cache_dir, 800)
+            self.assertFalse(dc.is_empty())
+            self.assertTrue(dc.sync(10))
+            self.assertEqual(dc.stats()['count'], 8)
+            self.assertEqual(dc.stats()['size'], 800)
+            self.assertFalse(os.path.exists(temp_path))
+            self.assertEqual(dc.get('spam7'), b'x' * 100)
+            # Files removed by another process should be a cache miss
+            (file_path, _) = dc.get_file('spam7')
+            os.remove(file_path)
+            self.assertIsNone(dc.get('spam7'))
+            self.assertEqual(dc.stats()['count'], 7)
+            dc.delete('spam6')
+            self.assertIsNone(dc.get_file('spam6'))
+            dc.clear()
+            self.assertEqual(dc.stats()['count'], 0)
+            self.assertTrue(dc.is_empty())
+            self.assertIsNone(DiskCache(cache_dir, 800).get('spam5'))
+            # New objects should not be stored while too many are waiting to be written
+            release_writes = threading.Event()
+            write_file = dc._write_file
+
+            def slow_write_file(name, obj):
+                release_writes.wait()
+                return write_file(name, obj)
+
+            with mock.patch.object(DiskCache, '_WRITE_QUEUE_BYTES', 150), \
+                 mock.patch.object(dc, '_write_file', side_effect=slow_write_file):
+                self.assertTrue(dc.put('eggs1', b'x' * 100))
+                for _ in range(100):
+                    if dc._writing is not None:
+                        break
+                    time.sleep(0.01)
+                self.assertTrue(dc.put('eggs2', b'x' * 100))
+                self.assertFalse(dc.put('eggs3', b'x' * 100))
+                release_writes.set()
+                self.assertTrue(dc.sync(10))
+            self.assertEqual(dc.get('eggs2'), b'x' * 100)
+            self.assertIsNone(dc.get('eggs3'))
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    # Test managed cache with the disk cache as a second tier
+    def test_cache_engine_disk(self):
+        from imageserver.cache_manager import DiskCache
+        cache_dir = '/tmp/qis_disk_cache'
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            with mock.patch.object(cm, '_disk_cache', DiskCache(cache_dir, 1024 * 1024)):
+                self.assertTrue(cm.put('rabbit', b'the killer rabbit'))
+                # Should still be returned after ejection from memcached
+                cm.raw_delete('rabbit_1')
+                self.assertEqual(cm.get('rabbit'), b'the killer rabbit')
+                self.assertEqual(cm.getn(['rabbit']), {'rabbit': b'the killer rabbit'})
+                (obj, _, _) = cm.get_fused('rabbit', 'rabbit_md')
+                self.assertIsNone(obj)
+                self.assertIsNotNone(cm.get_file('rabbit'))
+                self.assertEqual(cm.disk_stats()['count'], 1)
+                # Deletion should remove the disk copy too
+                self.assertTrue(cm.delete('rabbit'))
+                self.assertIsNone(cm.get('rabbit'))
+                self.assertIsNone(cm.get_file('rabbit'))
+        finally:
+            cm.delete('rabbit')
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
     # Test no one has tinkered incorrectly with the caching slot allocation code
     def test_cache_slot_headers(self):
         from imageserver.cache_manager import SLOT_HEADER_SIZE
@@ -2410,6 +3104,23 @@ class UtilityTests(unittest.TestCase):
         rev_dict = rev.to_dict()
         self.assertEqual(ia_dict, rev_dict)
 
+    def test_image_attrs_old_pickle(self):
+        # Older versions stored pickled ImageAttrs without the newer attributes
+        import pickle
+        old_ia = ImageAttrs('some/path', 1, width=200)
+        del old_ia.__dict__['_generation']
+        del old_ia.__dict__['_max_bytes']
+        ia = pickle.loads(pickle.dumps(old_ia))
+        self.assertEqual(ia.generation(), 0)
+        self.assertIsNone(ia.max_bytes())
+        target = ImageAttrs('some/path', 1, width=100)
+        target.normalise_values()
+        ia.normalise_values()
+        self.assertEqual(ia.suitable_for_base(target), 0)
+        self.assertEqual(ia.get_cache_key(), ImageAttrs('some/path', 1, width=200).get_cache_key())
+        ia.validate()
+        self.assertIsNone(ia.to_dict()['max_bytes'])
+
     def test_image_attrs_bad_serialisation(self):
         bad_dict = {
             'filename': 'some/path',
@@ -2474,3 +3185,76 @@ class UtilityTests(unittest.TestCase):
             'record_stats': {'value': 'not a bool'}
         }
         self.assertRaises(ValueError, TemplateAttrs, 'badtemplate', bad_dict)
+
+    def test_precache_checkpoint(self):
+        import tempfile
+        from imageserver.scripts.precache import PreCacheCheckpoint
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cp_path = os.path.join(temp_dir, 'checkpoint.txt')
+            # Nothing is recorded without a file
+            cp = PreCacheCheckpoint('', ['*.jpg'], ['smalljpeg'])
+            cp.set_done('a')
+            self.assertFalse(cp.is_done('a'))
+            cp.close()
+            # Completed directories should be read back by the next run
+            cp = PreCacheCheckpoint(cp_path, ['*.jpg'], ['smalljpeg'])
+            cp.set_done('a')
+            cp.close()
+            cp = PreCacheCheckpoint(cp_path, ['*.jpg'], ['smalljpeg'])
+            self.assertTrue(cp.is_done('a'))
+            self.assertFalse(cp.is_done('b'))
+            cp.close()
+            # But not by a run with different file specs or templates
+            self.assertRaises(
+                ValueError, PreCacheCheckpoint, cp_path, ['*.png'], ['smalljpeg']
+            )
+            self.assertRaises(
+                ValueError, PreCacheCheckpoint, cp_path, ['*.jpg'], ['largejpeg']
+            )
+
+    def test_precache_directory_tracker(self):
+        from imageserver.scripts.precache import DirectoryTracker
+        checkpoint = mock.Mock()
+        tracker = DirectoryTracker(checkpoint)
+        # A directory with no matching files is complete straight away
+        tracker.add_dir('empty', 0)
+        checkpoint.set_done.assert_called_once_with('empty')
+        checkpoint.reset_mock()
+        # Otherwise only once its last file is done
+        tracker.add_dir('a', 2)
+        tracker.add_dir('b', 1)
+        tracker.file_done('a')
+        checkpoint.set_done.assert_not_called()
+        tracker.file_done('b')
+        checkpoint.set_done.assert_called_once_with('b')
+        tracker.file_done('a')
+        self.assertEqual(checkpoint.set_done.call_args_list, [mock.call('b'), mock.call('a')])
+
+    def test_precache_resume(self):
+        import queue
+        import tempfile
+        import threading
+        from imageserver.scripts import precache
+        with tempfile.TemporaryDirectory() as base_dir:
+            for (dir_name, file_name) in [('a', '1.jpg'), ('a', '2.txt'), ('b', '3.jpg')]:
+                os.makedirs(os.path.join(base_dir, dir_name), exist_ok=True)
+                with open(os.path.join(base_dir, dir_name, file_name), 'w') as f:
+                    f.write('x')
+            cp_path = os.path.join(base_dir, 'checkpoint.txt')
+            checkpoint = precache.PreCacheCheckpoint(cp_path, ['*.jpg'], ['smalljpeg'])
+            checkpoint.set_done('a')
+            checkpoint.close()
+            checkpoint = precache.PreCacheCheckpoint(cp_path, ['*.jpg'], ['smalljpeg'])
+            stats = precache.PreCacheStats()
+            work_queue = queue.Queue()
+            with mock.patch.object(precache, 'silent', True):
+                precache.scan_directories(
+                    base_dir, base_dir + os.path.sep, ['*.jpg'], checkpoint,
+                    precache.DirectoryTracker(checkpoint), work_queue,
+                    threading.Event(), stats
+                )
+            checkpoint.close()
+            # Directory 'a' should be skipped as completed by the previous run
+            self.assertEqual(list(work_queue.queue), [('b', '3.jpg')])
+            self.assertEqual(stats.dir_resumed_count, 1)
+            self.assertEqual(stats.total_file_count, 1)